@@ -6,12 +6,18 @@ from flask_apscheduler import APScheduler
 from datetime import datetime
 
 from .utils.config import CONFIG
+from .utils.prompt_assembler import load_tokenizer
 from .entity.models import db, bcrypt, User, UserSettings
 from .repository.user_repository import UserRepository
 from .repository.analysis_repository import AnalysisRepository
 from .services.weather_service import WeatherService
 from .services.vector_store_service import VectorStoreService
 from .services.iot_service import IoTService
+from .services.llm_response_cache import LLMResponseCache
+from .services.llm_gateway import LLMGateway
+from .services.image_hash_index import ImageHashIndex
+from .services.monitoring_scheduler import MonitoringSweepScheduler
+from .services.weather_prefetcher import WeatherPrefetcher
 
 from .agents.image_recognition_agent import ImageRecognitionAgent
 from .agents.treatment_agent import TreatmentAgent
@@ -54,29 +60,35 @@ def create_app():
         app.weather_service = WeatherService()
         app.iot_service = IoTService()
         app.vector_store = VectorStoreService(CONFIG)
-        app.image_agent = ImageRecognitionAgent(model_path=CONFIG.MODEL_PATH, class_names=CONFIG.CLASS_NAMES)
-        app.treatment_agent = TreatmentAgent(weather_service=app.weather_service, user_repo=app.user_repo, analysis_repo=app.analysis_repo, vector_store=app.vector_store)
-        app.nutrient_agent = NutrientAgent(weather_service=app.weather_service, user_repo=app.user_repo, analysis_repo=app.analysis_repo, vector_store=app.vector_store)
-        app.water_agent = WaterAgent(weather_service=app.weather_service, user_repo=app.user_repo, analysis_repo=app.analysis_repo, vector_store=app.vector_store)
+        app.llm_cache = LLMResponseCache(CONFIG)
+        app.llm_gateway = LLMGateway(CONFIG)
+        load_tokenizer()
+        app.image_agent = ImageRecognitionAgent(model_path=CONFIG.MODEL_PATH, class_names=CONFIG.CLASS_NAMES, inference_config=CONFIG.IMAGE_INFERENCE)
+        app.treatment_agent = TreatmentAgent(weather_service=app.weather_service, user_repo=app.user_repo, analysis_repo=app.analysis_repo, vector_store=app.vector_store, response_cache=app.llm_cache, llm_gateway=app.llm_gateway)
+        app.nutrient_agent = NutrientAgent(weather_service=app.weather_service, user_repo=app.user_repo, analysis_repo=app.analysis_repo, vector_store=app.vector_store, response_cache=app.llm_cache, llm_gateway=app.llm_gateway)
+        app.water_agent = WaterAgent(weather_service=app.weather_service, user_repo=app.user_repo, analysis_repo=app.analysis_repo, vector_store=app.vector_store, response_cache=app.llm_cache, llm_gateway=app.llm_gateway)
         app.action_agent = ActionAgent()
-        app.monitoring_agent = EnvironmentalMonitoringAgent(treatment_agent=app.treatment_agent, image_agent=app.image_agent, user_repo=app.user_repo, storage_folder=CONFIG.STORAGE_FOLDER)
+        app.image_hash_index = ImageHashIndex(CONFIG, storage_folder=CONFIG.STORAGE_FOLDER)
+        app.monitoring_agent = EnvironmentalMonitoringAgent(treatment_agent=app.treatment_agent, image_agent=app.image_agent, user_repo=app.user_repo, storage_folder=CONFIG.STORAGE_FOLDER, hash_index=app.image_hash_index)
         app.qa_agent = QAAgent(
             vector_store=app.vector_store,
             nutrient_agent=app.nutrient_agent,
             treatment_agent=app.treatment_agent,
             water_agent=app.water_agent,
-            environmental_agent=app.monitoring_agent
+            environmental_agent=app.monitoring_agent,
+            llm_gateway=app.llm_gateway
         )
         app.pending_plans = {}
         app.scheduler = scheduler
+        app.monitoring_scheduler = MonitoringSweepScheduler(app, scheduled_monitoring_task, CONFIG)
+        app.weather_prefetcher = WeatherPrefetcher(app, app.weather_service, app.user_repo, CONFIG)
 
         print("\n--- BẮT ĐẦU TẢI/XÂY DỰNG CÁC KHO VECTOR TRI THỨC ---")
         
         if hasattr(CONFIG, 'KNOWLEDGE_SOURCES') and isinstance(CONFIG.KNOWLEDGE_SOURCES, dict):
             knowledge_store_names = list(CONFIG.KNOWLEDGE_SOURCES.keys())
-            for store_name in knowledge_store_names:
-                print(f"Đang kiểm tra và khởi tạo kho tri thức: '{store_name}'...")
-                app.vector_store.get_store(store_name)
+            print(f"Đang kiểm tra và khởi tạo các kho tri thức: {knowledge_store_names}...")
+            app.vector_store.load_stores(knowledge_store_names)
             print("--- TẤT CẢ CÁC KHO VECTOR ĐÃ SẴN SÀNG ---\n")
         else:
             print("!!! Cảnh báo: Không tìm thấy định nghĩa KNOWLEDGE_SOURCES trong config. Bỏ qua việc pre-load vector stores.")
@@ -91,18 +103,26 @@ def create_app():
         users_to_schedule = User.query.join(UserSettings).filter(UserSettings.notification_enabled == True).all()
         print(f"--- BẮT ĐẦU LÊN LỊCH GIÁM SÁT CHO {len(users_to_schedule)} NGƯỜI DÙNG ---")
         for user in users_to_schedule:
-            job_id = f'monitoring_job_for_user_{user.id}'
-            if not scheduler.get_job(job_id):
-                scheduler.add_job(
-                    id=job_id,
-                    func=scheduled_monitoring_task,
-                    args=[app, user.id],
-                    trigger='interval',
-                    hours=user.settings.notification_interval_hours
-                )
-                print(f"Đã lên lịch job '{job_id}' cho user {user.id}, mỗi {user.settings.notification_interval_hours} giờ.")
+            app.monitoring_scheduler.schedule_user(user.id, user.settings.notification_interval_hours, user.settings.last_checked_at)
+        if not scheduler.get_job('Monitoring Sweep'):
+            scheduler.add_job(
+                id='Monitoring Sweep', func=app.monitoring_scheduler.sweep, trigger='interval',
+                seconds=app.monitoring_scheduler.sweep_interval_seconds
+            )
+            print(f"Job 'Monitoring Sweep' đã được thêm, quét các nông hộ đến hạn mỗi {app.monitoring_scheduler.sweep_interval_seconds} giây.")
         print("--- KẾT THÚC LÊN LỊCH BAN ĐẦU ---")
+
+        if app.weather_prefetcher.enabled and not scheduler.get_job('Weather Prefetch'):
+            scheduler.add_job(
+                id='Weather Prefetch', func=app.weather_prefetcher.run, trigger='interval',
+                seconds=app.weather_prefetcher.interval_seconds, next_run_time=datetime.now()
+            )
+            print(f"Job 'Weather Prefetch' đã được thêm, kiểm tra cache thời tiết mỗi {app.weather_prefetcher.interval_seconds} giây.")
         
+        if not scheduler.get_job('IoT Compaction'):
+            scheduler.add_job(id='IoT Compaction', func=app.iot_service.compact, trigger='interval', days=1)
+            print("Job 'IoT Compaction' đã được thêm, dọn kho dữ liệu IoT mỗi ngày.")
+
         if not scheduler.get_job('Scheduled Retrain'):
             scheduler.add_job(id='Scheduled Retrain', func=scheduled_retrain_task, args=[app], trigger='interval', weeks=26)
             print("Job 'Scheduled Retrain' đã được thêm, chạy mỗi 6 tháng.")
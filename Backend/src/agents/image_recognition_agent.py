@@ -1,84 +1,211 @@
 import os
 import io
 import numpy as np
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.applications.efficientnet import preprocess_input as efficientnet_preprocess
 from PIL import Image
 from typing import Union, Dict
+from src.services.inference_engine import BatchInferenceEngine
 from src.logging.logger import logger
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+def _load_tflite_interpreter_class():
+    """Interpreter TFLite nhẹ (không cần TensorFlow đầy đủ); trả về None nếu chưa cài runtime nào."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+    except ImportError:
+        return None
+
+class _TFLitePredictor:
+    """Chạy bản export .tflite (đã lượng tử hóa) của model; chỉ một luồng engine gọi nên không cần khóa."""
+    def __init__(self, tflite_path: str, interpreter_class, num_threads: int = None):
+        self.backend = "tflite"
+        self.interpreter = interpreter_class(model_path=tflite_path, num_threads=num_threads)
+        self._input_index = self.interpreter.get_input_details()[0]["index"]
+        self._output_index = self.interpreter.get_output_details()[0]["index"]
+        self._batch_size = None
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        if batch.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch.shape[0]
+        self.interpreter.set_tensor(self._input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_index).copy()
+
+class _KerasPredictor:
+    """Chạy model .keras qua một tf.function đã biên dịch (chiều batch động) thay cho model.predict."""
+    def __init__(self, model_path: str, target_size: tuple):
+        import tensorflow as tf
+        self.backend = "keras"
+        self._tf = tf
+        self.model = tf.keras.models.load_model(model_path)
+        self._serving_fn = tf.function(
+            lambda batch: self.model(batch, training=False),
+            input_signature=[tf.TensorSpec(shape=[None, *target_size, 3], dtype=tf.float32)],
+        )
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        return self._serving_fn(self._tf.convert_to_tensor(batch, dtype=self._tf.float32)).numpy()
+
 class ImageRecognitionAgent:
-    def __init__(self, model_path: str, class_names: list, target_size: tuple = (224, 224)):
+    def __init__(self, model_path: str, class_names: list, target_size: tuple = (224, 224), inference_config: dict = None):
         """
         Khởi tạo Agent nhận diện ảnh.
 
         Args:
-            model_path (str): Đường dẫn đến file model .keras.
+            model_path (str): Đường dẫn đến file model .keras. Nếu cạnh đó có bản export .tflite
+                              (cùng tên) thì bản TFLite được ưu tiên sử dụng.
             class_names (list): Danh sách tên các lớp (bệnh) theo đúng thứ tự mà model đã được huấn luyện.
             target_size (tuple): Kích thước ảnh đầu vào cho model.
+            inference_config (dict): Cấu hình suy luận {"backend", "num_threads", "max_batch_size", "max_wait_ms"}.
         """
         if not model_path or not os.path.exists(model_path):
             error_msg = f"Không tìm thấy file model tại '{model_path}'. Vui lòng kiểm tra lại cấu hình."
             logger.error(error_msg)
             raise FileNotFoundError(error_msg)
-        
-        logger.info(f"Đang tải model nhận diện ảnh từ: {model_path}")
-        self.model = load_model(model_path)
+
+        inference_config = inference_config or {}
         self.class_names = class_names
         self.target_size = target_size
-        logger.info("Tải model nhận diện ảnh thành công!")
 
+        logger.info(f"Đang tải model nhận diện ảnh từ: {model_path}")
+        self.predictor = self._load_predictor(model_path, inference_config)
+        self.predictor(np.zeros((1, *target_size, 3), dtype=np.float32))
+
+        self.inference_timeout = inference_config.get("timeout_seconds", 60)
+        self.engine = BatchInferenceEngine(
+            self.predictor,
+            max_batch_size=inference_config.get("max_batch_size", 16),
+            max_wait_ms=inference_config.get("max_wait_ms", 10),
+            name="ImageRecognition",
+            sample_shape=(*target_size, 3),
+        )
+        logger.info(f"Tải model nhận diện ảnh thành công (backend: {self.predictor.backend})!")
+
+    def _load_predictor(self, model_path: str, inference_config: dict):
+        """
+        Chọn backend suy luận theo cấu hình "backend":
+        - "auto": dùng bản .tflite nếu có file và có runtime, ngược lại dùng model Keras.
+        - "tflite": bắt buộc dùng bản .tflite.
+        - "keras": luôn dùng model Keras.
+        """
+        backend = inference_config.get("backend", "auto")
+        tflite_path = os.path.splitext(model_path)[0] + ".tflite"
+
+        if backend in ("auto", "tflite"):
+            interpreter_class = _load_tflite_interpreter_class() if os.path.exists(tflite_path) else None
+            if interpreter_class is not None:
+                logger.info(f"Sử dụng bản TFLite đã lượng tử hóa: {tflite_path}")
+                return _TFLitePredictor(tflite_path, interpreter_class, inference_config.get("num_threads"))
+            if backend == "tflite":
+                raise RuntimeError(f"Không thể dùng backend TFLite: thiếu file '{tflite_path}' hoặc chưa cài ai-edge-litert/tflite-runtime. "
+                                   "Tạo file bằng: python -m src.model.retrain.export")
+            logger.info("Không có bản TFLite khả dụng, sử dụng model Keras "
+                        "(tạo bản TFLite bằng: python -m src.model.retrain.export).")
+        elif backend != "keras":
+            raise ValueError(f"Backend suy luận không hợp lệ: '{backend}'.")
+        return _KerasPredictor(model_path, self.target_size)
+
+    def _load_image(self, image_input: Union[str, bytes]) -> Image.Image:
+        if isinstance(image_input, str):
+            return Image.open(image_input)
+        if isinstance(image_input, bytes):
+            return Image.open(io.BytesIO(image_input))
+        raise TypeError("Đầu vào của ảnh phải là đường dẫn file (str) hoặc dữ liệu (bytes).")
+
+    def decode_image(self, image_input: Union[str, bytes, Image.Image]) -> Image.Image:
+        """
+        Giải mã ảnh MỘT lần sang RGB. Với JPEG, draft mode cho phép bộ giải mã thu nhỏ ngay khi đọc
+        (1/2, 1/4, 1/8) xuống kích thước nhỏ nhất vẫn không nhỏ hơn `target_size`, nên ảnh drone lớn
+        không phải giải mã ở độ phân giải đầy đủ. Ảnh trả về có thể dùng lại cho các bước khác (vd. phash).
+        """
+        if isinstance(image_input, Image.Image):
+            return image_input if image_input.mode == "RGB" else image_input.convert("RGB")
+        img = self._load_image(image_input)
+        img.draft("RGB", self.target_size)
+        return img.convert("RGB")
 
     def _preprocess_image(self, pil_image: Image.Image) -> np.ndarray:
-        """Tiền xử lý ảnh PIL để phù hợp với đầu vào của model EfficientNet."""
-        img = pil_image.convert("RGB")
-        img = img.resize(self.target_size)
-        img_array = image.img_to_array(img)
-        img_array = efficientnet_preprocess(img_array)
-        img_array = np.expand_dims(img_array, axis=0)
-        return img_array
-
-    def analyze_image(self, image_input: Union[str, bytes]) -> Union[str, Dict[str, str]]:
+        """
+        Tiền xử lý ảnh đã giải mã để phù hợp với đầu vào của model EfficientNet (chưa có chiều batch).
+        Model EfficientNet tự chuẩn hóa bên trong (preprocess_input của Keras là phép đồng nhất), nên chỉ cần
+        ảnh RGB trong khoảng [0, 255]. Trả về mảng uint8; engine ép sang float32 khi chép vào buffer của lô.
+        """
+        img = pil_image if pil_image.mode == "RGB" else pil_image.convert("RGB")
+        if img.size != self.target_size:
+            img = img.resize(self.target_size)
+        return np.asarray(img)
+
+    def _build_result(self, probabilities: np.ndarray) -> Dict:
+        predicted_index = int(np.argmax(probabilities))
+        disease_name = self.class_names[predicted_index]
+        confidence = float(probabilities[predicted_index])
+        logger.info(f"Kết quả nhận diện: '{disease_name}' (Độ tin cậy: {confidence * 100:.2f}%)")
+        return {
+            "label": disease_name,
+            "confidence": confidence,
+            "probabilities": {name: float(p) for name, p in zip(self.class_names, probabilities)},
+        }
+
+    def classify_images(self, image_inputs: list) -> list:
+        """
+        Phân loại nhiều ảnh (đường dẫn, bytes hoặc ảnh PIL đã giải mã bằng `decode_image`);
+        các ảnh được gửi cùng lúc vào engine để được gom chung micro-batch.
+
+        Returns:
+            list: Với mỗi ảnh, một dict {"label", "confidence", "probabilities"} hoặc {"error": ...}.
+        """
+        results = [None] * len(image_inputs)
+        pending = []
+        for position, image_input in enumerate(image_inputs):
+            try:
+                img_array = self._preprocess_image(self.decode_image(image_input))
+                pending.append((position, self.engine.submit(img_array)))
+            except Exception as e:
+                error_message = f"Lỗi khi đọc hoặc xử lý ảnh: {e}"
+                logger.error(error_message)
+                results[position] = {"error": error_message}
+
+        for position, future in pending:
+            try:
+                results[position] = self._build_result(future.result(timeout=self.inference_timeout))
+            except Exception as e:
+                error_message = f"Lỗi trong quá trình dự đoán của model: {e}"
+                logger.error(error_message)
+                results[position] = {"error": error_message}
+        return results
+
+    def classify_image(self, image_input: Union[str, bytes, Image.Image]) -> Dict:
+        """Phân loại một ảnh, trả về nhãn, độ tin cậy và toàn bộ vector xác suất (hoặc dict lỗi)."""
+        logger.info("Bắt đầu phân tích ảnh...")
+        return self.classify_images([image_input])[0]
+
+    def analyze_image(self, image_input: Union[str, bytes, Image.Image]) -> Union[str, Dict[str, str]]:
         """
         Phân tích một ảnh để nhận diện bệnh.
 
         Args:
-            image_input (Union[str, bytes]): Đầu vào có thể là đường dẫn file (str) hoặc dữ liệu ảnh (bytes).
+            image_input (Union[str, bytes, Image.Image]): Đầu vào có thể là đường dẫn file (str), dữ liệu ảnh (bytes)
+                                                          hoặc ảnh đã giải mã bằng `decode_image`.
 
         Returns:
             Union[str, Dict[str, str]]: Trả về tên bệnh (str) nếu thành công,
                                          hoặc một dictionary chứa lỗi (Dict) nếu thất bại.
         """
-        logger.info("Bắt đầu phân tích ảnh...")
-        try:
-            pil_img = None
-            if isinstance(image_input, str):
-                pil_img = Image.open(image_input)
-            elif isinstance(image_input, bytes):
-                pil_img = Image.open(io.BytesIO(image_input))
-            else:
-                raise TypeError("Đầu vào của ảnh phải là đường dẫn file (str) hoặc dữ liệu (bytes).")
-
-            img_array = self._preprocess_image(pil_img)
-
-        except Exception as e:
-            error_message = f"Lỗi khi đọc hoặc xử lý ảnh: {e}"
-            logger.error(error_message)
-            return {"error": error_message}
-
-        try:
-            preds = self.model.predict(img_array, verbose=0)[0]
-            predicted_index = np.argmax(preds)
-            disease_name = self.class_names[predicted_index]
-            confidence = float(preds[predicted_index]) * 100
-
-            logger.info(f"Kết quả nhận diện: '{disease_name}' (Độ tin cậy: {confidence:.2f}%)")
-            return disease_name
-
-        except Exception as e:
-            error_message = f"Lỗi trong quá trình dự đoán của model: {e}"
-            logger.error(error_message)
-            return {"error": error_message}
\ No newline at end of file
+        result = self.classify_image(image_input)
+        if "error" in result:
+            return result
+        return result["label"]
@@ -0,0 +1,197 @@
+import re
+import threading
+import unicodedata
+import numpy as np
+
+from src.logging.logger import logger
+
+DISEASE_KEYWORDS = {
+    "đốm nâu": "brown_spot",
+    "cháy bìa lá": "bacterial_leaf_blight",
+    "đạo ôn": "blast",
+}
+
+# Câu mẫu cho từng tool; câu hỏi mới được so khớp theo độ tương đồng cosine với các câu này.
+TOOL_EXAMPLES = {
+    "answer_general_question": [
+        "Bệnh đạo ôn là gì?",
+        "Nguyên nhân gây bệnh cháy bìa lá lúa",
+        "Giống lúa ST25 có đặc điểm gì?",
+        "Cỏ lồng vực là loại cỏ gì?",
+        "Triệu chứng của bệnh đốm nâu như thế nào?",
+        "Tại sao lúa bị lép hạt?",
+    ],
+    "get_nutrient_recommendation": [
+        "Tôi nên bón phân gì cho lúa lúc này?",
+        "Lập kế hoạch bón phân cho ruộng của tôi",
+        "Bón bao nhiêu kg urê cho ruộng lúa?",
+        "Lúa đẻ nhánh cần bón phân NPK như thế nào?",
+        "Khi nào thì bón thúc đòng?",
+    ],
+    "get_treatment_plan": [
+        "Lúa của tôi bị đạo ôn, phải xử lý thế nào?",
+        "Lá lúa có vết cháy ở mép, nên phun thuốc gì?",
+        "Lá lúa có đốm nâu, cách chữa trị ra sao?",
+        "Ruộng bị sâu cuốn lá, cần thuốc đặc trị",
+        "Lúa bị vàng lá và có vết bệnh, làm sao để trị?",
+    ],
+    "get_watering_advice": [
+        "Ruộng tôi có cần tưới thêm nước không?",
+        "Có nên tháo bớt nước ruộng không?",
+        "Mực nước ruộng bao nhiêu là phù hợp?",
+        "Lịch tưới nước cho lúa mấy ngày tới",
+        "Trời sắp mưa có nên rút nước không?",
+    ],
+    "run_proactive_diagnosis": [
+        "Lúa nhà tôi có bệnh không?",
+        "Kiểm tra ruộng giúp tôi",
+        "Tình trạng lúa hiện giờ thế nào?",
+        "Xem giúp ruộng lúa có vấn đề gì không",
+    ],
+}
+
+TOOL_ARGUMENT = {
+    "answer_general_question": "question",
+    "get_nutrient_recommendation": "problem_description",
+    "get_treatment_plan": "symptom_description",
+    "get_watering_advice": "query",
+}
+
+NUTRIENT_KEYWORDS = ("bón phân", "phân bón", "npk", "urê", "kali", "phân lân", "phân đạm", "bón thúc", "bón lót")
+WATER_KEYWORDS = ("tưới", "mực nước", "tháo nước", "tháo bớt nước", "rút nước", "bơm nước", "ngập nước")
+TREATMENT_ACTION_KEYWORDS = ("trị", "chữa", "phun", "thuốc", "xử lý", "diệt")
+DIAGNOSIS_KEYWORDS = ("có bệnh không", "kiểm tra ruộng", "tình trạng lúa", "có sao không")
+QUESTION_KEYWORDS = ("là gì", "là bệnh gì", "nguyên nhân", "vì sao", "tại sao", "triệu chứng", "đặc điểm")
+# Từ ghép chứa từ khóa hành động nhưng không mang nghĩa chữa trị; bị bỏ qua khi xét TREATMENT_ACTION_KEYWORDS.
+NON_TREATMENT_PHRASES = ("giá trị", "trị số", "quản trị", "chính trị")
+
+def _keyword_pattern(keywords) -> re.Pattern:
+    """
+    Khớp trọn một từ khóa (có thể nhiều tiếng) theo ranh giới từ, để "trị" không khớp bên trong "trịnh"
+    và "phun" không khớp "phung". Từ khóa dài hơn được thử trước.
+    """
+    alternatives = sorted((unicodedata.normalize("NFC", keyword) for keyword in keywords), key=len, reverse=True)
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(keyword) for keyword in alternatives) + r")(?!\w)")
+
+DISEASE_PATTERN = _keyword_pattern(DISEASE_KEYWORDS)
+NUTRIENT_PATTERN = _keyword_pattern(NUTRIENT_KEYWORDS)
+WATER_PATTERN = _keyword_pattern(WATER_KEYWORDS)
+TREATMENT_ACTION_PATTERN = _keyword_pattern(TREATMENT_ACTION_KEYWORDS)
+NON_TREATMENT_PATTERN = _keyword_pattern(NON_TREATMENT_PHRASES)
+DIAGNOSIS_PATTERN = _keyword_pattern(DIAGNOSIS_KEYWORDS)
+QUESTION_PATTERN = _keyword_pattern(QUESTION_KEYWORDS)
+
+class IntentRouter:
+    """
+    Bộ định tuyến ý định cục bộ cho QAAgent.
+    Kết hợp luật từ khóa với độ tương đồng embedding (cùng model sentence-transformer của kho tri thức)
+    để chọn tool mà không cần gọi LLM. Chỉ định tuyến khi đủ tự tin; trường hợp còn lại trả về None
+    để QAAgent dùng LLM chọn tool như trước. Bộ định tuyến chỉ nhìn câu hỏi hiện tại, nên khi đang có lịch sử
+    hội thoại (câu hỏi có thể là câu hỏi nối tiếp, vd. "còn liều lượng thì sao?") nó chỉ định tuyến khi
+    luật từ khóa khớp rõ ràng; các trường hợp khác để LLM chọn tool cùng với lịch sử.
+    """
+    def __init__(self, vector_store, config: dict = None):
+        router_config = {
+            "enabled": True, "similarity_threshold": 0.8, "margin": 0.08, "keyword_min_similarity": 0.6,
+            **(config or {}),
+        }
+        self.vector_store = vector_store
+        self.enabled = router_config["enabled"]
+        self.similarity_threshold = router_config["similarity_threshold"]
+        self.margin = router_config["margin"]
+        self.keyword_min_similarity = router_config["keyword_min_similarity"]
+
+        self._example_tools = [tool for tool, examples in TOOL_EXAMPLES.items() for _ in examples]
+        self._example_matrix = None
+        self._lock = threading.Lock()
+        self._stats = {"total": 0, "keyword": 0, "embedding": 0, "fallback": 0, "by_tool": {}}
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+    def _embed(self, texts: list) -> np.ndarray:
+        vectors = np.asarray(self.vector_store.embed_texts(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _get_example_matrix(self) -> np.ndarray:
+        if self._example_matrix is None:
+            examples = [example for tool_examples in TOOL_EXAMPLES.values() for example in tool_examples]
+            self._example_matrix = self._embed(examples)
+        return self._example_matrix
+
+    def _tool_similarities(self, question: str) -> dict:
+        similarities = self._get_example_matrix() @ self._embed([question])[0]
+        tool_scores = {}
+        for tool, similarity in zip(self._example_tools, similarities):
+            tool_scores[tool] = max(tool_scores.get(tool, -1.0), float(similarity))
+        return tool_scores
+
+    def _keyword_tool(self, text: str):
+        """Tool được luật từ khóa chỉ định duy nhất, hoặc None nếu không có / có nhiều luật cùng khớp."""
+        candidates = set()
+        has_disease = bool(DISEASE_PATTERN.search(text))
+        has_treatment_action = bool(TREATMENT_ACTION_PATTERN.search(NON_TREATMENT_PATTERN.sub(" ", text)))
+        if has_disease and QUESTION_PATTERN.search(text) and not has_treatment_action:
+            candidates.add("answer_general_question")
+        elif has_disease and has_treatment_action:
+            candidates.add("get_treatment_plan")
+        if NUTRIENT_PATTERN.search(text):
+            candidates.add("get_nutrient_recommendation")
+        if WATER_PATTERN.search(text):
+            candidates.add("get_watering_advice")
+        if DIAGNOSIS_PATTERN.search(text) and not has_disease:
+            candidates.add("run_proactive_diagnosis")
+        return candidates.pop() if len(candidates) == 1 else None
+
+    def _record(self, source: str, tool: str = None):
+        with self._lock:
+            self._stats["total"] += 1
+            self._stats[source] += 1
+            if tool:
+                self._stats["by_tool"][tool] = self._stats["by_tool"].get(tool, 0) + 1
+
+    def route(self, question: str, history: list = None):
+        """
+        Trả về (tên tool, tham số) nếu định tuyến cục bộ đủ tự tin, ngược lại trả về None.
+        `history`: các lượt hội thoại trước; nếu có thì chỉ định tuyến theo luật từ khóa.
+        """
+        if not self.enabled or not question:
+            return None
+        text = self._normalize(question)
+        try:
+            keyword_tool = self._keyword_tool(text)
+            tool_scores = self._tool_similarities(question)
+        except Exception as e:
+            logger.error(f"IntentRouter: Lỗi khi phân loại câu hỏi, chuyển sang LLM: {e}")
+            self._record("fallback")
+            return None
+
+        ranked = sorted(tool_scores.items(), key=lambda item: item[1], reverse=True)
+        (best_tool, best_score), second_score = ranked[0], ranked[1][1] if len(ranked) > 1 else -1.0
+
+        if keyword_tool and tool_scores.get(keyword_tool, -1.0) >= self.keyword_min_similarity:
+            tool, source = keyword_tool, "keyword"
+        elif history:
+            logger.info("IntentRouter: Câu hỏi nối tiếp hội thoại không khớp từ khóa rõ ràng, dùng LLM chọn tool theo lịch sử.")
+            self._record("fallback")
+            return None
+        elif best_score >= self.similarity_threshold and best_score - second_score >= self.margin:
+            tool, source = best_tool, "embedding"
+        else:
+            logger.info(f"IntentRouter: Chưa đủ tự tin (tool gần nhất '{best_tool}', điểm {best_score:.2f}), dùng LLM chọn tool.")
+            self._record("fallback")
+            return None
+
+        self._record(source, tool)
+        logger.info(f"IntentRouter: Định tuyến cục bộ tới '{tool}' (theo {source}, điểm {tool_scores[tool]:.2f}).")
+        argument = TOOL_ARGUMENT.get(tool)
+        return tool, ({argument: question} if argument else {})
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = {**self._stats, "by_tool": dict(self._stats["by_tool"])}
+        local = stats["keyword"] + stats["embedding"]
+        stats["local_rate"] = round(local / stats["total"], 4) if stats["total"] else 0.0
+        return stats
@@ -2,26 +2,71 @@ import requests
 import uuid
 import os
 import io
-from PIL import Image
+from contextlib import nullcontext
 import imagehash
+from PIL import Image
 from src.logging.logger import logger
 
+# Phần mở rộng theo định dạng ảnh gốc; chỉ gồm các định dạng tập retrain (image_dataset_from_directory) đọc được,
+# định dạng khác được mã hóa lại sang JPEG khi lưu.
+STORED_IMAGE_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "BMP": ".bmp", "GIF": ".gif"}
+
+def original_image_hash(image_bytes: bytes):
+    """
+    Phash và định dạng của ảnh gốc. Phash được tính trên ảnh giải mã đủ độ phân giải (không dùng draft mode),
+    giống cách các file `<phash>.jpg` cũ trong storage được đặt tên, để hash mới vẫn so khớp được với chúng.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return imagehash.phash(img), img.format
+
 class EnvironmentalMonitoringAgent:
     """
     Agent giám sát môi trường, chịu trách nhiệm phân tích hình ảnh tự động
     và kiểm tra các rủi ro tiềm ẩn cho nông trại.
     """
-    def __init__(self, treatment_agent, image_agent, user_repo, storage_folder):
+    def __init__(self, treatment_agent, image_agent, user_repo, storage_folder, hash_index=None):
         self.treatment_agent = treatment_agent
         self.image_agent = image_agent
         self.user_repo = user_repo
         self.storage_folder = storage_folder
+        self.hash_index = hash_index
         self.mock_api_url = "https://68a96612b115e67576eb0cec.mockapi.io/image"
         
         os.makedirs(self.storage_folder, exist_ok=True)
         logger.info(f"Thư mục lưu trữ ảnh giám sát được đảm bảo tồn tại tại: {self.storage_folder}")
 
-    def check_risk_for_farmer(self, user, iot_data=None):
+    def _store_image(self, image_bytes: bytes, img_hash, label: str, log_prefix: str, image_format: str = None):
+        """
+        Lưu ảnh mới vào thư mục lớp `<storage>/<label>/<phash><ext>` và ghi hash vào chỉ mục.
+        Phần mở rộng theo định dạng thật của ảnh; định dạng ngoài STORED_IMAGE_EXTENSIONS được lưu thành JPEG.
+        """
+        class_folder = os.path.join(self.storage_folder, label)
+        os.makedirs(class_folder, exist_ok=True)
+        extension = STORED_IMAGE_EXTENSIONS.get(image_format, ".jpg")
+        image_path = os.path.join(class_folder, f"{img_hash}{extension}")
+
+        if os.path.exists(image_path):
+            logger.info(f"{log_prefix} Ảnh trùng lặp đã được phát hiện (hash: {img_hash}). Bỏ qua việc lưu ảnh mới.")
+            return image_path, True
+
+        if image_format in STORED_IMAGE_EXTENSIONS:
+            # Lưu nguyên bytes đã tải về: giữ ảnh gốc cho tập retrain và không phải mã hóa lại.
+            with open(image_path, "wb") as f:
+                f.write(image_bytes)
+        else:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                img.convert("RGB").save(image_path, format="JPEG", quality=95)
+        if self.hash_index:
+            self.hash_index.add(img_hash, label, image_path)
+        logger.info(f"{log_prefix} Đã lưu ảnh mới tại: {image_path}")
+        return image_path, False
+
+    @staticmethod
+    def _stage(stages, name: str):
+        """Vùng giới hạn đồng thời của một giai đoạn khi chạy trong sweep scheduler; không giới hạn nếu gọi trực tiếp."""
+        return stages.stage(name) if stages else nullcontext()
+
+    def check_risk_for_farmer(self, user, iot_data=None, stages=None, iot_stats=None):
         """
         Kiểm tra rủi ro và chạy phân tích cho MỘT nông dân cụ thể.
         Đây là hàm được gọi bởi scheduler (tác vụ nền).
@@ -34,9 +79,14 @@ class EnvironmentalMonitoringAgent:
         farmer_id = user.id
         logger.info(f"Bắt đầu kiểm tra rủi ro định kỳ cho nông hộ {farmer_id} tại {farm.province}...")
         
-        self.run_single_automated_analysis(farmer_id, iot_data=iot_data, is_scheduled=True)
+        # Lấy trước và phân tích sẵn dự báo (vào cache) trong giai đoạn "weather" để bước lập kế hoạch không phải chờ crawl.
+        with self._stage(stages, "weather"):
+            self.treatment_agent.weather_service.get_forecast_frame(farm.province)
 
-    def run_single_automated_analysis(self, farmer_id: str, iot_data=None, is_scheduled: bool = False):
+        self.run_single_automated_analysis(farmer_id, iot_data=iot_data, is_scheduled=True, stages=stages, iot_stats=iot_stats)
+
+    def run_single_automated_analysis(self, farmer_id: str, iot_data=None, is_scheduled: bool = False, stages=None,
+                                      iot_stats=None):
         """
         Thực hiện một quy trình phân tích tự động hoàn chỉnh, bao gồm kiểm tra trùng lặp ảnh.
         """
@@ -55,43 +105,54 @@ class EnvironmentalMonitoringAgent:
                 image_bytes = r.content
             logger.info(f"{log_prefix} Đã tải ảnh thành công vào bộ nhớ.")
 
-            detection_result = self.image_agent.analyze_image(image_bytes)
-
-            if isinstance(detection_result, dict) and "error" in detection_result:
-                logger.error(f"{log_prefix} Lỗi từ agent nhận diện ảnh: {detection_result['error']}. Dừng lại.")
-                return {"error": "Không thể phân tích được hình ảnh."}
-
-            if not isinstance(detection_result, str):
-                error_detail = f"Dữ liệu nhận được: {str(detection_result)[:500]}..."
-                logger.error(f"{log_prefix} Lỗi: Agent nhận diện ảnh trả về định dạng không hợp lệ. {error_detail}")
-                return {"error": "Lỗi hệ thống: Agent nhận diện ảnh trả về định dạng không mong muốn."}
-            
-            detected_disease_name = detection_result
-            logger.info(f"{log_prefix} Kết quả nhận diện: '{detected_disease_name}'.")
-            
-            image_path_to_save = None
-            is_duplicate = False
+            # Phash tính trên ảnh gốc (cùng cách với các hash đã có); ảnh cho model được giải mã bằng draft mode
+            # và chỉ khi ảnh chưa từng được phân tích.
             try:
-                pil_image = Image.open(io.BytesIO(image_bytes))
-                img_hash = imagehash.phash(pil_image)
-                image_extension = ".jpg"
-                unique_filename = f"{img_hash}{image_extension}"
-
-                class_folder = os.path.join(self.storage_folder, detected_disease_name)
-                os.makedirs(class_folder, exist_ok=True)
-                image_path_to_save = os.path.join(class_folder, unique_filename)
-
-                if os.path.exists(image_path_to_save):
-                    logger.info(f"{log_prefix} Ảnh trùng lặp đã được phát hiện (hash: {img_hash}). Bỏ qua việc lưu ảnh mới.")
-                    is_duplicate = True
-                else:
-                    pil_image.save(image_path_to_save)
-                    logger.info(f"{log_prefix} Đã lưu ảnh mới tại: {image_path_to_save}")
-
+                img_hash, image_format = original_image_hash(image_bytes)
             except Exception as e:
-                logger.error(f"{log_prefix} Lỗi trong quá trình hashing hoặc lưu ảnh: {e}")
+                logger.error(f"{log_prefix} Lỗi khi giải mã hoặc hashing ảnh: {e}")
                 return {"error": "Lỗi khi xử lý file ảnh."}
 
+            known_image = self.hash_index.find(img_hash) if self.hash_index else None
+            if known_image:
+                # Ảnh trùng / gần trùng với ảnh đã phân tích: dùng lại kết quả cũ, không chạy model và không lưu ảnh.
+                detected_disease_name = known_image["label"]
+                image_path_to_save = known_image["path"]
+                image_hash = known_image["hash"]
+                is_duplicate = True
+                logger.info(
+                    f"{log_prefix} Ảnh trùng lặp đã được phát hiện (hash: {img_hash}, khoảng cách {known_image['distance']} "
+                    f"so với {known_image['hash']}). Dùng lại kết quả nhận diện: '{detected_disease_name}'."
+                )
+            else:
+                try:
+                    pil_image = self.image_agent.decode_image(image_bytes)
+                except Exception as e:
+                    logger.error(f"{log_prefix} Không thể giải mã ảnh: {e}")
+                    return {"error": "Không thể phân tích được hình ảnh."}
+                with self._stage(stages, "inference"):
+                    detection_result = self.image_agent.analyze_image(pil_image)
+
+                if isinstance(detection_result, dict) and "error" in detection_result:
+                    logger.error(f"{log_prefix} Lỗi từ agent nhận diện ảnh: {detection_result['error']}. Dừng lại.")
+                    return {"error": "Không thể phân tích được hình ảnh."}
+
+                if not isinstance(detection_result, str):
+                    error_detail = f"Dữ liệu nhận được: {str(detection_result)[:500]}..."
+                    logger.error(f"{log_prefix} Lỗi: Agent nhận diện ảnh trả về định dạng không hợp lệ. {error_detail}")
+                    return {"error": "Lỗi hệ thống: Agent nhận diện ảnh trả về định dạng không mong muốn."}
+
+                detected_disease_name = detection_result
+                image_hash = str(img_hash)
+                logger.info(f"{log_prefix} Kết quả nhận diện: '{detected_disease_name}'.")
+
+                try:
+                    image_path_to_save, is_duplicate = self._store_image(image_bytes, img_hash, detected_disease_name, log_prefix,
+                                                                          image_format)
+                except Exception as e:
+                    logger.error(f"{log_prefix} Lỗi trong quá trình lưu ảnh: {e}")
+                    return {"error": "Lỗi khi xử lý file ảnh."}
+
             if detected_disease_name == 'healthy':
                 logger.info(f"{log_prefix} Cây trồng được xác định là khỏe mạnh. Không cần tạo kế hoạch điều trị.")
                 if is_scheduled:
@@ -100,12 +161,15 @@ class EnvironmentalMonitoringAgent:
                     return {"message": "Phân tích hoàn tất. Cây trồng được xác định là khỏe mạnh.", "detection": "healthy", "is_duplicate": is_duplicate}
 
             logger.info(f"{log_prefix} Chuyển thông tin cho TreatmentAgent để tạo kế hoạch...")
-            plan_result = self.treatment_agent.create_treatment_plan(
-                detected_disease_name, 
-                farmer_id,
-                image_path_to_save=image_path_to_save,
-                iot_data=iot_data
-            )
+            with self._stage(stages, "llm"):
+                plan_result = self.treatment_agent.create_treatment_plan(
+                    detected_disease_name,
+                    farmer_id,
+                    image_path_to_save=image_path_to_save,
+                    iot_data=iot_data,
+                    image_hash=image_hash,
+                    iot_stats=iot_stats,
+                )
             
             if is_scheduled:
                 if "error" in plan_result:
@@ -115,7 +179,7 @@ class EnvironmentalMonitoringAgent:
                 return
             
             if isinstance(plan_result, dict):
-                plan_result['is_duplicate'] = is_duplicate
+                plan_result['is_duplicate'] = is_duplicate or plan_result.get('is_duplicate', False)
             
             return plan_result
 
@@ -1,6 +1,7 @@
 import json
 from datetime import datetime
 from .base_agent import BaseAgent
+from src.utils.prompt_assembler import PromptAssembler
 from src.logging.logger import logger 
 
 class NutrientAgent(BaseAgent):
@@ -8,7 +9,7 @@ class NutrientAgent(BaseAgent):
     Agent chuyên trách việc lập kế hoạch bón phân cho toàn bộ vụ mùa.
     """
     def create_fertilization_plan(self, farmer_id: str):
-        if not self.client:
+        if not self.llm_ready:
             logger.warning("NutrientAgent không thể tạo kế hoạch vì Trợ lý AI (OpenAI client) chưa sẵn sàng.")
             return {"error": "Trợ lý AI chưa sẵn sàng."}
 
@@ -32,19 +33,24 @@ class NutrientAgent(BaseAgent):
             Thông tin về các giai đoạn sinh trưởng quan trọng như đẻ nhánh, làm đòng, trổ bông. 
             Liều lượng NPK, Urê, Kali cho từng giai đoạn.
         """
-        retrieved_context = self.vector_store.retrieve("fertilizer_management", query_for_retrieval, k=10)
+        retrieved_context = self.vector_store.retrieve("fertilizer_management", query_for_retrieval, k=6)
 
         prompt = self._build_fertilization_prompt(retrieved_context, farmer_info_for_llm)
+
+        cache_key, cached_plan = self._get_cached_response("fertilization", prompt)
+        if cached_plan is not None:
+            logger.info(f"CACHE HIT: Dùng lại kế hoạch bón phân đã tạo cho nông hộ {farmer_id}.")
+            return {"plan": cached_plan}
         
         try:
             logger.info(f"Đang tạo kế hoạch bón phân cho nông hộ {farmer_id}...")
-            response = self.client.chat.completions.create(
-                model=self.model_name,
+            response = self.llm.chat_completion(
                 messages=[{"role": "user", "content": prompt}],
                 response_format={"type": "json_object"},
                 temperature=self.generation_config.get("temperature", 0.2) 
             )
             plan = json.loads(response.choices[0].message.content)
+            self._store_cached_response(cache_key, "fertilization", plan, farm_id=farm.id)
             logger.info(f"Đã tạo thành công kế hoạch bón phân cho nông hộ {farmer_id}.")
             return {"plan": plan}
         except Exception as e:
@@ -52,7 +58,9 @@ class NutrientAgent(BaseAgent):
             return {"error": "Rất tiếc, đã có lỗi khi tạo kế hoạch bón phân."}
 
     def _build_fertilization_prompt(self, retrieved_context: str, farmer_info: dict) -> str:
-        farmer_json = json.dumps(farmer_info, ensure_ascii=False, indent=2)
+        assembler = PromptAssembler("fertilization")
+        retrieved_context = assembler.add_context("context", retrieved_context)
+        farmer_json = assembler.add_json("farmer_info", farmer_info)
         
         prompt = f"""
             **Bối cảnh:**
@@ -113,5 +121,5 @@ class NutrientAgent(BaseAgent):
             }}
             ```
         """
-        return prompt
+        return assembler.finalize(prompt)
 
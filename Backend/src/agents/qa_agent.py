@@ -1,22 +1,23 @@
 import json
-import openai
 from datetime import datetime
 from src.utils.config import CONFIG
+from .intent_router import IntentRouter, DISEASE_KEYWORDS
+from src.utils.prompt_assembler import PromptAssembler
 from src.logging.logger import logger
 
 class QAAgent:
     """
     QAAgent hoạt động như một Orchestrator, điều phối các tác vụ đến các agent chuyên biệt.
     """
-    def __init__(self, vector_store, nutrient_agent, treatment_agent, water_agent, environmental_agent):
-        self.api_key = CONFIG.OPENAI_API_KEY
-        self.client = None
+    def __init__(self, vector_store, nutrient_agent, treatment_agent, water_agent, environmental_agent, llm_gateway=None):
+        self.llm = llm_gateway
         self.model_name = CONFIG.OPENAI_MODEL_NAME
         self.generation_config = CONFIG.OPENAI_GENERATION_CONFIG
 
         if not vector_store:
             raise ValueError("QAAgent yêu cầu phải có VectorStoreService.")
         self.vector_store = vector_store
+        self.intent_router = IntentRouter(vector_store, getattr(CONFIG, "INTENT_ROUTER", None))
 
         self.nutrient_agent = nutrient_agent
         self.treatment_agent = treatment_agent
@@ -31,15 +32,12 @@ class QAAgent:
             "run_proactive_diagnosis": self._execute_proactive_diagnosis, 
         }
 
-        if self.api_key:
-            try:
-                logger.info("Đang cấu hình và khởi tạo client OpenAI cho QAAgent...")
-                self.client = openai.OpenAI(api_key=self.api_key)
-                logger.info(f"Khởi tạo client OpenAI cho QAAgent với model '{self.model_name}' thành công!")
-            except Exception as e:
-                logger.error(f"[LỖI CẤU HÌNH OPENAI] {e}")
-        else:
-            logger.warning("[CẢNH BÁO] Không tìm thấy API Key. QAAgent sẽ không hoạt động.")
+        if not self.llm_ready:
+            logger.warning("[CẢNH BÁO] LLM gateway chưa sẵn sàng. QAAgent sẽ không hoạt động.")
+
+    @property
+    def llm_ready(self) -> bool:
+        return self.llm is not None and self.llm.available
     
     def _execute_nutrient_tool(self, farmer_info: dict, **kwargs) -> str:
         """Hàm trung gian chuẩn bị và gọi NutrientAgent."""
@@ -61,13 +59,8 @@ class QAAgent:
         """Hàm trung gian chuẩn bị và gọi TreatmentAgent."""
         logger.info("Điều phối tới TreatmentAgent...")
         
-        disease_map = {
-            "đốm nâu": "brown_spot",
-            "cháy bìa lá": "bacterial_leaf_blight",
-            "đạo ôn": "blast"
-        }
         model_disease_name = None
-        for keyword, disease_code in disease_map.items():
+        for keyword, disease_code in DISEASE_KEYWORDS.items():
             if keyword in symptom_description.lower():
                 model_disease_name = disease_code
                 break
@@ -171,79 +164,141 @@ class QAAgent:
             },
         ]
 
+    def _general_qa_messages(self, farmer_info: dict, question: str, history: list) -> list:
+        retrieved_context = self.vector_store.retrieve("general_qa", question, k=3)
+        prompt = self._build_qa_prompt(farmer_info, question, retrieved_context, history)
+        return [{"role": "user", "content": prompt}]
+
     def _handle_general_qa(self, farmer_info: dict, question: str, history: list) -> str:
         logger.info(f"Tool 'answer_general_question' được kích hoạt cho câu hỏi: '{question}'")
-        retrieved_context = self.vector_store.retrieve("general_qa", question, k=5)
-        prompt = self._build_qa_prompt(farmer_info, question, retrieved_context, history)
-        
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=[{"role": "user", "content": prompt}],
+        response = self.llm.chat_completion(
+            messages=self._general_qa_messages(farmer_info, question, history),
             temperature=self.generation_config.get("temperature", 0.7),
         )
         return response.choices[0].message.content.strip()
 
-    def answer_question(self, farmer_info: dict, question: str, history: list = None):
-        if not self.client:
-            return {"error": "Trợ lý AI chưa sẵn sàng.", "history": history or []}
-        history = history or []
-        if not farmer_info:
-            return {"error": "Không tìm thấy thông tin nông hộ.", "history": history}
-        
+    def _greeting_answer(self, question: str, history: list):
         greetings = ["chào", "hello", "xin chào", "hi"]
         if not history and question.lower().strip() in greetings:
-            answer = "Dạ chào bác, tôi là trợ lý nông nghiệp AI. Bác cần tôi giúp gì về việc đồng áng hôm nay ạ?"
-            history.append({"role": "user", "content": question})
-            history.append({"role": "assistant", "content": answer})
-            return {"answer": answer, "history": history}
+            return "Dạ chào bác, tôi là trợ lý nông nghiệp AI. Bác cần tôi giúp gì về việc đồng áng hôm nay ạ?"
+        return None
 
+    def _select_tool(self, question: str, history: list):
+        """Để LLM chọn tool phù hợp. Trả về (tên tool, tham số) hoặc (None, {}) nếu LLM không chọn tool."""
         messages = [{"role": "system", "content": "Bạn là một trợ lý nông nghiệp AI. Hãy phân tích câu hỏi của người dùng và chọn công cụ phù hợp nhất để trả lời."}]
         messages.extend(history)
         messages.append({"role": "user", "content": question})
 
+        logger.info(f"QAAgent đang phân tích câu hỏi để chọn tool: '{question}'")
+        response = self.llm.chat_completion(
+            messages=messages,
+            tools=self._define_tools(),
+            tool_choice="auto", 
+        )
+        tool_calls = response.choices[0].message.tool_calls
+        if not tool_calls:
+            return None, {}
+        tool_call = tool_calls[0]
+        return tool_call.function.name, json.loads(tool_call.function.arguments)
+
+    def _choose_tool(self, question: str, history: list):
+        """Thử định tuyến cục bộ trước; chỉ gọi LLM chọn tool khi bộ định tuyến chưa đủ tự tin."""
+        routed = self.intent_router.route(question, history)
+        if routed:
+            return routed
+        return self._select_tool(question, history)
+
+    def _run_tool(self, function_name: str, function_args: dict, farmer_info: dict, history: list) -> str:
+        function_to_call = self.available_tools.get(function_name)
+        if not function_to_call:
+            return f"Lỗi: Không tìm thấy hàm thực thi cho tool '{function_name}'."
+        logger.info(f"LLM quyết định gọi tool: '{function_name}' với tham số: {function_args}")
+        all_args = {**function_args, 'farmer_info': farmer_info, 'history': history}
+        return function_to_call(**all_args)
+
+    @staticmethod
+    def _append_history(history: list, question: str, answer: str) -> list:
+        history.append({"role": "user", "content": question})
+        history.append({"role": "assistant", "content": answer})
+        if len(history) > 10:
+            history = history[-10:]
+        return history
+
+    def answer_question(self, farmer_info: dict, question: str, history: list = None):
+        if not self.llm_ready:
+            return {"error": "Trợ lý AI chưa sẵn sàng.", "history": history or []}
+        history = history or []
+        if not farmer_info:
+            return {"error": "Không tìm thấy thông tin nông hộ.", "history": history}
+        
+        greeting = self._greeting_answer(question, history)
+        if greeting:
+            return {"answer": greeting, "history": self._append_history(history, question, greeting)}
+
         try:
-            logger.info(f"QAAgent đang phân tích câu hỏi để chọn tool: '{question}'")
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                tools=self._define_tools(),
-                tool_choice="auto", 
-            )
-            response_message = response.choices[0].message
-            tool_calls = response_message.tool_calls
-
-            answer = ""
-            if tool_calls:
-                tool_call = tool_calls[0] 
-                function_name = tool_call.function.name
-                function_to_call = self.available_tools.get(function_name)
-                
-                if function_to_call:
-                    function_args = json.loads(tool_call.function.arguments)
-                    logger.info(f"LLM quyết định gọi tool: '{function_name}' với tham số: {function_args}")
-                    
-                    all_args = {**function_args, 'farmer_info': farmer_info, 'history': history}
-                    
-                    answer = function_to_call(**all_args)
-                else:
-                    answer = f"Lỗi: Không tìm thấy hàm thực thi cho tool '{function_name}'."
+            function_name, function_args = self._choose_tool(question, history)
+            if function_name:
+                answer = self._run_tool(function_name, function_args, farmer_info, history)
             else:
                 logger.info("LLM không chọn tool, mặc định xử lý như câu hỏi chung.")
                 answer = self._handle_general_qa(farmer_info, question, history)
 
-            history.append({"role": "user", "content": question})
-            history.append({"role": "assistant", "content": answer})
-            if len(history) > 10:
-                history = history[-10:]
-            
+            history = self._append_history(history, question, answer)
             return {"answer": answer, "history": history}
 
         except Exception as e:
             logger.error(f"Lỗi khi điều phối câu trả lời: {e}", exc_info=True)
             return {"error": "Rất tiếc, đã có lỗi xảy ra. Vui lòng thử lại.", "history": history}
 
+    def stream_answer(self, farmer_info: dict, question: str, history: list = None):
+        """
+        Phiên bản stream của `answer_question`. Là generator trả về các cặp (sự kiện, dữ liệu):
+        ("token", đoạn văn bản) khi câu trả lời đang được sinh, sau cùng là ("done", {"answer", "history"})
+        hoặc ("error", {"error", "history"}).
+        Câu hỏi chung được stream trực tiếp từ LLM; kết quả của các tool chuyên biệt được gửi thành một đoạn.
+        """
+        history = history or []
+        if not self.llm_ready:
+            yield "error", {"error": "Trợ lý AI chưa sẵn sàng.", "history": history}
+            return
+        if not farmer_info:
+            yield "error", {"error": "Không tìm thấy thông tin nông hộ.", "history": history}
+            return
+
+        greeting = self._greeting_answer(question, history)
+        if greeting:
+            yield "token", greeting
+            yield "done", {"answer": greeting, "history": self._append_history(history, question, greeting)}
+            return
+
+        try:
+            function_name, function_args = self._choose_tool(question, history)
+            if function_name and function_name != "answer_general_question":
+                answer = self._run_tool(function_name, function_args, farmer_info, history)
+                yield "token", answer
+            else:
+                general_question = function_args.get("question", question) if function_name else question
+                logger.info(f"Stream câu trả lời chung cho câu hỏi: '{general_question}'")
+                parts = []
+                for delta in self.llm.stream_chat_completion(
+                    messages=self._general_qa_messages(farmer_info, general_question, history),
+                    temperature=self.generation_config.get("temperature", 0.7),
+                ):
+                    parts.append(delta)
+                    yield "token", delta
+                answer = "".join(parts).strip()
+
+            yield "done", {"answer": answer, "history": self._append_history(history, question, answer)}
+
+        except Exception as e:
+            logger.error(f"Lỗi khi stream câu trả lời: {e}", exc_info=True)
+            yield "error", {"error": "Rất tiếc, đã có lỗi xảy ra. Vui lòng thử lại.", "history": history}
+
     def _build_qa_prompt(self, farmer_info: dict, question: str, retrieved_context: str, history: list) -> str:
-        farmer_json = json.dumps(farmer_info, ensure_ascii=False, indent=2)
+        assembler = PromptAssembler("qa")
+        farmer_json = assembler.add_json("farmer_info", farmer_info)
+        retrieved_context = assembler.add_context("context", retrieved_context)
+        question = assembler.add_text("question", question)
         today = datetime.now().date()
         planting_date_str = farmer_info.get("farm_properties", {}).get("planting_date")
         days_since_planting = "không rõ"
@@ -255,11 +310,12 @@ class QAAgent:
                 pass 
         history_str = ""
         if history:
-            formatted_lines = ["**Lịch sử trò chuyện gần đây:**"]
+            formatted_lines = []
             for message in history:
                 role = "Bác nông dân" if message["role"] == "user" else "Trợ lý AI"
                 formatted_lines.append(f"- {role}: {message['content']}")
-            history_str = "\n".join(formatted_lines) + "\n"
+            history_lines = assembler.add_lines("history", formatted_lines)
+            history_str = "**Lịch sử trò chuyện gần đây:**\n" + history_lines + "\n"
 
         prompt = f"""
             **Bối cảnh:**
@@ -282,4 +338,4 @@ class QAAgent:
 
             **Câu trả lời của bạn:**
         """
-        return prompt
\ No newline at end of file
+        return assembler.finalize(prompt)
\ No newline at end of file
@@ -1,37 +1,132 @@
+import re
 import json
-from datetime import datetime, timedelta
-import pandas as pd
+import threading
+from datetime import datetime
 from .base_agent import BaseAgent
+from src.utils.prompt_assembler import PromptAssembler
 from src.logging.logger import logger
 
+# Trường main_message hoàn chỉnh trong JSON đang được stream (chuỗi JSON có thể chứa ký tự thoát).
+MAIN_MESSAGE_PATTERN = re.compile(r'"main_message"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
 class TreatmentAgent(BaseAgent):
-    def __init__(self, weather_service, user_repo, analysis_repo, vector_store):
-        super().__init__(weather_service, user_repo, analysis_repo, vector_store)
+    HOURLY_PROMPT_FIELDS = ('hour', 'temperature', 'humidity', 'wind_kmh', 'rain_chance', 'description')
+    PLAN_SYSTEM_KEY = "action_details_for_system"
+    IMAGE_PLAN_CACHE_NAMESPACE = "treatment_image"
+    PLAN_CONTEXT_CACHE_SIZE = 128
+
+    def __init__(self, weather_service, user_repo, analysis_repo, vector_store, response_cache=None, llm_gateway=None):
+        super().__init__(weather_service, user_repo, analysis_repo, vector_store, response_cache=response_cache, llm_gateway=llm_gateway)
         self.disease_map = {
             "bacterial_leaf_blight": "Cháy bìa lá", "blast": "Đạo ôn",
             "brown_spot": "Đốm nâu", "healthy": "Khỏe mạnh"
         }
+        self._plan_context_cache = {}
+        self._plan_context_group_locks = {}
+        self._plan_context_lock = threading.Lock()
+        self._plan_context_stats = {"hits": 0, "misses": 0}
+
+    def _image_plan_cache_source(self, image_hash: str, farm, model_disease_name: str):
+        """
+        Định danh cache kế hoạch cho một ảnh giám sát: (phash, nông trại, bệnh, phiên bản dự báo thời tiết).
+        Trả về None khi chưa có dự báo còn hạn, vì kế hoạch mới sẽ dựa trên dữ liệu thời tiết mới.
+        """
+        forecast_version = self.weather_service.get_cache_time(farm.province)
+        if not image_hash or not forecast_version:
+            return None
+        return f"image_hash={image_hash}; farm_id={farm.id}; disease={model_disease_name}; forecast={forecast_version}"
+
+    def _get_cached_image_plan(self, image_hash: str, farm, model_disease_name: str):
+        """Kế hoạch hiện tại của phiên phân tích trước đó cho cùng ảnh, nếu phiên đó vẫn còn."""
+        cache_source = self._image_plan_cache_source(image_hash, farm, model_disease_name)
+        if not cache_source:
+            return None
+        _, cached = self._get_cached_response(self.IMAGE_PLAN_CACHE_NAMESPACE, cache_source)
+        if not cached:
+            return None
+        session = self.analysis_repo.get_session_by_id(cached["session_id"])
+        if not session or not session.final_plan_json:
+            return None
+        return {"session_id": session.id, "plan": json.loads(session.final_plan_json), "is_duplicate": True}
+
+    def _build_plan_context(self, province: str, forecast_frame, model_disease_name: str, disease_name_vn: str) -> dict:
+        """
+        Phần dùng chung của kế hoạch cho mọi nông hộ cùng tỉnh và cùng bệnh: ngữ cảnh truy xuất,
+        tóm tắt dự báo 3 ngày và chi tiết theo giờ của ngày phun thuốc tốt nhất.
+        """
+        query_for_retrieval = f"""
+            Thông tin chi tiết về cách phòng và điều trị bệnh {disease_name_vn} trên lúa, 
+            bao gồm triệu chứng, thuốc đặc trị, biện pháp canh tác, và các lưu ý về dinh dưỡng
+            để giúp cây phục hồi.
+        """
+        retrieved_context = self.vector_store.retrieve(model_disease_name, query_for_retrieval, k=4)
+
+        forecast = forecast_frame.next_days(datetime.now().date(), days=3)
+        if forecast.empty:
+            logger.error(f"Không có đủ dữ liệu thời tiết cho 3 ngày tới tại {province}.")
+            return {"error": "Không có đủ dữ liệu thời tiết cho 3 ngày tới."}
+
+        best_day = forecast.best_spray_day()
+        # Ngày đã nằm ở tiêu đề mục nên mỗi bản ghi theo giờ chỉ giữ các trường thời tiết.
+        hourly_detail_for_target_date = [
+            {field: hour_data.get(field) for field in self.HOURLY_PROMPT_FIELDS}
+            for hour_data in best_day["hours"]
+        ]
+
+        return {
+            "retrieved_context": retrieved_context,
+            "daily_summary": forecast.daily_summary(),
+            "hourly_detail": hourly_detail_for_target_date,
+            "target_date": best_day["date"],
+            "spray_window": forecast.best_spray_window(best_day["date"]),
+        }
 
-    def _score_spraying_day(self, daily_hourly_data: list) -> float:
-        """Chấm điểm một ngày dựa trên mức độ phù hợp cho việc phun thuốc."""
-        if not daily_hourly_data: return 0
-        score = 100.0
-        dry_hours_streak, max_dry_hours_streak = 0, 0
-        for hour in daily_hourly_data:
-            if hour.get('rain_chance', 100) > 30:
-                score -= 10
-                dry_hours_streak = 0
-            else:
-                dry_hours_streak += 1
-            if hour.get('wind_kmh', 99) > 15:
-                score -= 2
-            max_dry_hours_streak = max(max_dry_hours_streak, dry_hours_streak)
-        score += max_dry_hours_streak * 5
-        return score
-
-    def create_treatment_plan(self, model_disease_name: str, farmer_id: str, image_path_to_save: str = None, iot_data=None):
-        """Tạo kế hoạch điều trị dựa trên bệnh được phát hiện."""
-        if not self.client:
+    def _get_plan_context(self, province: str, model_disease_name: str, disease_name_vn: str) -> dict:
+        """
+        Lấy phần dùng chung của kế hoạch theo nhóm (tỉnh, bệnh), tính MỘT lần cho mỗi phiên bản dự báo trong ngày.
+        Các worker giám sát cùng nhóm chạy đồng thời sẽ chờ lần tính đầu tiên thay vì tính lại.
+        Kết quả được dùng chung giữa các nông hộ nên không được sửa đổi.
+        """
+        forecast_frame = self.weather_service.get_forecast_frame(province)
+        if forecast_frame is None:
+            logger.error(f"Không thể lấy dữ liệu thời tiết cho tỉnh {province}.")
+            return {"error": f"Không thể lấy dữ liệu thời tiết cho tỉnh {province}."}
+
+        forecast_version = forecast_frame.cache_time
+        if not forecast_version:
+            return self._build_plan_context(province, forecast_frame, model_disease_name, disease_name_vn)
+
+        group_key = (province, model_disease_name, forecast_version, datetime.now().date().isoformat())
+        with self._plan_context_lock:
+            group_lock = self._plan_context_group_locks.setdefault(group_key, threading.Lock())
+        with group_lock:
+            with self._plan_context_lock:
+                cached = self._plan_context_cache.get(group_key)
+                self._plan_context_stats["hits" if cached else "misses"] += 1
+            if cached:
+                return cached
+            plan_context = self._build_plan_context(province, forecast_frame, model_disease_name, disease_name_vn)
+            with self._plan_context_lock:
+                if "error" not in plan_context:
+                    self._plan_context_cache[group_key] = plan_context
+                    while len(self._plan_context_cache) > self.PLAN_CONTEXT_CACHE_SIZE:
+                        del self._plan_context_cache[next(iter(self._plan_context_cache))]
+                self._plan_context_group_locks.pop(group_key, None)
+            return plan_context
+
+    def get_plan_context_stats(self) -> dict:
+        with self._plan_context_lock:
+            return {**self._plan_context_stats, "groups": len(self._plan_context_cache)}
+
+    def create_treatment_plan(self, model_disease_name: str, farmer_id: str, image_path_to_save: str = None, iot_data=None,
+                              image_hash: str = None, iot_stats: dict = None):
+        """
+        Tạo kế hoạch điều trị dựa trên bệnh được phát hiện.
+        Khi có `image_hash` (ảnh giám sát), ảnh đã được lập kế hoạch với cùng dự báo thời tiết sẽ dùng lại
+        phiên phân tích cũ (đánh dấu `is_duplicate`) thay vì gọi LLM và tạo phiên mới.
+        `iot_stats` là thống kê cảm biến theo cửa sổ 1h/6h/24h (IoTService.get_aggregates).
+        """
+        if not self.llm_ready:
             logger.warning("TreatmentAgent không thể tạo kế hoạch vì Trợ lý AI chưa sẵn sàng.")
             return {"error": "Trợ lý AI chưa sẵn sàng."}
 
@@ -42,6 +137,11 @@ class TreatmentAgent(BaseAgent):
             logger.warning(f"Không tìm thấy nông trại cho người dùng ID {farmer_id} khi tạo kế hoạch điều trị.")
             return {"error": f"Không tìm thấy nông trại cho người dùng ID {farmer_id}."}
 
+        cached_plan = self._get_cached_image_plan(image_hash, farm, model_disease_name)
+        if cached_plan:
+            logger.info(f"Ảnh {image_hash} đã có kế hoạch với dự báo hiện tại, dùng lại session {cached_plan['session_id']}.")
+            return cached_plan
+
         # --- IMPROVEMENT: Calculate days_since_planting for better context ---
         days_since_planting = "không rõ"
         if farm.planting_date:
@@ -59,50 +159,14 @@ class TreatmentAgent(BaseAgent):
             "location": {"province": farm.province}
         }
         
-        query_for_retrieval = f"""
-            Thông tin chi tiết về cách phòng và điều trị bệnh {disease_name_vn} trên lúa, 
-            bao gồm triệu chứng, thuốc đặc trị, biện pháp canh tác, và các lưu ý về dinh dưỡng
-            để giúp cây phục hồi.
-        """
-        retrieved_context = self.vector_store.retrieve(model_disease_name, query_for_retrieval, k=7)
-        
-        province = farm.province
-        hourly_forecast = self.weather_service.get_forecast(province)
-        if not hourly_forecast:
-            logger.error(f"Không thể lấy dữ liệu thời tiết cho tỉnh {province}.")
-            return {"error": f"Không thể lấy dữ liệu thời tiết cho tỉnh {province}."}
-
-        df = pd.DataFrame(hourly_forecast)
-        df['date'] = pd.to_datetime(df['date'])
-        today = pd.to_datetime(datetime.now().date())
-        end_date = today + pd.Timedelta(days=2)
+        plan_context = self._get_plan_context(farm.province, model_disease_name, disease_name_vn)
+        if "error" in plan_context:
+            return plan_context
 
-        df_3_days = df[(df['date'] >= today) & (df['date'] <= end_date)].copy()
-        df_3_days['date_str'] = df_3_days['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
-
-        if df_3_days.empty:
-            logger.error(f"Không có đủ dữ liệu thời tiết cho 3 ngày tới tại {province}.")
-            return {"error": "Không có đủ dữ liệu thời tiết cho 3 ngày tới."}
-
-        daily_groups = df_3_days.groupby(df['date'].dt.date)
-
-        scored_days = [{'date': date_val, 'score': self._score_spraying_day(g.to_dict('records')), 'data': g.to_dict('records')} for date_val, g in daily_groups]
-        
-        if not scored_days:
-            logger.error("Không thể chấm điểm các ngày dự báo thời tiết.")
-            return {"error": "Không thể chấm điểm các ngày dự báo."}
-        
-        best_day = max(scored_days, key=lambda x: x['score'])
-        hourly_detail_for_target_date = best_day['data']
-        for hour_data in hourly_detail_for_target_date:
-            if 'date' in hour_data and not isinstance(hour_data['date'], str):
-                hour_data['date'] = hour_data.get('date_str', str(hour_data['date']))
-        
-        daily_summary = self._summarize_daily_forecast(df_3_days.to_dict('records'))
-        
         prompt = self._build_treatment_prompt(
-            retrieved_context, farmer_info_for_llm, daily_summary, 
-            hourly_detail_for_target_date, str(farmer_id), disease_name_vn, iot_data=iot_data
+            plan_context["retrieved_context"], farmer_info_for_llm, plan_context["daily_summary"],
+            plan_context["hourly_detail"], str(farmer_id), disease_name_vn, iot_data=iot_data,
+            target_date=plan_context["target_date"], iot_stats=iot_stats, spray_window=plan_context["spray_window"]
         ) 
         
         new_session = self.analysis_repo.create_session(
@@ -114,8 +178,7 @@ class TreatmentAgent(BaseAgent):
         response_content = ""
         try:
             logger.info(f"Đang tạo kế hoạch điều trị cho nông hộ {farmer_id}...")
-            response = self.client.chat.completions.create(
-                model=self.model_name,
+            response = self.llm.chat_completion(
                 messages=[{"role": "user", "content": prompt}],
                 response_format={"type": "json_object"},
                 temperature=self.generation_config.get("temperature", 0.6),
@@ -128,6 +191,11 @@ class TreatmentAgent(BaseAgent):
             self.analysis_repo.commit()
             
             logger.info(f"Đã tạo và LƯU thành công kế hoạch cho session {new_session.id}.")
+            # Khóa tính theo phiên bản dự báo thực sự đã dùng (get_forecast ở trên có thể vừa làm mới cache).
+            cache_source = self._image_plan_cache_source(image_hash, farm, model_disease_name)
+            if cache_source:
+                cache_key = self._make_cache_key(self.IMAGE_PLAN_CACHE_NAMESPACE, cache_source)
+                self._store_cached_response(cache_key, self.IMAGE_PLAN_CACHE_NAMESPACE, {"session_id": new_session.id}, farm_id=farm.id)
             
             return {"session_id": new_session.id, "plan": plan}
         except (json.JSONDecodeError, ValueError) as e:
@@ -140,7 +208,10 @@ class TreatmentAgent(BaseAgent):
             return {"error": "Rất tiếc, đã có lỗi kết nối đến trợ lý AI. Vui lòng thử lại sau."}
 
     def _build_update_prompt(self, current_plan: dict, user_message: str) -> str:
-        current_plan_json = json.dumps(current_plan, ensure_ascii=False, indent=2)
+        assembler = PromptAssembler("treatment_update")
+        # Model trả lại toàn bộ kế hoạch đã cập nhật, nên kế hoạch hiện tại không được lược bớt phần nào.
+        current_plan_json = assembler.add_json("current_plan", current_plan, required=True)
+        user_message = assembler.add_text("user_message", user_message)
         
         prompt = f"""
             **Bối cảnh:**
@@ -165,49 +236,112 @@ class TreatmentAgent(BaseAgent):
             **Định dạng đầu ra:**
             Chỉ trả về đối tượng JSON của kế hoạch đã được cập nhật, giữ nguyên cấu trúc như kế hoạch ban đầu.
         """
-        return prompt
+        return assembler.finalize(prompt)
     
+    def _update_request(self, current_plan: dict, user_message: str) -> dict:
+        """Tham số gọi LLM cho một lượt cập nhật kế hoạch."""
+        logger.info(f"Đang xử lý phản hồi từ người dùng: '{user_message}'")
+        # Phần action_details_for_system chỉ lặp lại drug_info nên không gửi lại cho LLM mỗi lượt chat;
+        # nó được dựng lại từ kế hoạch đã cập nhật.
+        plan_for_prompt = {key: value for key, value in current_plan.items() if key != self.PLAN_SYSTEM_KEY}
+        prompt = self._build_update_prompt(plan_for_prompt, user_message)
+        return {
+            "messages": [{"role": "user", "content": prompt}],
+            "response_format": {"type": "json_object"},
+            "temperature": self.generation_config.get("temperature", 0.6),
+            "top_p": self.generation_config.get("top_p", 0.9),
+        }
+
+    def _parse_updated_plan(self, current_plan: dict, response_content: str) -> dict:
+        updated_plan = json.loads(response_content)
+        self._restore_system_details(current_plan, updated_plan)
+        logger.info("Đã cập nhật kế hoạch từ phản hồi của người dùng thành công.")
+        return updated_plan
+
     def update_plan_from_feedback(self, current_plan: dict, user_message: str):
         """Cập nhật kế hoạch điều trị dựa trên phản hồi của người dùng."""
-        if not self.client:
+        if not self.llm_ready:
             logger.warning("Không thể cập nhật kế hoạch vì Trợ lý AI chưa sẵn sàng.")
             return {"error": "Trợ lý AI chưa sẵn sàng."}
 
-        logger.info(f"Đang xử lý phản hồi từ người dùng: '{user_message}'")
-        prompt = self._build_update_prompt(current_plan, user_message)
-        
         try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"},
-                temperature=self.generation_config.get("temperature", 0.6),
-                top_p=self.generation_config.get("top_p", 0.9)
-            )
-            response_content = response.choices[0].message.content
-            updated_plan = json.loads(response_content)
-            logger.info("Đã cập nhật kế hoạch từ phản hồi của người dùng thành công.")
-            return updated_plan
+            response = self.llm.chat_completion(**self._update_request(current_plan, user_message))
+            return self._parse_updated_plan(current_plan, response.choices[0].message.content)
         except Exception as e:
             logger.error(f"Lỗi khi cập nhật kế hoạch từ phản hồi: {e}")
             return {"error": "Rất tiếc, đã có lỗi khi xử lý yêu cầu của bác. Vui lòng thử lại."}
+
+    def stream_plan_update(self, current_plan: dict, user_message: str):
+        """
+        Phiên bản stream của `update_plan_from_feedback`. Là generator trả về các cặp (sự kiện, dữ liệu):
+        ("token", đoạn JSON) khi LLM đang sinh, ("main_message", thông điệp) ngay khi trường
+        `main_message` được sinh xong, và sau cùng là ("done", kế hoạch đã cập nhật) hoặc ("error", {...}).
+        """
+        if not self.llm_ready:
+            logger.warning("Không thể cập nhật kế hoạch vì Trợ lý AI chưa sẵn sàng.")
+            yield "error", {"error": "Trợ lý AI chưa sẵn sàng."}
+            return
+
+        parts, main_message_sent = [], False
+        try:
+            for delta in self.llm.stream_chat_completion(**self._update_request(current_plan, user_message)):
+                parts.append(delta)
+                yield "token", delta
+                if not main_message_sent:
+                    match = MAIN_MESSAGE_PATTERN.search("".join(parts))
+                    if match:
+                        main_message_sent = True
+                        yield "main_message", json.loads(f'"{match.group(1)}"')
+            yield "done", self._parse_updated_plan(current_plan, "".join(parts))
+        except Exception as e:
+            logger.error(f"Lỗi khi stream cập nhật kế hoạch từ phản hồi: {e}")
+            yield "error", {"error": "Rất tiếc, đã có lỗi khi xử lý yêu cầu của bác. Vui lòng thử lại."}
     
+    def _restore_system_details(self, current_plan: dict, updated_plan: dict):
+        """Dựng lại action_details_for_system từ drug_info của kế hoạch đã cập nhật."""
+        system_details = current_plan.get(self.PLAN_SYSTEM_KEY)
+        if not isinstance(system_details, dict) or self.PLAN_SYSTEM_KEY in updated_plan:
+            return
+        drug_info = (updated_plan.get("treatment_plan") or {}).get("drug_info") or {}
+        updated_plan[self.PLAN_SYSTEM_KEY] = {
+            **system_details,
+            "drug_info": {
+                key: drug_info.get(key, system_details.get("drug_info", {}).get(key))
+                for key in ("sản_phẩm_tham_khảo", "liều_lượng", "cách_dùng")
+            },
+        }
+
     def _build_treatment_prompt(self, retrieved_context: str, farmer_info: dict, daily_summary: list, 
-                                hourly_detail: list, farmer_id: str, disease_name_vn: str, iot_data: dict = None) -> str:
+                                hourly_detail: list, farmer_id: str, disease_name_vn: str, iot_data: dict = None,
+                                target_date: str = None, iot_stats: dict = None, spray_window: dict = None) -> str:
         """Xây dựng prompt chuyên cho việc điều trị bệnh."""
-        farmer_json = json.dumps(farmer_info, ensure_ascii=False, indent=2)
-        summary_json = json.dumps(daily_summary, ensure_ascii=False, indent=2)
-        detail_json = json.dumps(hourly_detail, ensure_ascii=False, indent=2)
+        assembler = PromptAssembler("treatment")
+        retrieved_context = assembler.add_context("context", retrieved_context)
+        farmer_json = assembler.add_json("farmer_info", farmer_info)
+        summary_json = assembler.add_json("daily_summary", daily_summary)
+        detail_json = assembler.add_json("hourly_detail", hourly_detail)
+        target_date_str = f" (ngày {target_date})" if target_date else ""
+        if spray_window:
+            target_date_str += (f"; khung giờ khô ráo, gió nhẹ dài nhất: {spray_window['start_hour']} - {spray_window['end_hour']}"
+                                f" ({spray_window['hours']} giờ liên tiếp)")
 
         iot_data_str = ""
         if iot_data:
-            iot_json = json.dumps(iot_data, ensure_ascii=False, indent=2)
+            iot_json = assembler.add_json("iot_data", iot_data)
             iot_data_str = f"""
             6. **DỮ LIỆU CẢM BIẾN IOT (Thông tin thực tế tại ruộng):**
             ```json
             {iot_json}
             ```
             """
+        if iot_stats:
+            stats_json = assembler.add_json("iot_stats", iot_stats)
+            iot_data_str += f"""
+            7. **THỐNG KÊ CẢM BIẾN THEO CỬA SỔ 1 GIỜ / 6 GIỜ / 24 GIỜ QUA** (trung bình/thấp nhất/cao nhất; `hours_humidity_above` là số giờ độ ẩm không khí vượt từng ngưỡng %, `leaf_wetness_hours` là số giờ lá ước tính bị ướt):
+            ```json
+            {stats_json}
+            ```
+            """
 
         prompt = f"""
             **Bối cảnh:**
@@ -226,7 +360,7 @@ class TreatmentAgent(BaseAgent):
             ```json
             {summary_json}
             ```
-            5. **CHI TIẾT thời tiết theo giờ cho ngày hành động TỐT NHẤT đã được chọn sẵn:**
+            5. **CHI TIẾT thời tiết theo giờ cho ngày hành động TỐT NHẤT đã được chọn sẵn{target_date_str}:**
             ```json
             {detail_json}
             ```
@@ -316,5 +450,4 @@ class TreatmentAgent(BaseAgent):
             }}
             ```
         """
-        return prompt
-
+        return assembler.finalize(prompt)
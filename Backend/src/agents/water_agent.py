@@ -1,14 +1,58 @@
 import json
 from datetime import datetime
 from .base_agent import BaseAgent
+from src.utils.prompt_assembler import PromptAssembler
 from src.logging.logger import logger
 
+# Bước làm tròn giá trị cảm biến khi tạo khóa cache: chênh lệch nhỏ hơn một bước không đổi khuyến nghị tưới.
+IOT_CACHE_BUCKETS = {
+    "water_level": 1.0,
+    "soil_moisture": 5.0,
+    "humidity": 5.0,
+    "temperature": 1.0,
+    "soil_ph": 0.5,
+}
+
+def _bucket(value, step: float):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return round(round(value / step) * step, 2)
+
 class WaterAgent(BaseAgent):
     """
     Agent chuyên trách việc đưa ra các khuyến nghị về quản lý nước tưới.
     """
-    def create_water_management_plan(self, farmer_id: str, iot_data: dict = None):
-        if not self.client:
+    @staticmethod
+    def _normalize_iot(iot_data: dict = None, iot_stats: dict = None) -> dict:
+        """Giá trị cảm biến và thống kê theo cửa sổ đã làm tròn theo IOT_CACHE_BUCKETS, bỏ timestamp và số bản đo."""
+        readings = {field: _bucket((iot_data or {}).get(field), step) for field, step in IOT_CACHE_BUCKETS.items()}
+        windows = {}
+        for name, window in ((iot_stats or {}).get("windows") or {}).items():
+            windows[name] = {
+                field: {key: _bucket(value, step) for key, value in window[field].items()}
+                for field, step in IOT_CACHE_BUCKETS.items() if isinstance(window.get(field), dict)
+            }
+            windows[name]["hours_humidity_above"] = {
+                threshold: _bucket(hours, 1.0) for threshold, hours in (window.get("hours_humidity_above") or {}).items()
+            }
+            windows[name]["leaf_wetness_hours"] = _bucket(window.get("leaf_wetness_hours"), 1.0)
+        return {"readings": readings, "windows": windows}
+
+    def _water_plan_cache_source(self, farm, days_after_planting: int, forecast_frame, iot_data: dict = None,
+                                 iot_stats: dict = None) -> str:
+        """
+        Định danh cache tư vấn tưới từ các đầu vào đã chuẩn hóa: tỉnh, phiên bản dự báo, tuổi lúa và dữ liệu cảm biến
+        đã làm tròn. Không dùng prompt vì prompt chứa timestamp của bản đo, khiến khóa đổi ở mỗi lần đo.
+        """
+        return json.dumps({
+            "province": farm.province,
+            "forecast": forecast_frame.cache_time if forecast_frame else None,
+            "days_after_planting": days_after_planting,
+            "iot": self._normalize_iot(iot_data, iot_stats),
+        }, ensure_ascii=False, sort_keys=True)
+
+    def create_water_management_plan(self, farmer_id: str, iot_data: dict = None, iot_stats: dict = None):
+        if not self.llm_ready:
             logger.warning("WaterAgent không thể tạo tư vấn vì Trợ lý AI chưa sẵn sàng.")
             return {"error": "Trợ lý AI chưa sẵn sàng."}
 
@@ -19,43 +63,59 @@ class WaterAgent(BaseAgent):
 
         days_after_planting = (datetime.now().date() - farm.planting_date).days if farm.planting_date else -1
         
-        hourly_forecast = self.weather_service.get_forecast(farm.province)
-        daily_summary = self._summarize_daily_forecast(hourly_forecast) if hourly_forecast else []
+        forecast_frame = self.weather_service.get_forecast_frame(farm.province)
+        daily_summary = forecast_frame.daily_summary() if forecast_frame else []
+
+        cache_source = self._water_plan_cache_source(farm, days_after_planting, forecast_frame, iot_data, iot_stats)
+        cache_key, cached_plan = self._get_cached_response("water", cache_source)
+        if cached_plan is not None:
+            logger.info(f"CACHE HIT: Dùng lại tư vấn quản lý nước đã tạo cho nông hộ {farmer_id}.")
+            return {"plan": cached_plan}
 
         query_for_retrieval = f"""
             Kỹ thuật điều tiết nước tưới cho lúa ở giai đoạn {days_after_planting} ngày tuổi. 
             Phương pháp tưới ngập khô xen kẽ và cách xử lý khi thời tiết nắng nóng hoặc có mưa.
         """
         retrieved_context = self.vector_store.retrieve("water_management", query_for_retrieval, k=3)
+        prompt = self._build_water_prompt(retrieved_context, days_after_planting, daily_summary, iot_data, iot_stats)
 
-        prompt = self._build_water_prompt(retrieved_context, days_after_planting, daily_summary, iot_data)
-        
         try:
             logger.info(f"Đang tạo tư vấn quản lý nước cho nông hộ {farmer_id}...")
-            response = self.client.chat.completions.create(
-                model=self.model_name,
+            response = self.llm.chat_completion(
                 messages=[{"role": "user", "content": prompt}],
                 response_format={"type": "json_object"},
                 temperature=self.generation_config.get("temperature", 0.7)
             )
             plan = json.loads(response.choices[0].message.content)
+            self._store_cached_response(cache_key, "water", plan, farm_id=farm.id)
             logger.info(f"Đã tạo thành công tư vấn quản lý nước cho nông hộ {farmer_id}.")
             return {"plan": plan}
         except Exception as e:
             logger.error(f"Lỗi khi tạo tư vấn quản lý nước cho nông hộ {farmer_id}: {e}")
             return {"error": "Rất tiếc, đã có lỗi khi tạo tư vấn quản lý nước."}
 
-    def _build_water_prompt(self, retrieved_context: str, days_after_planting: int, daily_summary: list, iot_data: dict = None) -> str:
-        summary_json = json.dumps(daily_summary, ensure_ascii=False, indent=2)
+    def _build_water_prompt(self, retrieved_context: str, days_after_planting: int, daily_summary: list, iot_data: dict = None,
+                           iot_stats: dict = None) -> str:
+        assembler = PromptAssembler("water")
+        retrieved_context = assembler.add_context("context", retrieved_context)
+        summary_json = assembler.add_json("daily_summary", daily_summary)
         iot_data_str = ""
         if iot_data:
-            iot_json = json.dumps(iot_data, ensure_ascii=False, indent=2)
+            iot_json = assembler.add_json("iot_data", iot_data)
             iot_data_str = f"""
             4. **DỮ LIỆU CẢM BIẾN IOT (Thông tin thực tế tại ruộng):**
             ```json
             {iot_json}
             ```
             """
+        if iot_stats:
+            stats_json = assembler.add_json("iot_stats", iot_stats)
+            iot_data_str += f"""
+            5. **THỐNG KÊ CẢM BIẾN THEO CỬA SỔ 1 GIỜ / 6 GIỜ / 24 GIỜ QUA** (trung bình/thấp nhất/cao nhất, dùng để thấy xu hướng mực nước và độ ẩm đất):
+            ```json
+            {stats_json}
+            ```
+            """
 
         prompt = f"""
             **Bối cảnh:**
@@ -97,4 +157,4 @@ class WaterAgent(BaseAgent):
             }}
             ```
         """
-        return prompt
+        return assembler.finalize(prompt)
@@ -1,4 +1,4 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, current_app
 from src.repository.admin_user_repository import AdminUserRepository
 from src.repository.admin_farm_repository import AdminFarmRepository
 from src.repository.admin_analysis_repository import AdminAnalysisRepository
@@ -18,6 +18,23 @@ def get_stats():
         "totalSessions": AnalysisSession.query.count()
     })
 
+@admin_bp.route("/performance", methods=["GET"])
+def get_performance_stats():
+    """Số liệu vận hành của các thành phần có cache / định tuyến cục bộ."""
+    return jsonify({
+        "queryEmbeddingCache": current_app.vector_store.get_query_cache_stats(),
+        "llmResponseCache": current_app.llm_cache.get_stats(),
+        "llmGateway": current_app.llm_gateway.get_stats(),
+        "intentRouter": current_app.qa_agent.intent_router.get_stats(),
+        "imageInference": {**current_app.image_agent.engine.get_stats(), "backend": current_app.image_agent.predictor.backend},
+        "imageHashIndex": current_app.image_hash_index.get_stats(),
+        "monitoringScheduler": current_app.monitoring_scheduler.get_stats(),
+        "treatmentPlanContext": current_app.treatment_agent.get_plan_context_stats(),
+        "weather": current_app.weather_service.get_stats(),
+        "weatherPrefetch": current_app.weather_prefetcher.get_stats(),
+        "iotStore": current_app.iot_service.get_stats(),
+    })
+
 @admin_bp.route("/users", methods=["GET"])
 def get_users():
     users = user_repo.get_all_users()
@@ -92,6 +109,7 @@ def get_farms():
 def delete_farm(farm_id):
     success = farm_repo.delete_farm(farm_id)
     if success:
+        current_app.llm_cache.invalidate_farm(farm_id)
         return jsonify({"success": True})
     return jsonify({"success": False, "error": "Farm not found"}), 404
     
@@ -108,6 +126,7 @@ def update_farm(farm_id):
     farm.rice_variety = data.get("rice_variety", farm.rice_variety)
 
     farm_repo.commit()
+    current_app.llm_cache.invalidate_farm(farm_id)
     return jsonify({"success": True, "message": "Farm updated successfully"})
 
 @admin_bp.route("/sessions", methods=["GET"])
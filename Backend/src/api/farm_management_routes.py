@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify, current_app
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
+from .streaming import sse_event, sse_response
 
 farm_management_bp = Blueprint('farm_management_api', __name__)
 
@@ -30,8 +31,9 @@ def get_water_plan():
         return jsonify({"error": "Không tìm thấy nông trại để lấy dữ liệu IoT."}), 404
     
     iot_data = iot_service.get_latest_data(farm.id)
+    iot_stats = iot_service.get_aggregates(farm.id)
     
-    result = water_agent.create_water_management_plan(farmer_id=current_user_id, iot_data=iot_data)
+    result = water_agent.create_water_management_plan(farmer_id=current_user_id, iot_data=iot_data, iot_stats=iot_stats)
 
     if "error" in result:
         return jsonify(result), 500
@@ -65,6 +67,48 @@ def get_iot_data():
     
     return jsonify(iot_data)
 
+@farm_management_bp.route('/iot-data/batch', methods=['POST'])
+@jwt_required()
+def save_iot_data_batch():
+    """
+    Nhận một lô bản đo cảm biến (của một hoặc nhiều nông trại) từ gateway và lưu trong một lần ghi.
+    Body: {"readings": [{"farm_id", "timestamp", "temperature", ...}, ...]} hoặc trực tiếp một danh sách.
+    Tài khoản admin được ghi cho mọi nông trại; nông dân chỉ ghi được cho nông trại của mình.
+    """
+    data = request.get_json(silent=True)
+    readings = data.get("readings") if isinstance(data, dict) else data
+    if not isinstance(readings, list) or not readings:
+        return jsonify({"error": "Dữ liệu gửi lên phải là danh sách bản đo 'readings' không rỗng."}), 400
+
+    allowed_farm_ids = None
+    if get_jwt().get("role") != "admin":
+        user = current_app.user_repo.get_user_with_farm(int(get_jwt_identity()))
+        allowed_farm_ids = {farm.id for farm in user.farms} if user else set()
+
+    result = current_app.iot_service.save_many(readings, allowed_farm_ids=allowed_farm_ids)
+    if result["saved"] == 0 and result["errors"]:
+        return jsonify(result), 400
+    return jsonify(result), 207 if result["errors"] else 201
+
+def _get_farmer_context(current_user_id):
+    """Lấy nông trại và thông tin nông hộ dùng cho hỏi đáp. Trả về (None, None) nếu không tìm thấy."""
+    user = current_app.user_repo.get_user_with_farm(int(current_user_id))
+    if not user or not user.farms.first():
+        return None, None
+    
+    farm = user.farms.first() 
+    farmer_info = {
+        "farmer_id": user.id, "full_name": user.full_name, "farm_name": farm.name,
+        "province": farm.province, "area_ha": farm.area_ha,
+        "planting_date": farm.planting_date.strftime('%Y-%m-%d') if farm.planting_date else None,
+        "soil_ph": getattr(farm, 'soil_ph', None)
+    }
+    return farm, farmer_info
+
+def _save_qa_answer(farm_id, question, answer):
+    qa_session = current_app.analysis_repo.get_or_create_qa_session(farm_id)
+    if qa_session:
+        current_app.analysis_repo.save_qa_message(qa_session.id, question, answer)
 
 @farm_management_bp.route('/ask', methods=['POST'])
 @jwt_required()
@@ -78,25 +122,41 @@ def ask_question():
     if not question:
         return jsonify({"error": "Request thiếu 'question'"}), 400
     
-    user = current_app.user_repo.get_user_with_farm(int(current_user_id))
-    if not user or not user.farms.first():
+    farm, farmer_info = _get_farmer_context(current_user_id)
+    if not farm:
         return jsonify({"error": "Không tìm thấy thông tin nông trại."}), 404
-    
-    farm = user.farms.first() 
-    farmer_info = {
-        "farmer_id": user.id, "full_name": user.full_name, "farm_name": farm.name,
-        "province": farm.province, "area_ha": farm.area_ha,
-        "planting_date": farm.planting_date.strftime('%Y-%m-%d') if farm.planting_date else None,
-        "soil_ph": getattr(farm, 'soil_ph', None)
-    }
 
     answer_obj = qa_agent.answer_question(farmer_info, question)
-    
-    qa_session = current_app.analysis_repo.get_or_create_qa_session(farm.id)
-    if qa_session:
-        current_app.analysis_repo.save_qa_message(
-            qa_session.id, question, answer_obj.get('answer', '')
-        )
+    _save_qa_answer(farm.id, question, answer_obj.get('answer', ''))
     
     return jsonify(answer_obj)
 
+@farm_management_bp.route('/ask/stream', methods=['POST'])
+@jwt_required()
+def ask_question_stream():
+    """
+    Hỏi đáp dạng Server-Sent Events: các sự kiện `token` chứa từng đoạn câu trả lời,
+    sau cùng là sự kiện `done` ({"answer", "history"}) hoặc `error`.
+    """
+    qa_agent = current_app.qa_agent
+    current_user_id = get_jwt_identity()
+    data = request.get_json()
+    
+    question = data.get('question')
+    if not question:
+        return jsonify({"error": "Request thiếu 'question'"}), 400
+    
+    farm, farmer_info = _get_farmer_context(current_user_id)
+    if not farm:
+        return jsonify({"error": "Không tìm thấy thông tin nông trại."}), 404
+
+    farm_id = farm.id
+
+    def events():
+        for event, payload in qa_agent.stream_answer(farmer_info, question):
+            if event == "done":
+                _save_qa_answer(farm_id, question, payload.get('answer', ''))
+            yield sse_event(event, payload)
+
+    return sse_response(events())
+
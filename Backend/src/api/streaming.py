@@ -0,0 +1,17 @@
+import json
+from flask import Response, stream_with_context
+
+def sse_event(event: str, data) -> str:
+    """Định dạng một sự kiện Server-Sent Events; dữ liệu luôn được gửi dưới dạng JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events) -> Response:
+    """
+    Trả về response text/event-stream từ một generator các chuỗi sự kiện.
+    Tắt cache và buffer của proxy để từng token tới client ngay khi được sinh ra.
+    """
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
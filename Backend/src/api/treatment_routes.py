@@ -3,6 +3,7 @@ import json
 from datetime import datetime
 from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from .streaming import sse_event, sse_response
 
 # from src.tasks import execute_spraying_task
 # from src.logging.logger import logger
@@ -61,6 +62,39 @@ def handle_chat_message():
     return jsonify({"conversation_id": session_id, "plan": updated_plan})
 
 
+@treatment_bp.route('/chat/stream', methods=['POST'])
+@jwt_required()
+def handle_chat_message_stream():
+    """
+    Chat điều chỉnh kế hoạch dạng Server-Sent Events: các sự kiện `token` chứa từng đoạn JSON đang được sinh,
+    `main_message` gửi thông điệp chính ngay khi có, sau cùng là `done` ({"conversation_id", "plan"}) hoặc `error`.
+    """
+    pending_plans = current_app.pending_plans
+    treatment_agent = current_app.treatment_agent 
+    analysis_repo = current_app.analysis_repo
+    data = request.get_json()
+    
+    session_id = data.get('conversation_id')
+    user_message = data.get('message')
+    
+    if not session_id or not user_message:
+        return jsonify({"error": "Request thiếu conversation_id hoặc message"}), 400
+
+    current_plan = pending_plans.get(str(session_id))
+    if not current_plan:
+        return jsonify({"error": "Phiên làm việc đã hết hạn hoặc không tồn tại."}), 404
+
+    def events():
+        for event, payload in treatment_agent.stream_plan_update(current_plan, user_message):
+            if event == "done":
+                pending_plans[str(session_id)] = payload
+                analysis_repo.save_chat_interaction(session_id, user_message, payload)
+                payload = {"conversation_id": session_id, "plan": payload}
+            yield sse_event(event, payload)
+
+    return sse_response(events())
+
+
 @treatment_bp.route('/execute', methods=['POST'])
 @jwt_required()
 def execute_plan():
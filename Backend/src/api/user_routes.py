@@ -2,7 +2,6 @@ from flask import request
 from flask import Blueprint, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from src.entity.models import User
-from ..tasks import scheduled_monitoring_task 
 import json
 
 user_bp = Blueprint('user_api', __name__)
@@ -45,23 +44,18 @@ def handle_settings():
     if "error" in result:
         return jsonify(result), 500
 
-    scheduler = current_app.scheduler
-    job_id = f'monitoring_job_for_user_{current_user_id}'
+    if data.get('farm_info'):
+        user = current_app.user_repo.get_user_with_farm(int(current_user_id))
+        if user and user.farms.first():
+            current_app.llm_cache.invalidate_farm(user.farms.first().id)
 
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
-        print(f"Đã xóa job giám sát cũ '{job_id}' để cập nhật.")
+    monitoring_scheduler = current_app.monitoring_scheduler
+    monitoring_scheduler.remove_user(current_user_id)
 
     if settings_data.get('enabled'):
         new_interval = settings_data.get('interval', 24)
-        scheduler.add_job(
-            id=job_id,
-            func=scheduled_monitoring_task,
-            args=[current_app._get_current_object(), current_user_id],
-            trigger='interval',
-            hours=new_interval
-        )
-        print(f"Đã lên lịch lại job '{job_id}' với tần suất {new_interval} giờ.")
+        monitoring_scheduler.schedule_user(current_user_id, new_interval)
+        print(f"Đã lên lịch lại giám sát cho user {current_user_id} với tần suất {new_interval} giờ.")
     else:
         print(f"Người dùng {current_user_id} đã tắt giám sát. Không tạo job mới.")
         
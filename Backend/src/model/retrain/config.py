@@ -11,4 +11,9 @@ BATCH_SIZE = 64
 SEED = 42
 AUTOTUNE = tf.data.AUTOTUNE
 LEARNING_RATE = 1e-4
-EPOCHS = 50 
\ No newline at end of file
+EPOCHS = 50
+
+# Export model sang TFLite sau khi retrain: "dynamic" (lượng tử hóa trọng số) hoặc "int8" (toàn bộ số nguyên).
+EXPORT_QUANTIZATION = "dynamic"
+EXPORT_REPRESENTATIVE_SAMPLES = 200
+EXPORT_MAX_ACCURACY_DROP = 0.01
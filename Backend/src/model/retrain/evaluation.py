@@ -3,7 +3,8 @@ from tensorflow.keras.applications.efficientnet import preprocess_input as effic
 from src.model.retrain.config import SEED, IMAGE_SIZE, BATCH_SIZE, AUTOTUNE
 from src.logging.logger import logger 
 
-def evaluate_model(model_path: str, test_dir: str):
+def load_test_dataset(test_dir: str):
+    """Tập test đã tiền xử lý, dùng chung cho đánh giá model Keras và kiểm tra bản export."""
     test_ds = tf.keras.utils.image_dataset_from_directory(
         test_dir, seed=SEED,
         image_size=IMAGE_SIZE, batch_size=BATCH_SIZE
@@ -14,7 +15,10 @@ def evaluate_model(model_path: str, test_dir: str):
         return image, label
 
     test_ds = test_ds.map(preprocess)
-    test_ds = test_ds.cache().prefetch(buffer_size=AUTOTUNE)
+    return test_ds.cache().prefetch(buffer_size=AUTOTUNE)
+
+def evaluate_model(model_path: str, test_dir: str):
+    test_ds = load_test_dataset(test_dir)
 
     model = tf.keras.models.load_model(model_path)
     loss, acc = model.evaluate(test_ds)
@@ -0,0 +1,123 @@
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications.efficientnet import preprocess_input as efficientnet_preprocess
+from src.model.retrain.config import (
+    SEED, IMAGE_SIZE, EXPORT_QUANTIZATION, EXPORT_REPRESENTATIVE_SAMPLES, EXPORT_MAX_ACCURACY_DROP
+)
+from src.model.retrain.evaluation import load_test_dataset, evaluate_model
+from src.model.retrain.preprocess import get_latest_dataset_path
+from src.logging.logger import logger
+
+def get_tflite_path(model_path: str) -> str:
+    """Bản TFLite của một phiên bản model nằm cạnh file .keras, cùng tên (efficientnet_model_vN.tflite)."""
+    return os.path.splitext(model_path)[0] + ".tflite"
+
+def _representative_dataset(data_dir: str, num_samples: int):
+    """Ảnh mẫu để hiệu chỉnh dải giá trị khi lượng tử hóa int8."""
+    dataset = tf.keras.utils.image_dataset_from_directory(
+        data_dir, seed=SEED, image_size=IMAGE_SIZE, batch_size=1, shuffle=True
+    ).take(num_samples)
+
+    def generator():
+        for image, _ in dataset:
+            yield [tf.cast(efficientnet_preprocess(image), tf.float32)]
+    return generator
+
+def convert_to_tflite(model_path: str, quantization: str = EXPORT_QUANTIZATION, representative_dir: str = None) -> bytes:
+    """
+    Chuyển model Keras sang TFLite.
+    - "dynamic": lượng tử hóa trọng số 8-bit, tính toán float (không cần dữ liệu hiệu chỉnh).
+    - "int8": lượng tử hóa toàn bộ trọng số và activation, vào/ra vẫn là float32 để runtime không đổi.
+    """
+    model = tf.keras.models.load_model(model_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == "int8":
+        if not representative_dir:
+            raise ValueError("Lượng tử hóa int8 cần thư mục ảnh mẫu (representative_dir).")
+        converter.representative_dataset = _representative_dataset(representative_dir, EXPORT_REPRESENTATIVE_SAMPLES)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != "dynamic":
+        raise ValueError(f"Kiểu lượng tử hóa không được hỗ trợ: '{quantization}'.")
+
+    return converter.convert()
+
+def evaluate_tflite(tflite_model: bytes, test_dir: str) -> float:
+    """Độ chính xác của model TFLite trên cùng tập test mà `evaluate_model` sử dụng."""
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    correct, total, current_batch = 0, 0, None
+    for images, labels in load_test_dataset(test_dir):
+        images = images.numpy().astype(np.float32)
+        if current_batch != images.shape[0]:
+            interpreter.resize_tensor_input(input_details["index"], images.shape)
+            interpreter.allocate_tensors()
+            current_batch = images.shape[0]
+        interpreter.set_tensor(input_details["index"], images)
+        interpreter.invoke()
+        predictions = interpreter.get_tensor(output_details["index"])
+        correct += int(np.sum(np.argmax(predictions, axis=1) == labels.numpy()))
+        total += len(labels)
+
+    return correct / total if total else 0.0
+
+def export_model(model_path: str, test_dir: str, reference_accuracy: float, representative_dir: str = None,
+                 quantization: str = EXPORT_QUANTIZATION, max_accuracy_drop: float = EXPORT_MAX_ACCURACY_DROP):
+    """
+    Export model sang TFLite đã lượng tử hóa và kiểm tra tương đương độ chính xác với model Keras.
+    Chỉ ghi file .tflite khi độ chính xác giảm không quá `max_accuracy_drop`; nếu không,
+    bản TFLite cũ (nếu có) bị xóa để agent tiếp tục dùng model Keras.
+    """
+    tflite_path = get_tflite_path(model_path)
+    try:
+        tflite_model = convert_to_tflite(model_path, quantization, representative_dir)
+        tflite_accuracy = evaluate_tflite(tflite_model, test_dir)
+    except Exception as e:
+        logger.error(f"Lỗi khi export model sang TFLite: {e}")
+        return None
+
+    accuracy_drop = reference_accuracy - tflite_accuracy
+    logger.info(
+        f"Kiểm tra tương đương TFLite ({quantization}): Keras={reference_accuracy:.4f}, "
+        f"TFLite={tflite_accuracy:.4f}, chênh lệch={accuracy_drop:.4f}, kích thước={len(tflite_model) / 1e6:.1f}MB"
+    )
+    if accuracy_drop > max_accuracy_drop:
+        logger.warning(f"Bản TFLite giảm độ chính xác quá ngưỡng {max_accuracy_drop:.4f}. Không dùng bản export này.")
+        if os.path.exists(tflite_path):
+            os.remove(tflite_path)
+        return None
+
+    with open(tflite_path, "wb") as f:
+        f.write(tflite_model)
+    logger.info(f"Đã lưu model TFLite tại: {tflite_path}")
+    return tflite_path
+
+def export_existing_model(model_path: str, dataset_path: str = None, quantization: str = EXPORT_QUANTIZATION):
+    """
+    Export một model .keras đã có (không retrain), ví dụ model đang chạy chưa có bản .tflite.
+    Độ chính xác tham chiếu được đo lại trên tập test của `dataset_path` (mặc định: snapshot dữ liệu mới nhất).
+    """
+    dataset_path = dataset_path or get_latest_dataset_path()
+    if not dataset_path:
+        logger.error("Không tìm thấy snapshot dữ liệu để kiểm tra tương đương độ chính xác. Không export.")
+        return None
+    test_dir = os.path.join(dataset_path, "test")
+    _, accuracy = evaluate_model(model_path, test_dir)
+    return export_model(model_path, test_dir, reference_accuracy=accuracy,
+                        representative_dir=os.path.join(dataset_path, "train"), quantization=quantization)
+
+if __name__ == "__main__":
+    # python -m src.model.retrain.export [--model đường_dẫn.keras] [--dataset thư_mục_snapshot] [--quantization int8]
+    from src.utils.config import CONFIG
+
+    parser = argparse.ArgumentParser(description="Export model nhận diện ảnh sang TFLite (kèm kiểm tra tương đương).")
+    parser.add_argument("--model", default=CONFIG.MODEL_PATH, help="File .keras cần export (mặc định: phiên bản mới nhất).")
+    parser.add_argument("--dataset", default=None, help="Thư mục snapshot có train/ và test/ (mặc định: snapshot mới nhất).")
+    parser.add_argument("--quantization", default=EXPORT_QUANTIZATION, choices=("dynamic", "int8"))
+    args = parser.parse_args()
+    raise SystemExit(0 if export_existing_model(args.model, args.dataset, args.quantization) else 1)
@@ -4,6 +4,7 @@ from src.model.retrain.config import MODEL_VERSIONS_DIR
 from src.model.retrain.preprocess import create_new_dataset_snapshot
 from src.model.retrain.training import train_model
 from src.model.retrain.evaluation import evaluate_model
+from src.model.retrain.export import export_model
 from src.logging.logger import logger
 
 def retrain_run():
@@ -13,10 +14,11 @@ def retrain_run():
     2. Huấn luyện lại từ model mới nhất.
     3. Lưu model mới.
     4. Đánh giá model mới trên tập test.
+    5. Export bản TFLite lượng tử hóa (kèm kiểm tra tương đương độ chính xác).
     """
     logger.info(f"--- BẮT ĐẦU QUY TRÌNH RETRAIN VÀO {datetime.datetime.now()} ---")
     
-    logger.info("[BƯỚC 1/4] Chuẩn bị dữ liệu...")
+    logger.info("[BƯỚC 1/5] Chuẩn bị dữ liệu...")
     new_dataset_path = create_new_dataset_snapshot()
     if new_dataset_path is None:
         logger.error("Dừng quy trình do lỗi chuẩn bị dữ liệu.")
@@ -34,7 +36,7 @@ def retrain_run():
     latest_model_name = sorted(all_models, key=lambda m: int(m.split('_v')[-1].split('.')[0]))[-1]
     base_model_path = os.path.join(MODEL_VERSIONS_DIR, latest_model_name)
     
-    logger.info(f"[BƯỚC 2/4] Bắt đầu huấn luyện model từ base model: {base_model_path}...")
+    logger.info(f"[BƯỚC 2/5] Bắt đầu huấn luyện model từ base model: {base_model_path}...")
     train_dir = os.path.join(new_dataset_path, "train")
     new_model, history = train_model(train_dir, base_model_path)
 
@@ -46,11 +48,14 @@ def retrain_run():
     new_model_name = f"efficientnet_model_v{current_version_num + 1}.keras"
     new_model_path = os.path.join(MODEL_VERSIONS_DIR, new_model_name)
     
-    logger.info(f"[BƯỚC 3/4] Huấn luyện hoàn tất. Lưu model mới tại: {new_model_path}")
+    logger.info(f"[BƯỚC 3/5] Huấn luyện hoàn tất. Lưu model mới tại: {new_model_path}")
     new_model.save(new_model_path)
 
-    logger.info(f"[BƯỚC 4/4] Đánh giá model mới trên test set...")
+    logger.info(f"[BƯỚC 4/5] Đánh giá model mới trên test set...")
     test_dir = os.path.join(new_dataset_path, "test")
-    evaluate_model(new_model_path, test_dir)
+    _, accuracy = evaluate_model(new_model_path, test_dir)
+
+    logger.info(f"[BƯỚC 5/5] Export model sang TFLite cho suy luận CPU...")
+    export_model(new_model_path, test_dir, reference_accuracy=accuracy, representative_dir=train_dir)
 
     logger.info(f"--- KẾT THÚC QUY TRÌNH RETRAIN ---")
@@ -10,6 +10,13 @@ class UserRepository(BaseRepository):
     def get_user_with_farm(self, user_id: int):
         return self.get_by_id(user_id) 
 
+    def get_monitored_provinces(self) -> list:
+        """Danh sách tỉnh (không trùng) của các nông trại có người dùng đang bật giám sát."""
+        rows = db.session.query(Farm.province).distinct()\
+            .join(UserSettings, UserSettings.user_id == Farm.user_id)\
+            .filter(UserSettings.notification_enabled == True).all()
+        return [province for (province,) in rows if province]
+
     def get_settings_by_user_id(self, user_id: int):
         settings = UserSettings.query.filter_by(user_id=user_id).first()
         if not settings:
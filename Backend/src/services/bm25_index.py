@@ -0,0 +1,68 @@
+import re
+import math
+import heapq
+import unicodedata
+from collections import Counter
+from operator import itemgetter
+
+class BM25Index:
+    """
+    Chỉ mục đảo ngược BM25 cho văn bản tiếng Việt.
+    Tiếng Việt viết tách theo âm tiết nên mỗi văn bản được đánh chỉ mục theo từng âm tiết
+    và theo cặp âm tiết liền kề (xấp xỉ từ ghép như "đạo_ôn", "cháy_bìa").
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = {}
+        self.idf = {}
+        self.avg_doc_length = 0.0
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        """Tách văn bản thành âm tiết (chữ thường, chuẩn NFC) và các cặp âm tiết liền kề."""
+        syllables = re.findall(r"\w+", unicodedata.normalize("NFC", text).lower())
+        return syllables + [f"{first}_{second}" for first, second in zip(syllables, syllables[1:])]
+
+    def build(self, documents: dict):
+        """Xây dựng chỉ mục từ dict {doc_id: nội dung}."""
+        postings = {}
+        doc_lengths = {}
+        for doc_id, text in documents.items():
+            term_counts = Counter(self.tokenize(text))
+            doc_lengths[doc_id] = sum(term_counts.values())
+            for term, term_frequency in term_counts.items():
+                postings.setdefault(term, {})[doc_id] = term_frequency
+
+        num_docs = len(doc_lengths)
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+        self.avg_doc_length = sum(doc_lengths.values()) / num_docs if num_docs else 0.0
+        self.idf = {
+            term: math.log(1 + (num_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for term, posting in postings.items()
+        }
+        return self
+
+    def search(self, query: str, k: int, allowed_ids=None) -> list:
+        """
+        Trả về tối đa k cặp (doc_id, điểm BM25) theo thứ tự giảm dần.
+        `allowed_ids` (set) giới hạn kết quả trong một tập tài liệu (lọc metadata / kho).
+        """
+        if not self.doc_lengths:
+            return []
+
+        scores = {}
+        for term in set(self.tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf[term]
+            for doc_id, term_frequency in posting.items():
+                if allowed_ids is not None and doc_id not in allowed_ids:
+                    continue
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * term_frequency * (self.k1 + 1) / (term_frequency + self.k1 * length_norm)
+
+        return heapq.nlargest(k, scores.items(), key=itemgetter(1))
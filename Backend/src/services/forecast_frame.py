@@ -0,0 +1,173 @@
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+
+# Ngưỡng chấm điểm ngày/khung giờ phun thuốc: giờ có xác suất mưa > 30% hoặc gió > 15 km/h bị trừ điểm.
+SPRAY_MAX_RAIN_CHANCE = 30
+SPRAY_MAX_WIND_KMH = 15
+NUMERIC_COLUMNS = ("temperature", "humidity", "wind_kmh", "rain_chance")
+# Giá trị thay thế khi thiếu dữ liệu, giống cách chấm điểm cũ: thiếu mưa/gió coi như không phù hợp để phun.
+MISSING_RAIN_CHANCE = 100.0
+MISSING_WIND_KMH = 99.0
+
+def _column(records: list, name: str) -> np.ndarray:
+    values = [record.get(name) for record in records]
+    array = np.array([value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+                      for value in values], dtype=np.float64)
+    array.flags.writeable = False
+    return array
+
+def _max_run_lengths(mask: np.ndarray, starts: np.ndarray) -> tuple:
+    """
+    Độ dài chuỗi True liên tiếp tại mỗi vị trí (reset ở đầu mỗi nhóm), và độ dài chuỗi dài nhất của từng nhóm.
+    """
+    n = len(mask)
+    index = np.arange(n)
+    breaks = np.where(mask, -1, index)
+    breaks[starts] = np.maximum(breaks[starts], starts - 1)
+    run_lengths = index - np.maximum.accumulate(breaks)
+    return run_lengths, np.maximum.reduceat(run_lengths, starts)
+
+class ForecastFrame:
+    """
+    Dự báo theo giờ dạng cột (NumPy), được phân tích MỘT lần từ danh sách bản ghi của WeatherService.
+    Tóm tắt theo ngày, điểm phun thuốc của từng ngày và khung giờ phun tốt nhất đều tính bằng phép toán
+    vector trên các nhóm ngày liên tiếp (reduceat), không tạo DataFrame hay duyệt từng giờ bằng Python.
+    Đối tượng không đổi sau khi tạo (mảng chỉ đọc, tóm tắt theo ngày tính sẵn) nên WeatherService giữ một
+    frame cho mỗi (tỉnh, cache_time) và mọi agent/luồng dùng chung, không phân tích lại dữ liệu.
+    """
+    def __init__(self, hourly_forecast: list, province: str = None, cache_time: str = None):
+        self.province = province
+        self.cache_time = cache_time
+        records = [record for record in (hourly_forecast or []) if record.get("date")]
+        order = np.argsort(np.array([record["date"][:10] for record in records], dtype="datetime64[D]"), kind="stable")
+        self.records = tuple(records[i] for i in order)
+        self.dates = np.array([record["date"][:10] for record in self.records], dtype="datetime64[D]")
+        self.dates.flags.writeable = False
+        self.columns = {name: _column(self.records, name) for name in NUMERIC_COLUMNS}
+        # Cột chỉ gồm số nguyên thì tóm tắt giữ kiểu int, giống kết quả groupby của pandas trước đây.
+        self._integral = {name: all(isinstance(record.get(name), int) for record in self.records) for name in NUMERIC_COLUMNS}
+        self._daily_summary = tuple(self._compute_daily_summary())
+        self._views = {}
+        self._views_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def empty(self) -> bool:
+        return not self.records
+
+    def between(self, start_date: date, end_date: date) -> "ForecastFrame":
+        """Các giờ có ngày trong [start_date, end_date]."""
+        mask = (self.dates >= np.datetime64(start_date, "D")) & (self.dates <= np.datetime64(end_date, "D"))
+        return ForecastFrame([self.records[i] for i in np.flatnonzero(mask)], province=self.province, cache_time=self.cache_time)
+
+    def next_days(self, start_date: date, days: int = 3) -> "ForecastFrame":
+        """`days` ngày kể từ `start_date`; kết quả được ghi nhớ vì mọi nông hộ trong tỉnh dùng cùng khoảng ngày."""
+        key = (start_date, days)
+        with self._views_lock:
+            view = self._views.get(key)
+        if view is None:
+            view = self.between(start_date, start_date + timedelta(days=days - 1))
+            with self._views_lock:
+                view = self._views.setdefault(key, view)
+                # Chỉ giữ các khoảng ngày gần đây (mỗi ngày một view).
+                while len(self._views) > 4:
+                    del self._views[next(iter(self._views))]
+        return view
+
+    def _groups(self):
+        """Vị trí bắt đầu của từng ngày (dữ liệu đã được sắp theo ngày) và ngày tương ứng."""
+        starts = np.flatnonzero(np.r_[True, self.dates[1:] != self.dates[:-1]])
+        return starts, self.dates[starts]
+
+    def _scalar(self, name: str, value):
+        if np.isnan(value):
+            return None
+        return int(value) if self._integral[name] else float(value)
+
+    def daily_summary(self) -> list:
+        """Tóm tắt theo ngày: nhiệt độ thấp/cao nhất, độ ẩm trung bình, xác suất mưa và gió lớn nhất."""
+        return [dict(row) for row in self._daily_summary]
+
+    def _compute_daily_summary(self) -> list:
+        if self.empty:
+            return []
+        starts, days = self._groups()
+        humidity = self.columns["humidity"]
+        valid_humidity = ~np.isnan(humidity)
+        humidity_sum = np.add.reduceat(np.where(valid_humidity, humidity, 0.0), starts)
+        humidity_count = np.add.reduceat(valid_humidity.astype(np.int64), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg_humidity = np.round(humidity_sum / humidity_count)
+        min_temp = np.fmin.reduceat(self.columns["temperature"], starts)
+        max_temp = np.fmax.reduceat(self.columns["temperature"], starts)
+        max_rain_chance = np.fmax.reduceat(self.columns["rain_chance"], starts)
+        max_wind_kmh = np.fmax.reduceat(self.columns["wind_kmh"], starts)
+        return [
+            {
+                "date": str(day),
+                "min_temp": self._scalar("temperature", min_temp[i]),
+                "max_temp": self._scalar("temperature", max_temp[i]),
+                "avg_humidity": None if np.isnan(avg_humidity[i]) else int(avg_humidity[i]),
+                "max_rain_chance": self._scalar("rain_chance", max_rain_chance[i]),
+                "max_wind_kmh": self._scalar("wind_kmh", max_wind_kmh[i]),
+            }
+            for i, day in enumerate(days)
+        ]
+
+    def _spray_masks(self) -> tuple:
+        rain_chance = np.nan_to_num(self.columns["rain_chance"], nan=MISSING_RAIN_CHANCE)
+        wind_kmh = np.nan_to_num(self.columns["wind_kmh"], nan=MISSING_WIND_KMH)
+        return rain_chance <= SPRAY_MAX_RAIN_CHANCE, wind_kmh <= SPRAY_MAX_WIND_KMH
+
+    def spray_scores(self) -> list:
+        """
+        Điểm phù hợp phun thuốc của từng ngày: 100, trừ 10 cho mỗi giờ có khả năng mưa, trừ 2 cho mỗi giờ gió mạnh,
+        cộng 5 cho mỗi giờ của chuỗi giờ khô ráo dài nhất trong ngày.
+        """
+        if self.empty:
+            return []
+        starts, days = self._groups()
+        dry, calm = self._spray_masks()
+        _, longest_dry = _max_run_lengths(dry, starts)
+        rainy_hours = np.add.reduceat((~dry).astype(np.int64), starts)
+        windy_hours = np.add.reduceat((~calm).astype(np.int64), starts)
+        scores = 100.0 - 10 * rainy_hours - 2 * windy_hours + 5 * longest_dry
+        return [{"date": str(day), "score": float(score)} for day, score in zip(days, scores)]
+
+    def best_spray_day(self) -> dict:
+        """Ngày có điểm phun thuốc cao nhất (ngày sớm hơn nếu bằng điểm), kèm các bản ghi theo giờ của ngày đó."""
+        scores = self.spray_scores()
+        if not scores:
+            return None
+        best = max(scores, key=lambda day: day["score"])
+        hours = [record for record, day in zip(self.records, self.dates) if str(day) == best["date"]]
+        return {**best, "hours": hours}
+
+    def best_spray_window(self, target_date: str = None) -> dict:
+        """
+        Chuỗi giờ liên tiếp dài nhất vừa khô ráo vừa gió nhẹ (trong ngày `target_date` nếu có).
+
+        Returns:
+            dict | None: {"date", "start_hour", "end_hour", "hours"}, hoặc None nếu không có giờ nào phù hợp.
+        """
+        if self.empty:
+            return None
+        starts, _ = self._groups()
+        dry, calm = self._spray_masks()
+        run_lengths, _ = _max_run_lengths(dry & calm, starts)
+        if target_date is not None:
+            run_lengths = np.where(self.dates == np.datetime64(target_date, "D"), run_lengths, 0)
+        end = int(np.argmax(run_lengths))
+        length = int(run_lengths[end])
+        if not length:
+            return None
+        return {
+            "date": str(self.dates[end]),
+            "start_hour": self.records[end - length + 1].get("hour"),
+            "end_hour": self.records[end].get("hour"),
+            "hours": length,
+        }
@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+
+from src.utils.sqlite import connect_sqlite
+from src.logging.logger import logger
+
+def _hamming(a: int, b: int) -> int:
+    # bin().count thay cho int.bit_count() (chỉ có từ Python 3.10).
+    return bin(a ^ b).count("1")
+
+class _BKNode:
+    __slots__ = ("hash_value", "entry", "children")
+
+    def __init__(self, hash_value: int, entry: dict):
+        self.hash_value = hash_value
+        self.entry = entry
+        self.children = {}
+
+class ImageHashIndex:
+    """
+    Chỉ mục perceptual hash (phash 64-bit) của các ảnh giám sát đã phân tích, tổ chức dạng BK-tree
+    theo khoảng cách Hamming: tìm ảnh gần trùng (khoảng cách <= `max_distance`) mà không phải duyệt
+    toàn bộ, kể cả khi ảnh cũ được lưu ở thư mục lớp khác. Các hash được lưu bền vững trong SQLite
+    (nếu cấu hình "path"); khi khởi động, cây được nạp lại từ SQLite và từ tên file trong storage.
+    Thư mục storage bị chuyển/xóa khi tạo dataset retrain, nên kết quả tìm được chỉ trả về khi file ảnh
+    còn tồn tại; mục có file đã mất bị gỡ khỏi chỉ mục (đánh dấu trong cây, xóa trong SQLite).
+    """
+    def __init__(self, config, storage_folder: str = None):
+        index_config = getattr(config, "IMAGE_HASH_INDEX", {})
+        self.enabled = index_config.get("enabled", True)
+        self.max_distance = index_config.get("max_distance", 6)
+        self.path = index_config.get("path")
+        self._root = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._stats = {"lookups": 0, "exact_hits": 0, "near_hits": 0, "misses": 0, "pruned": 0}
+
+        if not self.enabled:
+            return
+        if self.path:
+            try:
+                self._connection = connect_sqlite(self.path)
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS image_hashes ("
+                    "image_hash TEXT PRIMARY KEY, label TEXT NOT NULL, image_path TEXT, created_at REAL NOT NULL)"
+                )
+                self._connection.commit()
+                for row in self._connection.execute("SELECT image_hash, label, image_path FROM image_hashes"):
+                    self._insert(int(row["image_hash"], 16), {"hash": row["image_hash"], "label": row["label"], "path": row["image_path"]})
+            except Exception as e:
+                logger.error(f"Không thể mở chỉ mục hash ảnh tại '{self.path}': {e}. Chỉ dùng chỉ mục trong bộ nhớ.")
+                self._connection = None
+        if storage_folder:
+            self._import_storage_folder(storage_folder)
+        logger.info(f"Chỉ mục hash ảnh sẵn sàng với {self._size} ảnh (ngưỡng Hamming {self.max_distance}).")
+
+    @staticmethod
+    def _to_int(image_hash) -> int:
+        return int(str(image_hash), 16)
+
+    def _import_storage_folder(self, storage_folder: str):
+        """Nạp các ảnh đã lưu theo quy ước `<storage>/<lớp>/<phash>.<đuôi>` chưa có trong chỉ mục."""
+        if not os.path.isdir(storage_folder):
+            return
+        for label in os.listdir(storage_folder):
+            class_folder = os.path.join(storage_folder, label)
+            if not os.path.isdir(class_folder):
+                continue
+            for filename in os.listdir(class_folder):
+                hash_hex = os.path.splitext(filename)[0]
+                if len(hash_hex) != 16:
+                    continue
+                try:
+                    self.add(hash_hex, label, os.path.join(class_folder, filename))
+                except ValueError:
+                    continue
+
+    def _insert(self, hash_value: int, entry: dict) -> bool:
+        if self._root is None:
+            self._root = _BKNode(hash_value, entry)
+            self._size += 1
+            return True
+        node = self._root
+        while True:
+            distance = _hamming(node.hash_value, hash_value)
+            if distance == 0:
+                if node.entry is not None:
+                    return False
+                node.entry = entry
+                self._size += 1
+                return True
+            child = node.children.get(distance)
+            if child is None:
+                node.children[distance] = _BKNode(hash_value, entry)
+                self._size += 1
+                return True
+            node = child
+
+    def _search(self, hash_value: int, max_distance: int):
+        best = None
+        candidates = [self._root] if self._root is not None else []
+        while candidates:
+            node = candidates.pop()
+            distance = _hamming(node.hash_value, hash_value)
+            if node.entry is not None and distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node)
+                if distance == 0:
+                    break
+            low, high = distance - max_distance, distance + max_distance
+            candidates.extend(child for d, child in node.children.items() if low <= d <= high)
+        return best
+
+    def find(self, image_hash, max_distance: int = None):
+        """
+        Tìm ảnh đã biết gần nhất với `image_hash`.
+
+        Returns:
+            dict | None: {"hash", "label", "path", "distance"} nếu có ảnh trong ngưỡng, ngược lại None.
+        """
+        if not self.enabled:
+            return None
+        max_distance = self.max_distance if max_distance is None else max_distance
+        hash_value = self._to_int(image_hash)
+        with self._lock:
+            self._stats["lookups"] += 1
+            while True:
+                best = self._search(hash_value, max_distance)
+                if best is None:
+                    self._stats["misses"] += 1
+                    return None
+                distance, node = best
+                if node.entry["path"] and os.path.exists(node.entry["path"]):
+                    break
+                self._prune(node)
+            self._stats["exact_hits" if distance == 0 else "near_hits"] += 1
+            return {**node.entry, "distance": distance}
+
+    def _prune(self, node: _BKNode):
+        """Gỡ mục có file ảnh không còn tồn tại. Nút vẫn ở lại trong cây (để giữ cấu trúc BK-tree) nhưng không còn khớp."""
+        hash_hex = node.entry["hash"]
+        logger.info(f"Chỉ mục hash ảnh: ảnh {hash_hex} không còn tại '{node.entry['path']}', gỡ khỏi chỉ mục.")
+        node.entry = None
+        self._size -= 1
+        self._stats["pruned"] += 1
+        if self._connection is not None:
+            try:
+                self._connection.execute("DELETE FROM image_hashes WHERE image_hash = ?", (hash_hex,))
+                self._connection.commit()
+            except Exception as e:
+                logger.error(f"Lỗi khi xóa hash ảnh {hash_hex}: {e}")
+
+    def add(self, image_hash, label: str, image_path: str = None) -> bool:
+        """Thêm hash của một ảnh mới; trả về False nếu hash đã có trong chỉ mục."""
+        if not self.enabled:
+            return False
+        hash_value = self._to_int(image_hash)
+        hash_hex = f"{hash_value:016x}"
+        with self._lock:
+            inserted = self._insert(hash_value, {"hash": hash_hex, "label": label, "path": image_path})
+            if inserted and self._connection is not None:
+                try:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO image_hashes (image_hash, label, image_path, created_at) VALUES (?, ?, ?, ?)",
+                        (hash_hex, label, image_path, time.time()),
+                    )
+                    self._connection.commit()
+                except Exception as e:
+                    logger.error(f"Lỗi khi lưu hash ảnh {hash_hex}: {e}")
+        return inserted
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+        stats["max_distance"] = self.max_distance
+        return stats
@@ -0,0 +1,92 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from src.logging.logger import logger
+
+class BatchInferenceEngine:
+    """
+    Gom các yêu cầu suy luận đồng thời thành micro-batch.
+    Một luồng nền lấy yêu cầu đầu tiên trong hàng đợi, chờ thêm tối đa `max_wait_ms` (hoặc đến khi đủ
+    `max_batch_size`) rồi gọi `predict_fn` MỘT lần cho cả lô. Mỗi yêu cầu nhận lại đúng hàng kết quả của mình.
+    Khi biết trước `sample_shape`, các mẫu được chép thẳng vào một buffer lô cấp phát sẵn (ép kiểu `dtype`
+    ngay khi chép) thay vì tạo mảng mới bằng np.stack cho mỗi lô; `predict_fn` không được giữ lại buffer này.
+    """
+    def __init__(self, predict_fn, max_batch_size: int = 16, max_wait_ms: float = 10.0, name: str = "inference",
+                 sample_shape: tuple = None, dtype=np.float32):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self._buffer = np.empty((self.max_batch_size, *sample_shape), dtype=dtype) if sample_shape else None
+        self.max_wait_seconds = max(0.0, max_wait_ms / 1000.0)
+        self.name = name
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "errors": 0, "total_batch_seconds": 0.0}
+        self._worker = threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True)
+        self._worker.start()
+        logger.info(f"[{self.name}] Engine micro-batch đã khởi động (tối đa {self.max_batch_size} ảnh/lô, chờ {max_wait_ms}ms).")
+
+    def submit(self, sample: np.ndarray) -> Future:
+        """Đưa một mẫu (không có chiều batch) vào hàng đợi; trả về Future chứa hàng kết quả tương ứng."""
+        future = Future()
+        self._queue.put((np.asarray(sample), future))
+        return future
+
+    def infer(self, sample: np.ndarray, timeout: float = None) -> np.ndarray:
+        return self.submit(sample).result(timeout=timeout)
+
+    def infer_many(self, samples: list, timeout: float = None) -> list:
+        """Gửi nhiều mẫu cùng lúc để chúng được gom chung lô; trả về kết quả theo đúng thứ tự."""
+        futures = [self.submit(sample) for sample in samples]
+        return [future.result(timeout=timeout) for future in futures]
+
+    def _collect_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _fill_batch(self, samples: list) -> np.ndarray:
+        if self._buffer is None or samples[0].shape != self._buffer.shape[1:]:
+            return np.stack(samples)
+        batch = self._buffer[:len(samples)]
+        for row, sample in zip(batch, samples):
+            row[...] = sample
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            futures = [future for _, future in batch]
+            started = time.monotonic()
+            try:
+                outputs = np.asarray(self.predict_fn(self._fill_batch([sample for sample, _ in batch])))
+                for future, output in zip(futures, outputs):
+                    future.set_result(output)
+            except Exception as e:
+                logger.error(f"[{self.name}] Lỗi khi suy luận lô {len(batch)} mẫu: {e}")
+                with self._stats_lock:
+                    self._stats["errors"] += 1
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            with self._stats_lock:
+                self._stats["requests"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["total_batch_seconds"] += time.monotonic() - started
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_batch_size"] = round(stats["requests"] / stats["batches"], 2) if stats["batches"] else 0.0
+        stats["avg_batch_seconds"] = round(stats["total_batch_seconds"] / stats["batches"], 4) if stats["batches"] else 0.0
+        return stats
@@ -0,0 +1,186 @@
+import math
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+def dew_point(temperature: float, humidity: float) -> float:
+    """Điểm sương (°C) theo công thức Magnus."""
+    a, b = 17.62, 243.12
+    gamma = math.log(max(humidity, 1e-6) / 100.0) + a * temperature / (b + temperature)
+    return b * gamma / (a - gamma)
+
+class RollingWindow:
+    """
+    Thống kê trượt của một cửa sổ thời gian cho một nông trại.
+    Tổng và các bộ đếm được cộng/trừ khi bản đo vào/ra khỏi cửa sổ; min/max dùng deque đơn điệu,
+    nên mỗi bản đo tốn O(1) (khấu hao) bất kể cửa sổ dài bao nhiêu.
+    Mỗi bản đo đại diện cho khoảng [ts - duration, ts]; các khoảng liên tiếp không chồng nhau, nên chỉ bản đo
+    cũ nhất còn trong cửa sổ có thể bắt đầu trước mốc cắt, và số giờ được tính chỉ gồm phần nằm trong cửa sổ.
+    """
+    def __init__(self, seconds: float, fields: tuple, humidity_thresholds: tuple):
+        self.seconds = seconds
+        self.fields = fields
+        self.humidity_thresholds = humidity_thresholds
+        self._entries = deque()
+        self._sums = {field: 0.0 for field in fields}
+        self._counts = {field: 0 for field in fields}
+        self._mins = {field: deque() for field in fields}
+        self._maxs = {field: deque() for field in fields}
+        self._humid_seconds = [0.0] * len(humidity_thresholds)
+        self._wet_seconds = 0.0
+        self._cutoff = None
+
+    def add(self, ts: float, values: dict, duration: float, humid_flags: tuple, is_wet: bool):
+        self._entries.append((ts, values, duration, humid_flags, is_wet))
+        for field, value in values.items():
+            self._sums[field] += value
+            self._counts[field] += 1
+            mins, maxs = self._mins[field], self._maxs[field]
+            while mins and mins[-1][1] >= value:
+                mins.pop()
+            mins.append((ts, value))
+            while maxs and maxs[-1][1] <= value:
+                maxs.pop()
+            maxs.append((ts, value))
+        for index, flag in enumerate(humid_flags):
+            if flag:
+                self._humid_seconds[index] += duration
+        if is_wet:
+            self._wet_seconds += duration
+
+    def evict(self, now: float):
+        cutoff = now - self.seconds
+        self._cutoff = cutoff if self._cutoff is None else max(self._cutoff, cutoff)
+        while self._entries and self._entries[0][0] < cutoff:
+            ts, values, duration, humid_flags, is_wet = self._entries.popleft()
+            for field, value in values.items():
+                self._sums[field] -= value
+                self._counts[field] -= 1
+                if self._mins[field] and self._mins[field][0][0] == ts:
+                    self._mins[field].popleft()
+                if self._maxs[field] and self._maxs[field][0][0] == ts:
+                    self._maxs[field].popleft()
+            for index, flag in enumerate(humid_flags):
+                if flag:
+                    self._humid_seconds[index] -= duration
+            if is_wet:
+                self._wet_seconds -= duration
+
+    def _clipped_seconds(self) -> tuple:
+        """Số giây độ ẩm vượt từng ngưỡng và số giây lá ướt, đã bỏ phần của bản đo cũ nhất nằm trước mốc cắt."""
+        humid_seconds, wet_seconds = list(self._humid_seconds), self._wet_seconds
+        if self._entries and self._cutoff is not None:
+            ts, _, duration, humid_flags, is_wet = self._entries[0]
+            outside = min(duration, max(0.0, self._cutoff - (ts - duration)))
+            humid_seconds = [seconds - outside if flag else seconds for seconds, flag in zip(humid_seconds, humid_flags)]
+            if is_wet:
+                wet_seconds -= outside
+        return humid_seconds, wet_seconds
+
+    def summary(self) -> dict:
+        result = {"readings": len(self._entries)}
+        for field in self.fields:
+            count = self._counts[field]
+            if count:
+                result[field] = {
+                    "mean": round(self._sums[field] / count, 1),
+                    "min": round(self._mins[field][0][1], 1),
+                    "max": round(self._maxs[field][0][1], 1),
+                }
+        humid_seconds, wet_seconds = self._clipped_seconds()
+        result["hours_humidity_above"] = {
+            str(threshold): round(min(max(seconds, 0.0), self.seconds) / 3600, 1)
+            for threshold, seconds in zip(self.humidity_thresholds, humid_seconds)
+        }
+        result["leaf_wetness_hours"] = round(min(max(wet_seconds, 0.0), self.seconds) / 3600, 1)
+        return result
+
+class IoTAggregator:
+    """
+    Thống kê trượt 1h/6h/24h (mặc định) của dữ liệu cảm biến cho từng nông trại, giữ trong bộ nhớ:
+    trung bình/min/max, số giờ độ ẩm vượt ngưỡng và số giờ lá ướt ước lượng (chênh lệch nhiệt độ - điểm sương nhỏ).
+    Mỗi bản đo được tính là đại diện cho khoảng thời gian từ bản đo trước đó (tối đa `max_gap_hours`).
+    Bản đo đến trễ (cũ hơn bản đo mới nhất đã nhận) vẫn được lưu ở kho nhưng không đưa vào thống kê.
+    """
+    def __init__(self, config: dict = None):
+        aggregate_config = {
+            "windows_hours": (1, 6, 24),
+            "fields": ("temperature", "humidity", "soil_moisture", "water_level"),
+            "humidity_thresholds": (85, 90),
+            "leaf_wetness_max_dew_point_depression": 2.0,
+            "max_gap_hours": 4,
+            **(config or {}),
+        }
+        self.windows_hours = tuple(aggregate_config["windows_hours"])
+        self.fields = tuple(aggregate_config["fields"])
+        self.humidity_thresholds = tuple(aggregate_config["humidity_thresholds"])
+        self.max_dew_point_depression = aggregate_config["leaf_wetness_max_dew_point_depression"]
+        self.max_gap_seconds = aggregate_config["max_gap_hours"] * 3600
+        self.max_window_seconds = max(self.windows_hours) * 3600
+        self._farms = {}
+        self._lock = threading.Lock()
+
+    def _new_farm_state(self) -> dict:
+        return {
+            "last_ts": None,
+            "windows": {f"{hours}h": RollingWindow(hours * 3600, self.fields, self.humidity_thresholds)
+                        for hours in self.windows_hours},
+        }
+
+    def reset(self, farm_ids=None):
+        """Xóa thống kê của các nông trại trong `farm_ids` (mặc định: tất cả)."""
+        with self._lock:
+            if farm_ids is None:
+                self._farms = {}
+            for farm_id in farm_ids or ():
+                self._farms.pop(int(farm_id), None)
+
+    def last_timestamp(self, farm_id: int) -> float:
+        """Thời điểm của bản đo mới nhất đã đưa vào thống kê của nông trại, hoặc None."""
+        with self._lock:
+            state = self._farms.get(int(farm_id))
+            return state["last_ts"] if state else None
+
+    def _is_wet(self, values: dict) -> bool:
+        humidity, temperature = values.get("humidity"), values.get("temperature")
+        if humidity is None:
+            return False
+        if temperature is None:
+            return humidity >= 90
+        return temperature - dew_point(temperature, humidity) <= self.max_dew_point_depression
+
+    def add_reading(self, farm_id: int, ts: float, reading: dict):
+        values = {field: float(reading[field]) for field in self.fields
+                  if isinstance(reading.get(field), (int, float)) and not isinstance(reading.get(field), bool)}
+        with self._lock:
+            state = self._farms.setdefault(int(farm_id), self._new_farm_state())
+            if state["last_ts"] is not None and ts < state["last_ts"]:
+                return
+            duration = min(ts - state["last_ts"], self.max_gap_seconds) if state["last_ts"] is not None else 0.0
+            state["last_ts"] = ts
+            humidity = values.get("humidity")
+            humid_flags = tuple(humidity is not None and humidity >= threshold for threshold in self.humidity_thresholds)
+            is_wet = self._is_wet(values)
+            for window in state["windows"].values():
+                window.add(ts, values, duration, humid_flags, is_wet)
+                window.evict(ts)
+
+    def get_summary(self, farm_id: int, now: float = None) -> dict:
+        """Thống kê hiện tại của nông trại, hoặc None nếu chưa có bản đo nào trong cửa sổ dài nhất."""
+        with self._lock:
+            state = self._farms.get(int(farm_id))
+            if state is None or state["last_ts"] is None:
+                return None
+            reference = max(now if now is not None else state["last_ts"], state["last_ts"])
+            windows = {}
+            for name, window in state["windows"].items():
+                window.evict(reference)
+                windows[name] = window.summary()
+            as_of = datetime.fromtimestamp(state["last_ts"], tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+        if not any(window["readings"] for window in windows.values()):
+            return None
+        return {"as_of": as_of, "windows": windows}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"farms": len(self._farms), "windows_hours": list(self.windows_hours)}
@@ -1,45 +1,204 @@
 import os
 import json
+import time
 import random
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
 from src.utils.config import CONFIG
+from src.utils.sqlite import connect_sqlite
+from src.services.iot_aggregates import IoTAggregator
 from src.logging.logger import logger
 
+READING_FIELDS = ("temperature", "humidity", "soil_moisture", "soil_ph", "water_level")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+# Khoảng giá trị hợp lệ của từng loại cảm biến, dùng để kiểm tra dữ liệu gửi lên hàng loạt.
+READING_RANGES = {
+    "temperature": (-10.0, 60.0),
+    "humidity": (0.0, 100.0),
+    "soil_moisture": (0.0, 100.0),
+    "soil_ph": (0.0, 14.0),
+    "water_level": (-50.0, 200.0),
+}
+
 class IoTService:
     """
     Dịch vụ mô phỏng việc tạo, lưu và đọc dữ liệu từ các cảm biến IoT.
-    Tất cả dữ liệu được lưu trong một file JSON duy nhất.
+    Dữ liệu được lưu dạng chuỗi thời gian trong SQLite (chỉ ghi thêm, chỉ mục (farm_id, ts)), nên mỗi lần ghi
+    chỉ tốn một INSERT bất kể số nông trại, và lịch sử đo không bị ghi đè. Bản đo mới nhất của từng farm
+    được giữ trong bộ nhớ để đọc không cần truy vấn, cùng với thống kê trượt theo cửa sổ thời gian (IoTAggregator),
+    nên agent lấy được xu hướng cảm biến mà không phải quét lịch sử.
+    Kho có thể được ghi bởi worker khác hoặc scheduler, nên trước mỗi lần đọc dịch vụ so MAX(id) với id cuối
+    đã nạp (id AUTOINCREMENT không bao giờ bị dùng lại, kể cả sau khi compact xóa dòng mới nhất) và chỉ nạp thêm các dòng mới; farm nhận bản đo cũ hơn thống kê hiện có được dựng lại từ kho.
     """
     def __init__(self):
+        store_config = {"retention_days": 90, "max_batch_size": 5000, **getattr(CONFIG, "IOT_STORE", {})}
         self.save_path = os.path.join(CONFIG.IOT_FOLDER, "iot_data")
         os.makedirs(self.save_path, exist_ok=True)
-        self.data_file = os.path.join(self.save_path, "all_iot_data.json")
-        logger.info(f"File lưu trữ dữ liệu IoT tập trung tại: {self.data_file}")
+        self.legacy_data_file = os.path.join(self.save_path, "all_iot_data.json")
+        self.db_path = store_config.get("path") or os.path.join(self.save_path, "iot_readings.sqlite3")
+        self.retention_days = store_config["retention_days"]
+        self.max_batch_size = store_config["max_batch_size"]
+
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._last_id = 0
+        self.aggregates = IoTAggregator(getattr(CONFIG, "IOT_AGGREGATES", {}))
+        self._connection = connect_sqlite(self.db_path)
+        self._create_schema()
+
+        self._migrate_legacy_file()
+        with self._lock:
+            self._reload()
+        logger.info(f"Kho dữ liệu IoT (SQLite) tại: {self.db_path} ({len(self._latest)} nông trại có dữ liệu)")
 
-    def _read_all_data(self) -> dict:
-        """Đọc toàn bộ dữ liệu từ file JSON. Trả về {} nếu file không tồn tại hoặc rỗng."""
+    def _create_schema(self):
+        """
+        Tạo bảng chuỗi thời gian. Bảng tạo bởi phiên bản cũ (không có cột id) được chép sang bảng mới
+        theo thứ tự rowid trong một transaction, vì SQLite không cho thêm cột khóa chính bằng ALTER TABLE.
+        """
+        columns = ("farm_id INTEGER NOT NULL, ts REAL NOT NULL, "
+                   + "".join(f"{field} REAL, " for field in READING_FIELDS) + "payload TEXT NOT NULL")
+        names = ", ".join(("farm_id", "ts", *READING_FIELDS, "payload"))
+        self._connection.execute("BEGIN IMMEDIATE")
         try:
-            with open(self.data_file, "r", encoding="utf-8") as f:
-                content = f.read()
-                if not content:
-                    return {}
-                return json.loads(content)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
-
-    def _write_all_data(self, data: dict):
-        """Ghi toàn bộ dữ liệu vào file JSON."""
+            existing = [row["name"] for row in self._connection.execute("PRAGMA table_info(iot_readings)")]
+            if existing and "id" not in existing:
+                self._connection.execute(f"CREATE TABLE iot_readings_v2 (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})")
+                self._connection.execute(f"INSERT INTO iot_readings_v2 ({names}) SELECT {names} FROM iot_readings ORDER BY rowid")
+                self._connection.execute("DROP TABLE iot_readings")
+                self._connection.execute("ALTER TABLE iot_readings_v2 RENAME TO iot_readings")
+                logger.info("Đã chuyển bảng iot_readings sang khóa chính id AUTOINCREMENT.")
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS iot_readings (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_iot_readings_farm_ts ON iot_readings (farm_id, ts)")
+            self._connection.commit()
+        except Exception:
+            self._connection.rollback()
+            raise
+
+    @staticmethod
+    def _parse_timestamp(value) -> float:
+        """Chuyển timestamp của bản đo (chuỗi UTC hoặc epoch) sang epoch giây; trả về None nếu không đọc được."""
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            for fmt in (TIMESTAMP_FORMAT, "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+                try:
+                    return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc).timestamp()
+                except ValueError:
+                    continue
+            try:
+                parsed = datetime.fromisoformat(value)
+                return (parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)).timestamp()
+            except ValueError:
+                pass
+        return None
+
+    def _row_values(self, farm_id: int, iot_data: dict) -> tuple:
+        ts = self._parse_timestamp(iot_data.get("timestamp"))
+        if ts is None:
+            ts = time.time()
+        return (int(farm_id), ts, *(iot_data.get(field) for field in READING_FIELDS),
+                json.dumps(iot_data, ensure_ascii=False))
+
+    def _insert_rows(self, rows: list):
+        """Ghi nhiều bản đo trong MỘT transaction rồi nạp chúng (cùng dòng do tiến trình khác ghi) vào bộ nhớ."""
+        placeholders = ", ".join("?" for _ in range(len(READING_FIELDS) + 3))
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    f"INSERT INTO iot_readings (farm_id, ts, {', '.join(READING_FIELDS)}, payload) VALUES ({placeholders})",
+                    rows,
+                )
+            self._refresh()
+
+    def _refresh(self):
+        """
+        Nạp các dòng có id lớn hơn id cuối đã thấy (do tiến trình này, worker khác hoặc scheduler ghi).
+        MAX(id) đọc từ cuối B-tree nên lần kiểm tra khi không có gì mới gần như không tốn gì.
+        Gọi khi đang giữ self._lock.
+        """
+        max_id = self._connection.execute("SELECT MAX(id) FROM iot_readings").fetchone()[0] or 0
+        if max_id == self._last_id:
+            return
+        if max_id < self._last_id:
+            # MAX(id) chỉ giảm khi compact xóa dòng có id lớn nhất; id mới vẫn lớn hơn mọi id cũ nên chỉ cần
+            # nạp lại toàn bộ để đồng bộ trạng thái.
+            self._reload()
+            return
+        rows = self._connection.execute(
+            f"SELECT farm_id, ts, {', '.join(READING_FIELDS)}, payload FROM iot_readings "
+            "WHERE id > ? AND id <= ? ORDER BY ts",
+            (self._last_id, max_id),
+        ).fetchall()
+        self._last_id = max_id
+        stale_farms = set()
+        for row in rows:
+            farm_id, ts = row["farm_id"], row["ts"]
+            current = self._latest.get(farm_id)
+            if current is None or ts >= current[0]:
+                self._latest[farm_id] = (ts, json.loads(row["payload"]))
+            last_ts = self.aggregates.last_timestamp(farm_id)
+            if farm_id in stale_farms or (last_ts is not None and ts < last_ts):
+                stale_farms.add(farm_id)
+                continue
+            self.aggregates.add_reading(farm_id, ts, {field: row[field] for field in READING_FIELDS})
+        if stale_farms:
+            self._warm_aggregates(stale_farms)
+
+    def _migrate_legacy_file(self):
+        """Chuyển dữ liệu từ file all_iot_data.json cũ (mỗi farm một bản đo) sang SQLite, rồi đổi tên file cũ."""
+        if not os.path.exists(self.legacy_data_file):
+            return
         try:
-            with open(self.data_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4, ensure_ascii=False)
+            with open(self.legacy_data_file, "r", encoding="utf-8") as f:
+                content = f.read()
+            legacy_data = json.loads(content) if content else {}
+            rows = [self._row_values(int(farm_id), reading) for farm_id, reading in legacy_data.items() if isinstance(reading, dict)]
+            if rows:
+                self._insert_rows(rows)
+            os.replace(self.legacy_data_file, f"{self.legacy_data_file}.migrated")
+            logger.info(f"Đã chuyển {len(rows)} bản đo IoT từ {self.legacy_data_file} sang SQLite.")
         except Exception as e:
-            logger.error(f"Không thể ghi vào file IoT {self.data_file}: {e}")
+            logger.error(f"Không thể chuyển dữ liệu IoT cũ từ {self.legacy_data_file}: {e}")
+
+    def _reload(self):
+        """Nạp lại toàn bộ trạng thái trong bộ nhớ từ kho. Gọi khi đang giữ self._lock."""
+        self._last_id = self._connection.execute("SELECT MAX(id) FROM iot_readings").fetchone()[0] or 0
+        self._load_latest()
+        self._warm_aggregates()
+
+    def _load_latest(self):
+        rows = self._connection.execute(
+            "SELECT r.farm_id, r.ts, r.payload FROM iot_readings r "
+            "JOIN (SELECT farm_id, MAX(ts) AS max_ts FROM iot_readings GROUP BY farm_id) m "
+            "ON r.farm_id = m.farm_id AND r.ts = m.max_ts"
+        ).fetchall()
+        self._latest = {row["farm_id"]: (row["ts"], json.loads(row["payload"])) for row in rows}
+
+    def _warm_aggregates(self, farm_ids: set = None):
+        """
+        Dựng lại thống kê trượt từ các bản đo trong cửa sổ dài nhất, cho các farm trong `farm_ids` (mặc định: tất cả).
+        Gọi khi đang giữ self._lock.
+        """
+        since_ts = time.time() - self.aggregates.max_window_seconds
+        query = f"SELECT farm_id, ts, {', '.join(READING_FIELDS)} FROM iot_readings WHERE ts >= ?"
+        params = [since_ts]
+        if farm_ids is not None:
+            farm_ids = sorted(int(farm_id) for farm_id in farm_ids)
+            query += f" AND farm_id IN ({', '.join('?' for _ in farm_ids)})"
+            params.extend(farm_ids)
+        rows = self._connection.execute(query + " ORDER BY ts", params).fetchall()
+        self.aggregates.reset(farm_ids)
+        for row in rows:
+            self.aggregates.add_reading(row["farm_id"], row["ts"], {field: row[field] for field in READING_FIELDS})
 
     def generate_fake_data(self, farm_id: int) -> dict:
         """Tạo ra một bộ dữ liệu cảm biến giả cho một nông trại cụ thể."""
         return {
             "farm_id": farm_id,
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
+            "timestamp": datetime.utcnow().strftime(TIMESTAMP_FORMAT),
             "temperature": round(random.uniform(25.0, 36.5), 1),
             "humidity": round(random.uniform(70.0, 95.0), 1),
             "soil_moisture": round(random.uniform(30.0, 75.0), 1),
@@ -48,21 +207,151 @@ class IoTService:
         }
 
     def save_data(self, farm_id: int, iot_data: dict):
-        """Cập nhật dữ liệu cho một farm_id cụ thể và lưu lại toàn bộ file."""
-        all_data = self._read_all_data()
-        all_data[str(farm_id)] = iot_data
-        self._write_all_data(all_data)
-        logger.info(f"Đã cập nhật dữ liệu IoT cho farm {farm_id} trong file tập trung.")
+        """Ghi thêm một bản đo cho farm_id vào chuỗi thời gian."""
+        try:
+            self._insert_rows([self._row_values(farm_id, iot_data)])
+            logger.info(f"Đã lưu bản đo IoT mới cho farm {farm_id}.")
+        except Exception as e:
+            logger.error(f"Không thể lưu dữ liệu IoT cho farm {farm_id}: {e}")
 
-    def get_latest_data(self, farm_id: int) -> dict:
-        """Lấy dữ liệu mới nhất cho một farm từ file JSON tập trung."""
-        all_data = self._read_all_data()
-        farm_id_str = str(farm_id)
+    def validate_reading(self, record) -> dict:
+        """
+        Kiểm tra và chuẩn hóa một bản đo gửi lên từ gateway. Bắt buộc có farm_id và ít nhất một giá trị cảm biến;
+        giá trị phải là số trong khoảng hợp lệ. Timestamp thiếu được gán thời điểm hiện tại (UTC).
+        Raises:
+            ValueError: mô tả lỗi của bản đo.
+        """
+        if not isinstance(record, dict):
+            raise ValueError("Bản đo phải là một object JSON.")
+        try:
+            farm_id = int(record.get("farm_id"))
+        except (TypeError, ValueError):
+            raise ValueError("Thiếu hoặc sai farm_id.")
+
+        reading = {"farm_id": farm_id}
+        for field in READING_FIELDS:
+            value = record.get(field)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"Giá trị '{field}' phải là số.")
+            low, high = READING_RANGES[field]
+            if not low <= value <= high:
+                raise ValueError(f"Giá trị '{field}'={value} nằm ngoài khoảng [{low}, {high}].")
+            reading[field] = value
+        if len(reading) == 1:
+            raise ValueError(f"Bản đo không có giá trị cảm biến nào ({', '.join(READING_FIELDS)}).")
 
-        if farm_id_str in all_data:
-            return all_data[farm_id_str]
+        timestamp = record.get("timestamp")
+        if timestamp is None:
+            reading["timestamp"] = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
         else:
-            logger.info(f"Chưa có dữ liệu cảm biến cho farm {farm_id}. Tạo dữ liệu mới.")
-            new_data = self.generate_fake_data(farm_id)
-            self.save_data(farm_id, new_data) 
-            return new_data
+            ts = self._parse_timestamp(timestamp)
+            if ts is None:
+                raise ValueError(f"Không đọc được timestamp '{timestamp}'.")
+            reading["timestamp"] = datetime.fromtimestamp(ts, tz=timezone.utc).strftime(TIMESTAMP_FORMAT)
+        return reading
+
+    def save_many(self, records: list, allowed_farm_ids: set = None) -> dict:
+        """
+        Kiểm tra rồi ghi nhiều bản đo (có thể của nhiều farm) trong MỘT transaction.
+        Bản đo lỗi không chặn các bản đo hợp lệ; lỗi được trả về theo vị trí trong danh sách gửi lên.
+
+        Args:
+            records (list): Danh sách bản đo.
+            allowed_farm_ids (set): Nếu có, chỉ chấp nhận bản đo của các farm này.
+
+        Returns:
+            dict: {"received", "saved", "errors": [{"index", "error"}]}.
+        """
+        if len(records) > self.max_batch_size:
+            return {"received": len(records), "saved": 0,
+                    "errors": [{"index": None, "error": f"Lô dữ liệu vượt quá {self.max_batch_size} bản đo."}]}
+
+        rows, errors = [], []
+        for index, record in enumerate(records):
+            try:
+                reading = self.validate_reading(record)
+                if allowed_farm_ids is not None and reading["farm_id"] not in allowed_farm_ids:
+                    raise ValueError(f"Không có quyền ghi dữ liệu cho farm {reading['farm_id']}.")
+                rows.append(self._row_values(reading["farm_id"], reading))
+            except ValueError as e:
+                errors.append({"index": index, "error": str(e)})
+
+        if rows:
+            try:
+                self._insert_rows(rows)
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi lô {len(rows)} bản đo IoT: {e}")
+                return {"received": len(records), "saved": 0,
+                        "errors": errors + [{"index": None, "error": "Lỗi hệ thống khi lưu dữ liệu IoT."}]}
+        logger.info(f"Đã lưu lô IoT: {len(rows)}/{len(records)} bản đo hợp lệ.")
+        return {"received": len(records), "saved": len(rows), "errors": errors}
+
+    def get_latest_data(self, farm_id: int) -> dict:
+        """Lấy bản đo mới nhất của một farm (từ bộ nhớ, sau khi nạp các dòng mới trong kho)."""
+        with self._lock:
+            self._refresh_safely()
+            latest = self._latest.get(int(farm_id))
+        if latest:
+            return latest[1]
+
+        logger.info(f"Chưa có dữ liệu cảm biến cho farm {farm_id}. Tạo dữ liệu mới.")
+        new_data = self.generate_fake_data(farm_id)
+        self.save_data(farm_id, new_data)
+        return new_data
+
+    def get_aggregates(self, farm_id: int) -> dict:
+        """Thống kê trượt (trung bình/min/max, số giờ độ ẩm cao, số giờ lá ướt) của farm, tính đến thời điểm hiện tại."""
+        with self._lock:
+            self._refresh_safely()
+        return self.aggregates.get_summary(farm_id, now=time.time())
+
+    def _refresh_safely(self):
+        """Như _refresh nhưng lỗi đọc kho chỉ được ghi log; khi đó dùng trạng thái đang có trong bộ nhớ."""
+        try:
+            self._refresh()
+        except Exception as e:
+            logger.warning(f"Không thể nạp bản đo IoT mới từ kho: {e}")
+
+    def get_history(self, farm_id: int, since_ts: float = None, limit: int = None) -> list:
+        """Các bản đo của farm theo thứ tự thời gian tăng dần, tùy chọn từ thời điểm `since_ts` (epoch giây)."""
+        query = "SELECT payload FROM iot_readings WHERE farm_id = ? AND ts >= ? ORDER BY ts"
+        params = [int(farm_id), since_ts if since_ts is not None else 0]
+        if limit:
+            query = ("SELECT payload FROM (SELECT payload, ts FROM iot_readings WHERE farm_id = ? AND ts >= ? "
+                     "ORDER BY ts DESC LIMIT ?) ORDER BY ts")
+            params.append(int(limit))
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [json.loads(row["payload"]) for row in rows]
+
+    def compact(self):
+        """
+        Dọn kho chuỗi thời gian: xóa các bản đo cũ hơn `retention_days` (luôn giữ bản mới nhất của mỗi farm)
+        và gộp WAL vào file chính để file không phình ra theo thời gian.
+        """
+        cutoff = time.time() - self.retention_days * 86400
+        try:
+            with self._lock:
+                with self._connection:
+                    deleted = self._connection.execute(
+                        "DELETE FROM iot_readings WHERE ts < ? AND rowid NOT IN "
+                        "(SELECT r.rowid FROM iot_readings r JOIN (SELECT farm_id, MAX(ts) AS max_ts FROM iot_readings GROUP BY farm_id) m "
+                        "ON r.farm_id = m.farm_id AND r.ts = m.max_ts)",
+                        (cutoff,),
+                    ).rowcount
+                self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logger.info(f"Đã dọn kho IoT: xóa {deleted} bản đo cũ hơn {self.retention_days} ngày.")
+            return deleted
+        except Exception as e:
+            logger.error(f"Lỗi khi dọn kho dữ liệu IoT: {e}")
+            return 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._refresh_safely()
+            total = self._connection.execute("SELECT COUNT(*) FROM iot_readings").fetchone()[0]
+            farms = len(self._latest)
+        return {"readings": total, "farms": farms, "retention_days": self.retention_days,
+                "aggregates": self.aggregates.get_stats()}
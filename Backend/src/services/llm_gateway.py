@@ -0,0 +1,190 @@
+import time
+import random
+import threading
+
+import openai
+from openai import OpenAI
+
+from src.logging.logger import logger
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+class LLMGateway:
+    """
+    Cổng gọi LLM dùng chung cho mọi agent trong một tiến trình.
+    - Một connection pool HTTP có giới hạn (thay vì mỗi agent một client OpenAI riêng).
+    - Semaphore toàn cục giới hạn số lời gọi đồng thời (kể cả lời gọi stream). Sweep giám sát chạy song song
+      nhiều nông hộ trên thread pool của nó, nên các lời gọi đồng bộ qua gateway đã chồng lên nhau.
+    - Tự thử lại lỗi tạm thời (timeout, mất kết nối, 429, 5xx) với backoff lũy thừa có jitter.
+    - Timeout riêng cho từng lời gọi.
+    `OPENAI_BASE_URL` cho phép trỏ gateway tới một server giả lập cục bộ khi kiểm thử.
+    """
+    def __init__(self, config):
+        gateway_config = {
+            "max_connections": 20, "max_keepalive_connections": 10, "max_concurrency": 8,
+            "timeout_seconds": 60.0, "connect_timeout_seconds": 10.0,
+            "max_retries": 3, "backoff_base_seconds": 0.5, "backoff_max_seconds": 8.0,
+            **getattr(config, "LLM_GATEWAY", {}),
+        }
+        self.api_key = config.OPENAI_API_KEY
+        self.base_url = getattr(config, "OPENAI_BASE_URL", None)
+        self.model_name = config.OPENAI_MODEL_NAME
+        self.timeout_seconds = gateway_config["timeout_seconds"]
+        self.connect_timeout_seconds = gateway_config["connect_timeout_seconds"]
+        self.max_connections = gateway_config["max_connections"]
+        self.max_keepalive_connections = gateway_config["max_keepalive_connections"]
+        self.max_retries = gateway_config["max_retries"]
+        self.backoff_base_seconds = gateway_config["backoff_base_seconds"]
+        self.backoff_max_seconds = gateway_config["backoff_max_seconds"]
+
+        self._semaphore = threading.BoundedSemaphore(gateway_config["max_concurrency"])
+        self._stats_lock = threading.Lock()
+        self._stats = {"calls": 0, "retries": 0, "failures": 0, "in_flight": 0, "total_latency_seconds": 0.0}
+
+        self.client = None
+        if not self.api_key:
+            logger.warning("LLMGateway: Không tìm thấy OPENAI_API_KEY. Gateway sẽ không được khởi tạo.")
+            return
+        try:
+            self.client = OpenAI(**self._client_kwargs(), http_client=self._build_http_client())
+            logger.info(
+                f"LLMGateway đã khởi tạo (model '{self.model_name}', tối đa {gateway_config['max_concurrency']} lời gọi đồng thời, "
+                f"{self.max_connections} kết nối)."
+            )
+        except Exception as e:
+            logger.error(f"LLMGateway: Lỗi khi khởi tạo OpenAI client: {e}")
+            self.client = None
+
+    @property
+    def available(self) -> bool:
+        return self.client is not None
+
+    def _client_kwargs(self) -> dict:
+        # Việc thử lại do gateway đảm nhiệm để backoff và semaphore được áp dụng thống nhất.
+        kwargs = {"api_key": self.api_key, "max_retries": 0, "timeout": self.timeout_seconds}
+        if self.base_url:
+            kwargs["base_url"] = self.base_url
+        return kwargs
+
+    def _build_http_client(self):
+        """Tạo HTTP client với connection pool có giới hạn. Trả về None để dùng pool mặc định của SDK."""
+        if httpx is None:
+            return None
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive_connections)
+        timeout = httpx.Timeout(self.timeout_seconds, connect=self.connect_timeout_seconds)
+        return httpx.Client(limits=limits, timeout=timeout)
+
+    def _request_kwargs(self, messages: list, timeout, kwargs: dict) -> dict:
+        return {"model": kwargs.pop("model", self.model_name), "messages": messages,
+                "timeout": timeout or self.timeout_seconds, **kwargs}
+
+    def _backoff_delay(self, attempt: int, error) -> float:
+        """Full jitter: chờ ngẫu nhiên trong [0, min(max, base * 2^attempt)], tôn trọng Retry-After nếu có."""
+        delay = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * (2 ** attempt)))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max_seconds))
+            except ValueError:
+                pass
+        return delay
+
+    def _record(self, key: str, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def chat_completion(self, messages: list, timeout: float = None, **kwargs):
+        """Gọi chat completion (đồng bộ) qua pool dùng chung; trả về đối tượng ChatCompletion của SDK."""
+        if not self.client:
+            raise RuntimeError("LLMGateway chưa sẵn sàng.")
+        request = self._request_kwargs(messages, timeout, kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            with self._semaphore:
+                self._record("in_flight")
+                started = time.monotonic()
+                try:
+                    response = self.client.chat.completions.create(**request)
+                    self._record("calls")
+                    self._record("total_latency_seconds", time.monotonic() - started)
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    error = e
+                finally:
+                    self._record("in_flight", -1)
+
+            if attempt == self.max_retries:
+                break
+            delay = self._backoff_delay(attempt, error)
+            self._record("retries")
+            logger.warning(f"LLMGateway: Lỗi tạm thời ({type(error).__name__}), thử lại lần {attempt + 1} sau {delay:.2f}s.")
+            time.sleep(delay)
+
+        self._record("failures")
+        raise error
+
+    def stream_chat_completion(self, messages: list, timeout: float = None, **kwargs):
+        """
+        Gọi chat completion ở chế độ stream; là generator trả về từng đoạn văn bản ngay khi nhận được.
+        Chỉ thử lại khi lỗi xảy ra trước lúc stream bắt đầu; slot đồng thời được giữ đến khi stream kết thúc.
+        """
+        if not self.client:
+            raise RuntimeError("LLMGateway chưa sẵn sàng.")
+        request = {**self._request_kwargs(messages, timeout, kwargs), "stream": True}
+
+        for attempt in range(self.max_retries + 1):
+            self._semaphore.acquire()
+            self._record("in_flight")
+            started = time.monotonic()
+            try:
+                stream = self.client.chat.completions.create(**request)
+            except RETRYABLE_ERRORS as e:
+                error = e
+                self._record("in_flight", -1)
+                self._semaphore.release()
+            except Exception:
+                self._record("in_flight", -1)
+                self._semaphore.release()
+                raise
+            else:
+                try:
+                    for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            yield delta
+                    self._record("calls")
+                    self._record("total_latency_seconds", time.monotonic() - started)
+                    return
+                finally:
+                    stream.close()
+                    self._record("in_flight", -1)
+                    self._semaphore.release()
+
+            if attempt == self.max_retries:
+                break
+            delay = self._backoff_delay(attempt, error)
+            self._record("retries")
+            logger.warning(f"LLMGateway: Lỗi tạm thời ({type(error).__name__}), thử lại lần {attempt + 1} sau {delay:.2f}s.")
+            time.sleep(delay)
+
+        self._record("failures")
+        raise error
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["avg_latency_seconds"] = stats["total_latency_seconds"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
@@ -0,0 +1,105 @@
+import json
+import time
+import hashlib
+import threading
+
+from src.utils.sqlite import connect_sqlite
+from src.logging.logger import logger
+
+class LLMResponseCache:
+    """
+    Cache bền vững (SQLite) cho phản hồi LLM, định danh theo nội dung.
+    Khóa là hash của (model, cấu hình sinh, loại prompt, prompt đã chuẩn hóa), nên bất kỳ thay đổi
+    nào của thông tin nông hộ, dự báo thời tiết hay dữ liệu IoT đưa vào prompt đều tạo khóa mới.
+    Mỗi bản ghi gắn farm_id để có thể xóa chủ động khi thông tin nông trại thay đổi.
+    """
+    def __init__(self, config):
+        cache_config = getattr(config, "LLM_RESPONSE_CACHE", {})
+        self.path = cache_config.get("path")
+        self.ttl_seconds = cache_config.get("ttl_seconds", {})
+        self.default_ttl_seconds = cache_config.get("default_ttl_seconds", 3600)
+        self.enabled = bool(cache_config.get("enabled", True) and self.path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = None
+
+        if self.enabled:
+            try:
+                self._connection = connect_sqlite(self.path)
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_responses ("
+                    "cache_key TEXT PRIMARY KEY, namespace TEXT NOT NULL, farm_id TEXT, "
+                    "response TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._connection.execute("CREATE INDEX IF NOT EXISTS idx_llm_responses_farm ON llm_responses (farm_id)")
+                self._connection.commit()
+                logger.info(f"Cache phản hồi LLM tại: {self.path}")
+            except Exception as e:
+                logger.error(f"Không thể khởi tạo cache phản hồi LLM: {e}. Cache bị tắt.")
+                self.enabled = False
+
+    @staticmethod
+    def make_key(namespace: str, model_name: str, generation_config: dict, prompt: str) -> str:
+        payload = json.dumps(
+            {"namespace": namespace, "model": model_name, "generation_config": generation_config, "prompt": " ".join(prompt.split())},
+            ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, cache_key: str):
+        """Trả về phản hồi đã cache (đã parse JSON) hoặc None nếu không có / đã hết hạn."""
+        if not self.enabled:
+            return None
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT response FROM llm_responses WHERE cache_key = ? AND expires_at > ?",
+                    (cache_key, time.time()),
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        except Exception as e:
+            logger.error(f"Lỗi khi đọc cache phản hồi LLM: {e}")
+            return None
+
+        if row is None:
+            return None
+        return json.loads(row["response"])
+
+    def set(self, cache_key: str, namespace: str, response, farm_id=None):
+        """Lưu phản hồi với TTL theo loại prompt; đồng thời dọn các bản ghi đã hết hạn."""
+        if not self.enabled:
+            return
+        now = time.time()
+        ttl = self.ttl_seconds.get(namespace, self.default_ttl_seconds)
+        try:
+            with self._lock:
+                self._connection.execute("DELETE FROM llm_responses WHERE expires_at <= ?", (now,))
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO llm_responses (cache_key, namespace, farm_id, response, created_at, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cache_key, namespace, str(farm_id) if farm_id is not None else None,
+                     json.dumps(response, ensure_ascii=False), now, now + ttl),
+                )
+                self._connection.commit()
+        except Exception as e:
+            logger.error(f"Lỗi khi ghi cache phản hồi LLM: {e}")
+
+    def invalidate_farm(self, farm_id):
+        """Xóa toàn bộ phản hồi đã cache của một nông trại (khi thông tin nông trại thay đổi)."""
+        if not self.enabled or farm_id is None:
+            return
+        try:
+            with self._lock:
+                deleted = self._connection.execute("DELETE FROM llm_responses WHERE farm_id = ?", (str(farm_id),)).rowcount
+                self._connection.commit()
+            logger.info(f"Đã xóa {deleted} phản hồi LLM đã cache của farm {farm_id}.")
+        except Exception as e:
+            logger.error(f"Lỗi khi xóa cache phản hồi LLM của farm {farm_id}: {e}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses}
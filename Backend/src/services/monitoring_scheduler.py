@@ -0,0 +1,176 @@
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from src.logging.logger import logger
+
+class StageLimiter:
+    """
+    Giới hạn số tác vụ chạy đồng thời cho từng giai đoạn của pipeline giám sát (inference, weather, llm).
+    Mỗi giai đoạn có semaphore riêng, nên một giai đoạn chậm (vd. LLM) không chiếm hết worker của giai đoạn khác.
+    """
+    def __init__(self, limits: dict):
+        self._semaphores = {name: threading.BoundedSemaphore(max(1, int(limit))) for name, limit in limits.items()}
+        self._lock = threading.Lock()
+        self._stats = {name: {"limit": int(limit), "active": 0, "waiting": 0, "completed": 0, "total_wait_seconds": 0.0}
+                       for name, limit in limits.items()}
+
+    @contextmanager
+    def stage(self, name: str):
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        stats = self._stats[name]
+        with self._lock:
+            stats["waiting"] += 1
+        started = time.monotonic()
+        semaphore.acquire()
+        with self._lock:
+            stats["waiting"] -= 1
+            stats["active"] += 1
+            stats["total_wait_seconds"] += time.monotonic() - started
+        try:
+            yield
+        finally:
+            with self._lock:
+                stats["active"] -= 1
+                stats["completed"] += 1
+            semaphore.release()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+        for values in stats.values():
+            values["avg_wait_seconds"] = round(values["total_wait_seconds"] / values["completed"], 4) if values["completed"] else 0.0
+        return stats
+
+class MonitoringSweepScheduler:
+    """
+    Lịch giám sát định kỳ cho toàn bộ nông hộ, thay cho mỗi người dùng một job APScheduler.
+    Thời điểm chạy kế tiếp của từng người dùng nằm trong một heap; một job quét duy nhất lấy ra các nông hộ
+    đã đến hạn và đưa vào thread pool có giới hạn. Một người dùng không bao giờ được chạy chồng lên chính mình.
+    """
+    def __init__(self, app, task_fn, config):
+        scheduler_config = {
+            "sweep_interval_seconds": 60, "max_workers": 8,
+            "stage_limits": {"inference": 4, "weather": 2, "llm": 4},
+            **getattr(config, "MONITORING_SCHEDULER", {}),
+        }
+        self.app = app
+        self.task_fn = task_fn
+        self.sweep_interval_seconds = scheduler_config["sweep_interval_seconds"]
+        self.max_workers = scheduler_config["max_workers"]
+        self.stages = StageLimiter(scheduler_config["stage_limits"])
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="monitoring-sweep")
+
+        self._lock = threading.Lock()
+        self._heap = []
+        self._entries = {}
+        self._in_flight = set()
+        self._versions = itertools.count(1)
+        self._stats = {"sweeps": 0, "dispatched": 0, "started": 0, "completed": 0, "failed": 0, "skipped_in_flight": 0,
+                       "total_lag_seconds": 0.0, "max_lag_seconds": 0.0, "last_lag_seconds": 0.0}
+
+    def schedule_user(self, user_id, interval_hours: float, last_checked_at: datetime = None):
+        """
+        Thêm / cập nhật lịch của một người dùng. Lần chạy đầu là `last_checked_at + interval` (nếu còn ở tương lai),
+        ngược lại là một chu kỳ kể từ bây giờ, giống job interval trước đây.
+        """
+        user_id = int(user_id)
+        interval_seconds = float(interval_hours) * 3600
+        now = time.time()
+        next_run = now + interval_seconds
+        if last_checked_at is not None:
+            # last_checked_at được lưu theo UTC (datetime.utcnow) và không kèm múi giờ.
+            last_checked_ts = last_checked_at.replace(tzinfo=last_checked_at.tzinfo or timezone.utc).timestamp()
+            next_run = max(now, min(next_run, last_checked_ts + interval_seconds))
+        with self._lock:
+            version = next(self._versions)
+            self._entries[user_id] = (interval_seconds, version)
+            heapq.heappush(self._heap, (next_run, user_id, version))
+        logger.info(f"Đã lên lịch giám sát cho user {user_id}, mỗi {interval_hours} giờ.")
+
+    def remove_user(self, user_id):
+        """Hủy lịch của người dùng; mục cũ trong heap bị bỏ qua khi tới hạn."""
+        with self._lock:
+            removed = self._entries.pop(int(user_id), None)
+        if removed:
+            logger.info(f"Đã hủy lịch giám sát của user {user_id}.")
+
+    def is_scheduled(self, user_id) -> bool:
+        with self._lock:
+            return int(user_id) in self._entries
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_time, user_id, version = heapq.heappop(self._heap)
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] != version:
+                continue
+            interval_seconds = entry[0]
+            next_run = due_time + interval_seconds
+            if next_run <= now:
+                next_run = now + interval_seconds
+            heapq.heappush(self._heap, (next_run, user_id, version))
+            due.append((due_time, user_id))
+        return due
+
+    def sweep(self):
+        """Được APScheduler gọi định kỳ: đưa tất cả nông hộ đã đến hạn vào thread pool rồi trả về ngay."""
+        now = time.time()
+        with self._lock:
+            self._stats["sweeps"] += 1
+            due = self._pop_due(now)
+            to_dispatch = []
+            for due_time, user_id in due:
+                if user_id in self._in_flight:
+                    self._stats["skipped_in_flight"] += 1
+                    continue
+                self._in_flight.add(user_id)
+                to_dispatch.append((due_time, user_id))
+            self._stats["dispatched"] += len(to_dispatch)
+
+        if to_dispatch:
+            logger.info(f"[SWEEP] {len(to_dispatch)} nông hộ đến hạn giám sát.")
+        for due_time, user_id in to_dispatch:
+            self._executor.submit(self._run_user, user_id, due_time)
+
+    def _run_user(self, user_id: int, due_time: float):
+        lag = max(0.0, time.time() - due_time)
+        with self._lock:
+            self._stats["started"] += 1
+            self._stats["total_lag_seconds"] += lag
+            self._stats["max_lag_seconds"] = max(self._stats["max_lag_seconds"], lag)
+            self._stats["last_lag_seconds"] = lag
+        try:
+            self.task_fn(self.app, user_id, stages=self.stages)
+            outcome = "completed"
+        except Exception:
+            logger.exception(f"[SWEEP] Lỗi khi giám sát user {user_id}.")
+            outcome = "failed"
+        with self._lock:
+            self._in_flight.discard(user_id)
+            self._stats[outcome] += 1
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            stats = dict(self._stats)
+            live = [(due_time, user_id) for due_time, user_id, version in self._heap
+                    if self._entries.get(user_id, (None, None))[1] == version]
+            stats["scheduled_users"] = len(self._entries)
+            stats["in_flight"] = len(self._in_flight)
+        overdue = [now - due_time for due_time, _ in live if due_time <= now]
+        stats["queue_depth"] = stats["dispatched"] - stats["started"]
+        stats["overdue_users"] = len(overdue)
+        stats["oldest_overdue_seconds"] = round(max(overdue), 2) if overdue else 0.0
+        stats["next_due_in_seconds"] = round(min(due_time for due_time, _ in live) - now, 2) if live else None
+        stats["avg_lag_seconds"] = round(stats.pop("total_lag_seconds") / stats["started"], 4) if stats["started"] else 0.0
+        stats["stages"] = self.stages.get_stats()
+        return stats
@@ -3,145 +3,638 @@ import numpy as np
 import json
 import re
 import os
+import hashlib
+import math
+import threading
+import unicodedata
+from collections import OrderedDict
 from sentence_transformers import SentenceTransformer
+from src.services.bm25_index import BM25Index
 from src.logging.logger import logger
 
 class VectorStoreService:
     """
     Dịch vụ quản lý nhiều kho vector tri thức chuyên biệt.
     Mỗi kho được tải hoặc xây dựng một cách linh hoạt khi được yêu cầu lần đầu tiên (lazy loading).
+
+    Tất cả các kho dùng chung MỘT bảng chunk đã khử trùng lặp và MỘT index FAISS (IndexIDMap2,
+    ID = hash nội dung chunk). Mỗi kho chỉ là một "view" gồm metadata của tài liệu và tập ID chunk,
+    truy vấn trên kho được lọc bằng IDSelector. Loại index (flat, sq8, ivfpq) cấu hình qua
+    `VECTOR_STORE_INDEX`, và index trên đĩa được memory-map để các worker dùng chung trang bộ nhớ.
+
+    Manifest dùng chung ghi lại dấu vân tay (hash nội dung) của từng file nguồn và các chunk của nó.
+    Khi file nguồn thay đổi, chỉ các chunk chưa từng có mới được tạo embedding và vá vào index.
+
+    Truy vấn là truy vấn lai: điểm vector FAISS và điểm BM25 (chỉ mục đảo ngược trên cùng bảng chunk)
+    được hợp nhất bằng Reciprocal Rank Fusion, có hỗ trợ lọc trước theo metadata của tài liệu.
     """
     def __init__(self, config):
         logger.info("Khởi tạo VectorStoreService (Manager)...")
         self.config = config
         self.model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
         self._stores = {} 
+        self._shared = None
+        self._bm25 = None
+        self._bm25_lock = threading.Lock()
+        self._store_lock = threading.RLock()
+
+        self.query_cache_size = getattr(config, "QUERY_EMBEDDING_CACHE_SIZE", 1024)
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
 
-    def _get_store_paths(self, store_name: str):
-        """Tạo đường dẫn file động cho một kho tri thức cụ thể."""
+    def _get_shared_paths(self):
+        """Đường dẫn các file của lớp vector dùng chung: index, bảng chunk và manifest."""
         base_dir = self.config.VECTOR_STORE_DIR
-        index_path = os.path.join(base_dir, f"faiss_index_{store_name}.bin")
-        docs_path = os.path.join(base_dir, f"documents_{store_name}.json")
-        return index_path, docs_path
-
-    def _build_store(self, store_name: str):
-        """Xây dựng một kho vector mới từ các nguồn dữ liệu được cấu hình."""
-        logger.info(f"Không tìm thấy cache cho kho '{store_name}'. Bắt đầu xây dựng mới...")
-        
-        sources_config = self.config.KNOWLEDGE_SOURCES.get(store_name)
-        if not sources_config:
-            logger.error(f"Không tìm thấy cấu hình nguồn tri thức cho kho '{store_name}'.")
+        index_path = os.path.join(base_dir, "faiss_index_shared.bin")
+        chunks_path = os.path.join(base_dir, "chunks_shared.json")
+        manifest_path = os.path.join(base_dir, "manifest_shared.json")
+        return index_path, chunks_path, manifest_path
+
+    def _get_view_path(self, store_name: str) -> str:
+        """Đường dẫn file view (metadata tài liệu, không kèm nội dung) của một kho."""
+        return os.path.join(self.config.VECTOR_STORE_DIR, f"documents_{store_name}.json")
+
+    def _get_index_config(self) -> dict:
+        """Lấy cấu hình index của lớp vector dùng chung."""
+        return {"type": "flat", **getattr(self.config, "VECTOR_STORE_INDEX", {})}
+
+    def _create_index(self, embeddings: np.ndarray):
+        """
+        Tạo index FAISS (đã huấn luyện, chưa có vector) theo loại được cấu hình:
+        'flat', 'sq8' hoặc 'ivfpq'. IVF tự lưu ID chunk trong danh sách đảo ngược; flat/SQ
+        được bọc trong IndexIDMap2 (vốn giả định ID nội bộ liên tục, không dùng được cho IVF).
+        """
+        index_config = self._get_index_config()
+        index_type = index_config.get("type", "flat")
+        num_vectors, dimension = embeddings.shape
+
+        if index_type == "ivfpq":
+            m = index_config.get("m", 16)
+            nbits = index_config.get("nbits", 8)
+            if num_vectors < 2 ** nbits or dimension % m != 0:
+                logger.warning(f"Không đủ điều kiện cho IVF-PQ ({num_vectors} vector, m={m}). Chuyển sang 'sq8'.")
+                index_type = "sq8"
+            else:
+                nlist = max(1, min(index_config.get("nlist", 64), num_vectors // 39))
+                quantizer = faiss.IndexFlatL2(dimension)
+                index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, nbits)
+                index.train(embeddings)
+                index.nprobe = min(index_config.get("nprobe", 8), nlist)
+                return index
+
+        if index_type == "sq8":
+            index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+            index.train(embeddings)
+        else:
+            if index_type != "flat":
+                logger.warning(f"Loại index '{index_type}' không được hỗ trợ. Dùng 'flat'.")
+            index = faiss.IndexFlatL2(dimension)
+        return faiss.IndexIDMap2(index)
+
+    def _read_index(self, index_path: str, writable: bool = False):
+        """
+        Đọc index từ đĩa, dùng memory-map (chỉ đọc) nếu được bật trong cấu hình.
+        Index cần vá (`writable=True`) luôn được tải đầy đủ vào RAM.
+        """
+        index = None
+        if not writable and getattr(self.config, "VECTOR_STORE_USE_MMAP", True):
+            # IVF map danh sách đảo ngược (IO_FLAG_MMAP); flat/SQ map mảng mã vector (IO_FLAG_MMAP_IFC).
+            mmap_flags = [faiss.IO_FLAG_MMAP, getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)]
+            if self._get_index_config().get("type") != "ivfpq":
+                mmap_flags.reverse()
+            for io_flag in mmap_flags:
+                try:
+                    index = faiss.read_index(index_path, io_flag | faiss.IO_FLAG_READ_ONLY)
+                    break
+                except RuntimeError:
+                    continue
+            if index is None:
+                logger.warning("Không thể memory-map index dùng chung. Tải toàn bộ vào RAM.")
+        if index is None:
+            index = faiss.read_index(index_path)
+
+        try:
+            ivf_index = faiss.extract_index_ivf(index)
+            ivf_index.nprobe = min(self._get_index_config().get("nprobe", 8), ivf_index.nlist)
+        except RuntimeError:
+            pass
+        return index
+
+    def _search_params(self, index, selector, num_allowed: int):
+        """
+        Tham số tìm kiếm giới hạn kết quả trong một tập chunk (kho và bộ lọc metadata).
+        Với index IVF, nprobe được tăng theo tỉ lệ nghịch với độ phủ của tập chunk để bù cho bộ lọc.
+        """
+        try:
+            ivf_index = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return faiss.SearchParameters(sel=selector)
+
+        coverage = max(num_allowed / max(index.ntotal, 1), 1e-6)
+        nprobe = min(ivf_index.nlist, max(ivf_index.nprobe, math.ceil(ivf_index.nprobe / coverage)))
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+
+    @staticmethod
+    def _chunk_id(content: str) -> int:
+        """ID ổn định (int64 dương) của một chunk, suy ra từ hash nội dung."""
+        digest = hashlib.sha1(content.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+    def _source_fingerprint(self, source_info: dict):
+        """Hash nội dung file nguồn cùng kiểu và metadata của nó. Trả về None nếu file không tồn tại."""
+        path = source_info["path"]
+        if not os.path.exists(path):
             return None
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(
+            {"type": source_info["type"], "metadata": source_info.get("metadata", {})},
+            sort_keys=True, ensure_ascii=False
+        ).encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def _build_source_manifest(self, sources_config: list, documents: list) -> dict:
+        """Dấu vân tay từng nguồn của một kho và danh sách chunk_id mà nguồn đó sinh ra."""
+        chunk_ids_by_source = {}
+        for doc in documents:
+            chunk_ids_by_source.setdefault(doc["source_id"], []).append(doc["chunk_id"])
+        return {
+            source_info["id"]: {
+                "fingerprint": self._source_fingerprint(source_info),
+                "chunk_ids": chunk_ids_by_source.get(source_info["id"], []),
+            }
+            for source_info in sources_config
+        }
+
+    def _load_shared(self) -> dict:
+        """Nạp lớp vector dùng chung (index, bảng chunk, manifest) từ đĩa nếu chưa nạp."""
+        if self._shared is not None:
+            return self._shared
 
-        documents = self._load_and_process_sources(sources_config)
-        if not documents:
-            logger.warning(f"Không có tài liệu nào để index cho kho '{store_name}'.")
+        shared = {
+            "index": None, "mmapped": False, "chunks": {},
+            "manifest": {"index_config": self._get_index_config(), "stores": {}},
+        }
+        index_path, chunks_path, manifest_path = self._get_shared_paths()
+        if os.path.exists(index_path) and os.path.exists(chunks_path) and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                if manifest.get("index_config") != self._get_index_config():
+                    logger.info("Cấu hình index dùng chung đã thay đổi. Sẽ xây dựng lại toàn bộ.")
+                else:
+                    with open(chunks_path, 'r', encoding='utf-8') as f:
+                        chunks = {int(chunk_id): content for chunk_id, content in json.load(f).items()}
+                    index = self._read_index(index_path)
+                    if index.ntotal != len(chunks) or manifest.get("num_chunks", len(chunks)) != len(chunks):
+                        raise ValueError(f"index ({index.ntotal}), bảng chunk ({len(chunks)}) và manifest không khớp nhau")
+                    shared = {"index": index, "mmapped": True, "chunks": chunks, "manifest": manifest}
+                    logger.info(f"Đã tải lớp vector dùng chung với {index.ntotal} chunk duy nhất.")
+            except Exception as e:
+                logger.warning(f"Lỗi khi tải lớp vector dùng chung từ cache: {e}. Sẽ xây dựng lại.")
+
+        self._shared = shared
+        return shared
+
+    def _read_view(self, store_name: str):
+        """Đọc view của một kho từ đĩa. Trả về None nếu chưa có hoặc bị lỗi."""
+        try:
+            with open(self._get_view_path(store_name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, json.JSONDecodeError):
             return None
 
-        logger.info(f"Bắt đầu tạo embeddings cho {len(documents)} tài liệu của kho '{store_name}'...")
-        texts_to_embed = [doc['content'] for doc in documents]
-        embeddings = self.model.encode(texts_to_embed, convert_to_tensor=False, show_progress_bar=True)
-        
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.add(np.array(embeddings, dtype=np.float32))
-        logger.info(f"Xây dựng kho '{store_name}' thành công! Tổng cộng {index.ntotal} vector.")
+    def _save_view(self, store_name: str, documents: list):
+        """Lưu view của một kho (không kèm nội dung chunk, nội dung nằm trong bảng chunk dùng chung)."""
+        self._write_atomic(
+            self._get_view_path(store_name),
+            lambda path: self._dump_json(path, [self._strip_content(doc) for doc in documents]),
+        )
 
-        index_path, docs_path = self._get_store_paths(store_name)
-        self._save_index(index, documents, index_path, docs_path)
+    @staticmethod
+    def _dump_json(path: str, data):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
 
-        return {"index": index, "documents": documents}
+    @staticmethod
+    def _write_atomic(path: str, write_fn):
+        """
+        Ghi file qua file tạm trong cùng thư mục rồi `os.replace`. File cũ (có thể đang được các worker
+        memory-map) không bao giờ bị ghi đè tại chỗ: tiến trình đang map vẫn giữ inode cũ cho tới khi nạp lại.
+        """
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            write_fn(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    def get_store(self, store_name: str):
+    @staticmethod
+    def _strip_content(doc: dict) -> dict:
+        return {key: value for key, value in doc.items() if key != "content"}
+
+    def _make_view(self, documents: list) -> dict:
+        """Tạo view trong bộ nhớ của một kho: metadata theo chunk_id và bộ lọc ID cho FAISS."""
+        docs_by_id = {}
+        for doc in documents:
+            docs_by_id.setdefault(doc["chunk_id"], self._strip_content(doc))
+        ids = np.fromiter(docs_by_id.keys(), dtype=np.int64, count=len(docs_by_id))
+        return {"documents": docs_by_id, "ids": ids, "id_set": set(docs_by_id), "selector": faiss.IDSelectorBatch(ids)}
+
+    def _update_shared_index(self, shared: dict, views: dict):
+        """
+        Thêm vào index dùng chung các chunk chưa có (mỗi chunk chỉ tạo embedding một lần,
+        dù xuất hiện ở bao nhiêu kho) và xóa các chunk không còn kho nào tham chiếu.
+        """
+        referenced = {
+            chunk_id
+            for store in shared["manifest"]["stores"].values()
+            for source in store["sources"].values()
+            for chunk_id in source["chunk_ids"]
+        }
+        new_chunks = {}
+        for documents in views.values():
+            for doc in documents:
+                if "content" in doc and doc["chunk_id"] not in shared["chunks"]:
+                    new_chunks.setdefault(doc["chunk_id"], doc["content"])
+        removed_ids = [chunk_id for chunk_id in shared["chunks"] if chunk_id not in referenced]
+        if not new_chunks and not removed_ids:
+            return False
+
+        index = shared["index"]
+        if index is not None and shared["mmapped"]:
+            # Bản sao trong RAM của chính index đang map (không đọc lại file, vốn có thể đã bị worker khác thay).
+            index = faiss.deserialize_index(faiss.serialize_index(index))
+
+        if removed_ids and index is not None:
+            index.remove_ids(faiss.IDSelectorBatch(np.array(removed_ids, dtype=np.int64)))
+        for chunk_id in removed_ids:
+            del shared["chunks"][chunk_id]
+
+        if new_chunks:
+            logger.info(f"Bắt đầu tạo embeddings cho {len(new_chunks)} chunk mới...")
+            embeddings = self.model.encode(
+                list(new_chunks.values()), convert_to_tensor=False, show_progress_bar=len(new_chunks) > 100
+            )
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            if index is None:
+                index = self._create_index(embeddings)
+            index.add_with_ids(embeddings, np.fromiter(new_chunks.keys(), dtype=np.int64, count=len(new_chunks)))
+            shared["chunks"].update(new_chunks)
+
+        shared["index"], shared["mmapped"] = index, False
+        logger.info(f"Đã cập nhật lớp vector dùng chung: +{len(new_chunks)} / -{len(removed_ids)} chunk, tổng cộng {index.ntotal} chunk duy nhất.")
+        return True
+
+    def _sync_stores(self, store_names: list) -> list:
         """
-        Lấy một kho tri thức cụ thể. Tải từ cache nếu có, nếu không thì xây dựng mới.
+        Đồng bộ các kho với file nguồn. Kho còn mới được nạp lại từ view trên đĩa; kho lỗi thời
+        chỉ xử lý lại các nguồn thay đổi. Trả về danh sách tên kho đã được cập nhật.
         """
-        if store_name in self._stores:
-            return self._stores[store_name]
+        shared = self._load_shared()
+        manifest_stores = shared["manifest"]["stores"]
+        knowledge_sources = self.config.KNOWLEDGE_SOURCES
 
-        index_path, docs_path = self._get_store_paths(store_name)
+        views, updated = {}, []
+        for store_name in store_names:
+            sources_config = knowledge_sources.get(store_name)
+            if not sources_config:
+                logger.error(f"Không tìm thấy cấu hình nguồn tri thức cho kho '{store_name}'.")
+                continue
 
-        if os.path.exists(index_path) and os.path.exists(docs_path):
+            recorded = manifest_stores.get(store_name, {}).get("sources", {})
+            documents = self._read_view(store_name) if recorded else None
+            if documents is None:
+                if recorded:
+                    logger.error(f"Manifest có kho '{store_name}' nhưng không đọc được view trên đĩa. Xây dựng lại view của kho.")
+                else:
+                    logger.info(f"Không tìm thấy cache cho kho '{store_name}'. Bắt đầu xây dựng mới...")
+                changed_sources, removed_source_ids, documents = list(sources_config), set(recorded), []
+            else:
+                changed_sources = [
+                    source_info for source_info in sources_config
+                    if source_info["id"] not in recorded
+                    or recorded[source_info["id"]].get("fingerprint") != self._source_fingerprint(source_info)
+                ]
+                removed_source_ids = set(recorded) - {source_info["id"] for source_info in sources_config}
+
+            if changed_sources or removed_source_ids:
+                stale_ids = {source_info["id"] for source_info in changed_sources} | removed_source_ids
+                logger.info(f"Kho '{store_name}' cần cập nhật các nguồn: {sorted(stale_ids)}.")
+                documents = [doc for doc in documents if doc.get("source_id") not in stale_ids]
+                documents.extend(self._load_and_process_sources(changed_sources))
+                manifest_stores[store_name] = {"sources": self._build_source_manifest(sources_config, documents)}
+                updated.append(store_name)
+            views[store_name] = documents
+
+        for store_name in set(manifest_stores) - set(knowledge_sources):
+            del manifest_stores[store_name]
+
+        if self._update_shared_index(shared, views) or updated:
+            self._bm25 = None
+            shared["manifest"]["index_config"] = self._get_index_config()
             try:
-                logger.info(f"Đang tải kho '{store_name}' từ cache...")
-                index = faiss.read_index(index_path)
-                with open(docs_path, 'r', encoding='utf-8') as f:
-                    documents = json.load(f)
-                logger.info(f"Tải thành công kho '{store_name}' với {index.ntotal} vector.")
-                
-                store_instance = {"index": index, "documents": documents}
-                self._stores[store_name] = store_instance
-                return store_instance
-            except Exception as e:
-                logger.warning(f"Lỗi khi tải kho '{store_name}' từ cache: {e}. Sẽ xây dựng lại.")
+                os.makedirs(self.config.VECTOR_STORE_DIR, exist_ok=True)
+                for store_name in updated:
+                    self._save_view(store_name, views[store_name])
+            except OSError as e:
+                # Không ghi manifest mới khi view chưa lưu được: trên đĩa vẫn là trạng thái nhất quán trước đó.
+                logger.error(f"Lỗi khi lưu view của kho tri thức: {e}. Bỏ qua lưu lớp vector dùng chung.")
+            else:
+                if shared["index"] is not None and self._save_shared(shared):
+                    # Chỉ nạp lại qua mmap SAU khi file mới đã thay file cũ, để worker không giữ bản sao riêng của index.
+                    shared["index"], shared["mmapped"] = self._read_index(self._get_shared_paths()[0]), True
+
+        for store_name, documents in views.items():
+            if not documents:
+                logger.warning(f"Không có tài liệu nào để index cho kho '{store_name}'.")
+                self._stores.pop(store_name, None)
+                continue
+            self._stores[store_name] = self._make_view(documents)
+            logger.info(f"Kho '{store_name}' sẵn sàng với {len(self._stores[store_name]['ids'])} chunk.")
+        return updated
 
-        store_instance = self._build_store(store_name)
+    def get_store(self, store_name: str):
+        """
+        Lấy view của một kho tri thức. Tải từ cache nếu có (vá nếu lỗi thời), nếu không thì xây dựng mới.
+        """
+        store_instance = self._stores.get(store_name)
         if store_instance:
-            self._stores[store_name] = store_instance
-        return store_instance
-    
-    def retrieve(self, store_name: str, query: str, k: int = 5) -> str:
-        """Thực hiện truy vấn trên một kho tri thức chuyên biệt."""
+            return store_instance
+
+        with self._store_lock:
+            if store_name not in self._stores:
+                self._sync_stores([store_name])
+            return self._stores.get(store_name)
+
+    def load_stores(self, store_names: list):
+        """
+        Tải (hoặc vá/xây dựng) nhiều kho trong một lượt. Chunk dùng chung giữa các kho
+        (ví dụ 'blast' và 'general_qa') chỉ được tạo embedding và lưu một lần.
+        """
+        with self._store_lock:
+            self._sync_stores([store_name for store_name in store_names if store_name not in self._stores])
+
+    def refresh_stale_stores(self) -> list:
+        """
+        Kiểm tra lại các kho đang được nạp với file nguồn hiện tại và vá những kho đã lỗi thời.
+        Trả về danh sách tên kho đã được cập nhật.
+        """
+        with self._store_lock:
+            return self._sync_stores(list(self._stores))
+
+    def _normalize_query(self, query: str) -> str:
+        """Chuẩn hóa câu truy vấn (Unicode NFC, gộp khoảng trắng) để làm khóa cache."""
+        return " ".join(unicodedata.normalize("NFC", query).split())
+
+    def _encode_queries(self, queries: list) -> np.ndarray:
+        """
+        Tạo embedding cho danh sách câu truy vấn, dùng cache LRU theo nội dung đã chuẩn hóa.
+        Các câu chưa có trong cache được encode chung trong MỘT lượt forward.
+        """
+        normalized = [self._normalize_query(q) for q in queries]
+        vectors = {}
+        missing = []
+        with self._query_cache_lock:
+            for text in normalized:
+                if text in vectors:
+                    continue
+                cached = self._query_cache.get(text)
+                if cached is not None:
+                    self._query_cache.move_to_end(text)
+                    vectors[text] = cached
+                    self.query_cache_hits += 1
+                elif text not in missing:
+                    missing.append(text)
+                    self.query_cache_misses += 1
+
+        if missing:
+            embeddings = self.model.encode(missing, convert_to_numpy=True, show_progress_bar=False)
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            with self._query_cache_lock:
+                for text, vector in zip(missing, embeddings):
+                    vectors[text] = vector
+                    self._query_cache[text] = vector
+                    self._query_cache.move_to_end(text)
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+
+        return np.stack([vectors[text] for text in normalized]).astype(np.float32, copy=False)
+
+    def embed_texts(self, texts: list) -> np.ndarray:
+        """Embedding (float32) của danh sách câu ngắn, dùng chung model và cache với truy vấn tri thức."""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._encode_queries(texts)
+
+    def get_query_cache_stats(self) -> dict:
+        """Trả về thống kê hit/miss của cache embedding truy vấn."""
+        with self._query_cache_lock:
+            total = self.query_cache_hits + self.query_cache_misses
+            return {
+                "size": len(self._query_cache),
+                "capacity": self.query_cache_size,
+                "hits": self.query_cache_hits,
+                "misses": self.query_cache_misses,
+                "hit_rate": round(self.query_cache_hits / total, 4) if total else 0.0,
+            }
+
+    def _get_bm25_index(self) -> BM25Index:
+        """Chỉ mục BM25 trên bảng chunk dùng chung, được xây dựng lại khi bảng chunk thay đổi."""
+        with self._bm25_lock:
+            if self._bm25 is None:
+                self._bm25 = BM25Index().build(self._shared["chunks"])
+                logger.info(f"Đã xây dựng chỉ mục BM25 với {len(self._bm25.postings)} term.")
+            return self._bm25
+
+    @staticmethod
+    def _filter_ids(store: dict, filters: dict = None) -> set:
+        """
+        Lọc trước các chunk của kho theo metadata. Giá trị lọc có thể là một giá trị
+        hoặc một danh sách các giá trị được chấp nhận, ví dụ {"sub_topic": ["Phòng trừ Đạo ôn"]}.
+        """
+        if not filters:
+            return store["id_set"]
+
+        def matches(doc):
+            for field, expected in filters.items():
+                value = doc.get(field)
+                if isinstance(expected, (list, tuple, set)):
+                    if value not in expected:
+                        return False
+                elif value != expected:
+                    return False
+            return True
+
+        return {chunk_id for chunk_id, doc in store["documents"].items() if matches(doc)}
+
+    def _fuse_hits(self, store: dict, vector_hits: list, bm25_hits: list, k: int, hybrid_config: dict) -> list:
+        """Hợp nhất hai danh sách xếp hạng bằng Reciprocal Rank Fusion và trả về hit có cấu trúc."""
+        rrf_k = hybrid_config["rrf_k"]
+        fused = {}
+        for rank, (chunk_id, distance) in enumerate(vector_hits):
+            entry = fused.setdefault(chunk_id, {"score": 0.0, "vector_score": None, "bm25_score": None})
+            entry["score"] += hybrid_config["vector_weight"] / (rrf_k + rank + 1)
+            entry["vector_score"] = round(1.0 / (1.0 + distance), 6)
+        for rank, (chunk_id, bm25_score) in enumerate(bm25_hits):
+            entry = fused.setdefault(chunk_id, {"score": 0.0, "vector_score": None, "bm25_score": None})
+            entry["score"] += hybrid_config["bm25_weight"] / (rrf_k + rank + 1)
+            entry["bm25_score"] = round(bm25_score, 4)
+
+        chunks = self._shared["chunks"]
+        ranked = sorted(fused.items(), key=lambda item: item[1]["score"], reverse=True)[:k]
+        return [
+            {
+                "chunk_id": chunk_id,
+                "content": chunks[chunk_id],
+                "score": round(entry["score"], 6),
+                "vector_score": entry["vector_score"],
+                "bm25_score": entry["bm25_score"],
+                "metadata": {key: value for key, value in store["documents"][chunk_id].items() if key != "chunk_id"},
+            }
+            for chunk_id, entry in ranked
+        ]
+
+    def search(self, store_name: str, query: str, k: int = 5, filters: dict = None) -> list:
+        """Truy vấn lai trên một kho, trả về danh sách hit có cấu trúc (xem `search_many`)."""
+        results = self.search_many(store_name, [query], k=k, filters=filters)
+        return results[0] if results else []
+
+    def search_many(self, store_name: str, queries: list, k: int = 5, filters: dict = None):
+        """
+        Truy vấn lai trên một kho: lọc trước theo metadata, lấy ứng viên từ FAISS (một lần gọi
+        cho cả lô câu truy vấn) và từ BM25, rồi hợp nhất bằng Reciprocal Rank Fusion.
+        Với mỗi câu truy vấn trả về danh sách hit
+        {"chunk_id", "content", "score", "vector_score", "bm25_score", "metadata"}.
+        Trả về None nếu kho không khả dụng.
+        """
         store = self.get_store(store_name)
-        if not store or store.get("index") is None:
-            logger.error(f"Truy vấn thất bại: Kho tri thức '{store_name}' chưa được khởi tạo.")
-            return f"Lỗi: Cơ sở tri thức '{store_name}' không khả dụng."
+        shared = self._shared
+        if not store or not shared or shared["index"] is None:
+            return None
+        if not queries:
+            return []
+
+        allowed_ids = self._filter_ids(store, filters)
+        if not allowed_ids:
+            return [[] for _ in queries]
+
+        hybrid_config = {
+            "vector_weight": 1.0, "bm25_weight": 1.0, "rrf_k": 60, "candidate_multiplier": 4,
+            **getattr(self.config, "HYBRID_RETRIEVAL", {}),
+        }
+        depth = max(k, k * hybrid_config["candidate_multiplier"])
+        if filters:
+            selector = faiss.IDSelectorBatch(np.fromiter(allowed_ids, dtype=np.int64, count=len(allowed_ids)))
+        else:
+            selector = store["selector"]
+
+        index = shared["index"]
+        query_embeddings = self._encode_queries(queries)
+        distances, indices = index.search(query_embeddings, depth, params=self._search_params(index, selector, len(allowed_ids)))
+        bm25_index = self._get_bm25_index() if hybrid_config["bm25_weight"] > 0 else None
+
+        results = []
+        for query, distance_row, id_row in zip(queries, distances, indices):
+            vector_hits = [
+                (int(chunk_id), float(distance))
+                for chunk_id, distance in zip(id_row, distance_row)
+                if chunk_id in allowed_ids
+            ]
+            bm25_hits = bm25_index.search(query, depth, allowed_ids) if bm25_index else []
+            results.append(self._fuse_hits(store, vector_hits, bm25_hits, k, hybrid_config))
+        return results
+
+    def retrieve(self, store_name: str, query: str, k: int = 5, filters: dict = None) -> str:
+        """Thực hiện truy vấn trên một kho tri thức chuyên biệt, trả về ngữ cảnh dạng chuỗi."""
+        return self.retrieve_many(store_name, [query], k=k, filters=filters)[0]
+
+    def retrieve_many(self, store_name: str, queries: list, k: int = 5, filters: dict = None) -> list:
+        """
+        Thực hiện nhiều truy vấn cùng lúc trên một kho tri thức.
+        Toàn bộ câu truy vấn được encode theo lô và tìm kiếm bằng một lần gọi FAISS.
+        Trả về danh sách ngữ cảnh theo đúng thứ tự của `queries`.
+        """
+        if not queries:
+            return []
 
-        index = store["index"]
-        documents = store["documents"]
-        
-        query_embedding = self.model.encode([query])
-        
         try:
-            _, indices = index.search(np.array(query_embedding, dtype=np.float32), k)
-            retrieved_docs = [documents[i] for i in indices[0]]
-            context = "\n---\n".join([doc['content'] for doc in retrieved_docs])
-            
-            logger.info(f"Đã truy xuất {len(retrieved_docs)} đoạn văn bản từ kho '{store_name}' cho câu hỏi: '{query[:50]}...'")
-            return context
+            results = self.search_many(store_name, queries, k=k, filters=filters)
         except Exception as e:
             logger.error(f"Lỗi trong quá trình truy xuất từ kho '{store_name}': {e}")
-            return "Lỗi: Đã xảy ra sự cố khi tìm kiếm thông tin."
+            return ["Lỗi: Đã xảy ra sự cố khi tìm kiếm thông tin."] * len(queries)
+
+        if results is None:
+            logger.error(f"Truy vấn thất bại: Kho tri thức '{store_name}' chưa được khởi tạo.")
+            return [f"Lỗi: Cơ sở tri thức '{store_name}' không khả dụng."] * len(queries)
 
-    def _save_index(self, index, documents, index_path, docs_path):
-        logger.info(f"Đang lưu index và documents vào: {os.path.dirname(index_path)}")
+        contexts = []
+        for query, hits in zip(queries, results):
+            contexts.append("\n---\n".join([hit["content"] for hit in hits]))
+            logger.info(f"Đã truy xuất {len(hits)} đoạn văn bản từ kho '{store_name}' cho câu hỏi: '{query[:50]}...'")
+        return contexts
+
+    def _save_shared(self, shared: dict) -> bool:
+        """
+        Lưu index, bảng chunk và manifest dùng chung. Mỗi file được ghi ra file tạm rồi `os.replace`
+        (manifest sau cùng), nên index đang được memory-map không bao giờ bị ghi đè tại chỗ. Manifest ghi kèm
+        số chunk để lần nạp sau phát hiện bộ ba file lệch nhau (nếu tiến trình dừng giữa các lần thay file).
+        """
+        index_path, chunks_path, manifest_path = self._get_shared_paths()
+        logger.info(f"Đang lưu lớp vector dùng chung vào: {os.path.dirname(index_path)}")
         try:
             os.makedirs(os.path.dirname(index_path), exist_ok=True)
-            faiss.write_index(index, index_path)
-            with open(docs_path, 'w', encoding='utf-8') as f:
-                json.dump(documents, f, ensure_ascii=False, indent=2)
+            shared["manifest"]["num_chunks"] = len(shared["chunks"])
+            self._write_atomic(index_path, lambda path: faiss.write_index(shared["index"], path))
+            self._write_atomic(chunks_path, lambda path: self._dump_json(
+                path, {str(chunk_id): content for chunk_id, content in shared["chunks"].items()}))
+            self._write_atomic(manifest_path, lambda path: self._dump_json(path, shared["manifest"]))
+            return True
         except Exception as e:
             logger.error(f"Lỗi khi lưu vector store: {e}")
+            return False
 
     def _load_and_process_sources(self, sources_config):
         all_documents = []
         for source_info in sources_config:
-            path = source_info["path"]
-            if not os.path.exists(path):
-                logger.warning(f"Không tìm thấy file nguồn: {path}")
-                continue
-            try:
-                with open(path, 'r', encoding='utf-8') as f:
-                    source_type = source_info["type"]
-                    metadata = source_info.get("metadata", {})
-                    if source_type == "json":
-                        data = json.load(f)
-                        for key, value in data.items():
-                            content = self._flatten_json_to_text(value, f"{metadata.get('topic', '')} {key}".strip())
-                            for chunk in self._chunk_text(content):
-                                doc = {"content": chunk, "source": os.path.basename(path), **metadata}
-                                if "sub_topic_key" in metadata:
-                                    doc[metadata["sub_topic_key"]] = key
-                                all_documents.append(doc)
-                    elif source_type == "txt":
-                        text_content = f.read()
-                        for chunk in self._chunk_text(text_content):
-                            all_documents.append({"content": chunk, "source": os.path.basename(path), **metadata})
-                logger.info(f"Đã xử lý thành công nguồn: {source_info['id']}")
-            except Exception as e:
-                logger.error(f"Không thể xử lý file {path}: {e}")
+            all_documents.extend(self._process_source(source_info))
         return all_documents
 
+    def _process_source(self, source_info: dict) -> list:
+        """Đọc và chia chunk một file nguồn. Mỗi tài liệu mang theo `source_id` và `chunk_id`."""
+        documents = []
+        path = source_info["path"]
+        if not os.path.exists(path):
+            logger.warning(f"Không tìm thấy file nguồn: {path}")
+            return documents
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                source_type = source_info["type"]
+                metadata = source_info.get("metadata", {})
+                base_doc = {"source": os.path.basename(path), "source_id": source_info["id"], **metadata}
+                if source_type == "json":
+                    data = json.load(f)
+                    for key, value in data.items():
+                        content = self._flatten_json_to_text(value, f"{metadata.get('topic', '')} {key}".strip())
+                        for chunk in self._chunk_text(content):
+                            doc = {"content": chunk, "chunk_id": self._chunk_id(chunk), **base_doc}
+                            if "sub_topic_key" in metadata:
+                                doc[metadata["sub_topic_key"]] = key
+                            documents.append(doc)
+                elif source_type == "txt":
+                    text_content = f.read()
+                    for chunk in self._chunk_text(text_content):
+                        documents.append({"content": chunk, "chunk_id": self._chunk_id(chunk), **base_doc})
+            logger.info(f"Đã xử lý thành công nguồn: {source_info['id']}")
+        except Exception as e:
+            logger.error(f"Không thể xử lý file {path}: {e}")
+        return documents
+
     def _chunk_text(self, text, chunk_size=1000, overlap=200):
         sentences = re.split(r'(?<=[.!?])\s+', text.replace('\n', ' '))
         chunks = []
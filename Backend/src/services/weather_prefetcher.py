@@ -0,0 +1,52 @@
+import time
+import threading
+from datetime import datetime
+
+from src.logging.logger import logger
+
+class WeatherPrefetcher:
+    """
+    Làm mới chủ động dự báo thời tiết cho các tỉnh đang có nông hộ bật giám sát.
+    Mỗi lần chạy (job APScheduler), các tỉnh có cache sắp hết hạn trong `lead_minutes` được đưa vào hàng đợi
+    làm mới nền của WeatherService; luồng nền đó crawl lần lượt từng tỉnh với khoảng nghỉ giữa các lần,
+    nên tốc độ crawl trên toàn bộ các tỉnh luôn bị giới hạn. Nhờ vậy request của người dùng gần như luôn trúng cache.
+    """
+    def __init__(self, app, weather_service, user_repo, config):
+        prefetch_config = {"enabled": True, "interval_seconds": 300, "lead_minutes": 30, **getattr(config, "WEATHER_PREFETCH", {})}
+        self.app = app
+        self.weather_service = weather_service
+        self.user_repo = user_repo
+        self.enabled = prefetch_config["enabled"]
+        self.interval_seconds = prefetch_config["interval_seconds"]
+        self.lead_hours = prefetch_config["lead_minutes"] / 60.0
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "errors": 0, "queued": 0, "last_run_at": None, "last_run_seconds": 0.0, "provinces": 0}
+
+    def run(self):
+        """Được APScheduler gọi định kỳ; chỉ xếp hàng các tỉnh cần làm mới nên trả về rất nhanh."""
+        if not self.enabled:
+            return
+        started = time.monotonic()
+        try:
+            with self.app.app_context():
+                provinces = self.user_repo.get_monitored_provinces()
+            queued = [province for province in provinces
+                      if self.weather_service.needs_refresh(province, self.lead_hours)
+                      and self.weather_service.refresh(province, self.lead_hours)]
+            if queued:
+                logger.info(f"[PREFETCH] Xếp hàng làm mới thời tiết cho {len(queued)}/{len(provinces)} tỉnh: {queued}")
+            with self._lock:
+                self._stats["provinces"] = len(provinces)
+                self._stats["queued"] += len(queued)
+        except Exception as e:
+            logger.error(f"[PREFETCH] Lỗi khi lên danh sách tỉnh cần làm mới thời tiết: {e}")
+            with self._lock:
+                self._stats["errors"] += 1
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["last_run_at"] = datetime.now().isoformat()
+            self._stats["last_run_seconds"] = round(time.monotonic() - started, 4)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "enabled": self.enabled, "lead_minutes": round(self.lead_hours * 60)}
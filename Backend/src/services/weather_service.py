@@ -1,23 +1,42 @@
 import requests
 import os
 import time
+import queue
+import threading
+from concurrent.futures import Future
 from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
+from datetime import datetime
 import json
+import sqlite3
 import unidecode
 import random
 from src.utils.config import CONFIG
+from src.utils.sqlite import connect_sqlite
+from src.services.forecast_frame import ForecastFrame
 from src.logging.logger import logger
 
 class WeatherService:
     """
     Dịch vụ chịu trách nhiệm lấy và cache dữ liệu thời tiết.
+    - Single-flight: nhiều yêu cầu cùng lúc cho một tỉnh chưa có cache chỉ tạo ra MỘT lần crawl.
+    - Stale-while-revalidate: cache hết hạn (nhưng chưa quá `stale_max_hours`) được trả về ngay,
+      việc làm mới được đưa vào hàng đợi nền.
+    - Khoảng nghỉ lịch sự giữa các lần crawl do luồng làm mới nền đảm nhận, không chặn luồng xử lý request.
+    - Cache lưu theo từng tỉnh trong SQLite (mỗi lần crawl chỉ ghi một dòng), nạp lười vào bộ nhớ khi cần
+      và đọc lại từ đĩa khi bản trong bộ nhớ hết hạn, nên các worker gunicorn dùng chung cache của nhau.
     """
-    def __init__(self):
-        self.cache_path = CONFIG.WEATHER_CACHE_PATH
+    def __init__(self, base_url: str = None, service_config: dict = None):
+        service_config = {**getattr(CONFIG, "WEATHER_SERVICE", {}), **(service_config or {})}
+        self.legacy_cache_path = CONFIG.WEATHER_CACHE_PATH
+        self.cache_path = service_config.get("cache_path") or f"{os.path.splitext(self.legacy_cache_path)[0]}.sqlite3"
+        self.evict_after_hours = service_config.get("evict_after_hours", 168)
         self.cache_duration_hours = CONFIG.WEATHER_CACHE_DURATION_HOURS
-        
-        self.base_url = "https://baomoi.com/tien-ich/thoi-tiet-"
+        self.stale_max_hours = service_config.get("stale_max_hours", 48)
+        self.politeness_delay_seconds = tuple(service_config.get("politeness_delay_seconds", (2, 5)))
+        self.request_timeout_seconds = service_config.get("request_timeout_seconds", 15)
+        self.fetch_wait_seconds = service_config.get("fetch_wait_seconds", 30)
+
+        self.base_url = base_url or service_config.get("base_url") or "https://baomoi.com/tien-ich/thoi-tiet-"
         self.user_agents = [
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
             'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
@@ -25,28 +44,113 @@ class WeatherService:
             'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
         ]
         
-        self.weather_cache = self._load_cache_from_disk()
+        self.weather_cache = {}
+        self._cache_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "crawls": 0, "crawl_failures": 0, "refreshes": 0,
+                       "frame_hits": 0, "frame_builds": 0}
+        self._crawl_latency = {"total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0}
+        self._last_failures = {}
+        self._frames = {}
+        self._frames_lock = threading.Lock()
+        self._last_eviction = 0.0
 
-    def _load_cache_from_disk(self):
-        """Tải dữ liệu cache từ file JSON trên đĩa."""
-        if os.path.exists(self.cache_path):
-            try:
-                with open(self.cache_path, 'r', encoding='utf-8') as f:
-                    logger.info(f"Đã tải cache thời tiết từ: {self.cache_path}")
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.warning(f"Lỗi đọc file cache thời tiết: {e}. Bắt đầu với cache rỗng.")
-                return {}
-        return {}
-
-    def _save_cache_to_disk(self):
-        """Lưu dữ liệu cache hiện tại vào file JSON."""
+        self._connection = connect_sqlite(self.cache_path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS weather_cache ("
+            "province TEXT PRIMARY KEY, cache_time TEXT NOT NULL, fetched_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        self._connection.commit()
+        self._migrate_legacy_cache()
+        self.evict_expired()
+
+        self._refresh_queue = queue.Queue()
+        self._queued_provinces = set()
+        self._refresh_worker = threading.Thread(target=self._refresh_loop, name="weather-refresh", daemon=True)
+        self._refresh_worker.start()
+
+    def _migrate_legacy_cache(self):
+        """Chuyển file cache JSON cũ (mọi tỉnh trong một file) sang SQLite, rồi đổi tên file cũ."""
+        if not os.path.exists(self.legacy_cache_path):
+            return
+        try:
+            with open(self.legacy_cache_path, 'r', encoding='utf-8') as f:
+                legacy_cache = json.load(f)
+            migrated = 0
+            for province, cache_entry in legacy_cache.items():
+                if isinstance(cache_entry, dict) and cache_entry.get('cache_time') and cache_entry.get('data'):
+                    self._write_entry(province, cache_entry)
+                    migrated += 1
+            os.replace(self.legacy_cache_path, f"{self.legacy_cache_path}.migrated")
+            logger.info(f"Đã chuyển cache thời tiết của {migrated} tỉnh từ {self.legacy_cache_path} sang SQLite.")
+        except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+            logger.warning(f"Không thể chuyển file cache thời tiết cũ {self.legacy_cache_path}: {e}")
+
+    def _read_entry(self, province: str):
+        """
+        Đọc cache của MỘT tỉnh từ SQLite vào bộ nhớ (nạp lười). Bản ghi có thể do worker khác vừa crawl,
+        nên chỉ thay bản trong bộ nhớ khi bản trên đĩa mới hơn.
+        """
+        try:
+            with self._db_lock:
+                row = self._connection.execute(
+                    "SELECT cache_time, fetched_at, data FROM weather_cache WHERE province = ?", (province,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Lỗi khi đọc cache thời tiết của {province}: {e}")
+            return None
+        if row is None:
+            return None
+        with self._cache_lock:
+            current = self.weather_cache.get(province)
+            if current is not None and current['fetched_at'] >= row['fetched_at']:
+                return current
+            cache_entry = {'cache_time': row['cache_time'], 'fetched_at': row['fetched_at'], 'data': json.loads(row['data'])}
+            self.weather_cache[province] = cache_entry
+        return cache_entry
+
+    def _write_entry(self, province: str, cache_entry: dict):
+        """Ghi cache của MỘT tỉnh; không ghi đè bản mới hơn do worker khác ghi trước."""
+        fetched_at = cache_entry.get('fetched_at') or datetime.fromisoformat(cache_entry['cache_time']).timestamp()
         try:
-            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
-            with open(self.cache_path, 'w', encoding='utf-8') as f:
-                json.dump(self.weather_cache, f, ensure_ascii=False, indent=4)
-        except IOError as e:
-            logger.error(f"Lỗi khi lưu cache thời tiết ra file: {e}")
+            with self._db_lock:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT INTO weather_cache (province, cache_time, fetched_at, data) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(province) DO UPDATE SET cache_time = excluded.cache_time, "
+                        "fetched_at = excluded.fetched_at, data = excluded.data "
+                        "WHERE excluded.fetched_at > weather_cache.fetched_at",
+                        (province, cache_entry['cache_time'], fetched_at, json.dumps(cache_entry['data'], ensure_ascii=False)),
+                    )
+        except sqlite3.Error as e:
+            logger.error(f"Lỗi khi lưu cache thời tiết của {province}: {e}")
+        if time.time() - self._last_eviction >= 3600:
+            self.evict_expired()
+
+    def evict_expired(self) -> int:
+        """Xóa cache của các tỉnh đã lấy về quá `evict_after_hours` (trên đĩa và trong bộ nhớ)."""
+        self._last_eviction = time.time()
+        cutoff = self._last_eviction - self.evict_after_hours * 3600
+        try:
+            with self._db_lock:
+                with self._connection:
+                    deleted = self._connection.execute("DELETE FROM weather_cache WHERE fetched_at < ?", (cutoff,)).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Lỗi khi dọn cache thời tiết: {e}")
+            return 0
+        with self._cache_lock:
+            expired = [province for province, cache_entry in self.weather_cache.items() if cache_entry['fetched_at'] < cutoff]
+            for province in expired:
+                del self.weather_cache[province]
+        with self._frames_lock:
+            for province in expired:
+                self._frames.pop(province, None)
+        if deleted:
+            logger.info(f"Đã xóa cache thời tiết của {deleted} tỉnh cũ hơn {self.evict_after_hours} giờ.")
+        return deleted
 
     def _format_province_for_url(self, province: str) -> str:
         """Chuyển đổi tên tỉnh thành định dạng cho URL."""
@@ -60,7 +164,7 @@ class WeatherService:
         logger.info(f"CACHE MISS: Đang lấy dữ liệu thời tiết từ: {url}...")
         try:
             headers = {'User-Agent': random.choice(self.user_agents)}
-            response = requests.get(url, headers=headers, timeout=15)
+            response = requests.get(url, headers=headers, timeout=self.request_timeout_seconds)
             response.raise_for_status()
             
             soup = BeautifulSoup(response.text, 'html.parser')
@@ -90,30 +194,192 @@ class WeatherService:
             logger.error(f"Lỗi không xác định khi crawl dữ liệu thời tiết cho {province}: {e}")
             return None
 
+    def _record(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _lookup(self, province: str):
+        """
+        Cache của tỉnh ({'cache_time', 'fetched_at', 'data'}) hoặc None. Bản trong bộ nhớ còn hạn được dùng ngay;
+        nếu chưa có hoặc đã hết hạn thì đọc lại từ SQLite (có thể worker khác đã crawl dữ liệu mới hơn).
+        """
+        with self._cache_lock:
+            cache_entry = self.weather_cache.get(province)
+        if cache_entry is None or time.time() - cache_entry['fetched_at'] >= self.cache_duration_hours * 3600:
+            cache_entry = self._read_entry(province) or cache_entry
+        return cache_entry
+
+    def _get_cache_entry(self, province: str):
+        """Trả về (dữ liệu, tuổi của cache tính bằng giờ) hoặc (None, None) nếu chưa có cache."""
+        cache_entry = self._lookup(province)
+        if not cache_entry or not cache_entry.get('data'):
+            return None, None
+        return cache_entry['data'], (time.time() - cache_entry['fetched_at']) / 3600
+
+    def get_cache_time(self, province: str):
+        """
+        Thời điểm dữ liệu dự báo đang dùng cho tỉnh được lấy về (chuỗi ISO), đóng vai trò phiên bản dự báo.
+        Trả về None nếu chưa có cache hoặc cache đã hết hạn (lần gọi get_forecast tới sẽ lấy dữ liệu mới).
+        """
+        cache_entry = self._lookup(province)
+        if not cache_entry or time.time() - cache_entry['fetched_at'] >= self.cache_duration_hours * 3600:
+            return None
+        return cache_entry['cache_time']
+
+    def _fetch(self, province: str, wait: bool = True, newer_than: float = None):
+        """
+        Crawl dữ liệu mới cho tỉnh theo cơ chế single-flight: nếu đã có lần crawl đang chạy cho tỉnh này
+        thì chờ kết quả của lần đó thay vì crawl thêm. Trả về dữ liệu mới hoặc None nếu thất bại.
+        `newer_than` (epoch giây): nếu cache đã có dữ liệu lấy sau thời điểm này (lần crawl khác vừa xong
+        giữa lúc người gọi thấy cache miss và lúc vào đây) thì dùng luôn dữ liệu đó, không crawl lại.
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(province)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._inflight[province] = future
+
+        if not is_leader:
+            self._record("coalesced")
+            if not wait:
+                return None
+            try:
+                return future.result(timeout=self.fetch_wait_seconds)
+            except Exception:
+                return None
+
+        fresh_data = None
+        try:
+            if newer_than is not None:
+                cache_entry = self._lookup(province)
+                if cache_entry and cache_entry.get('data') and cache_entry['fetched_at'] >= newer_than:
+                    self._record("coalesced")
+                    fresh_data = cache_entry['data']
+                    return fresh_data
+            self._record("crawls")
+            started = time.monotonic()
+            fresh_data = self._crawl_weather_data(province)
+            elapsed = time.monotonic() - started
+            with self._stats_lock:
+                self._crawl_latency["total_seconds"] += elapsed
+                self._crawl_latency["max_seconds"] = max(self._crawl_latency["max_seconds"], elapsed)
+                self._crawl_latency["last_seconds"] = elapsed
+                if fresh_data:
+                    self._last_failures.pop(province, None)
+                else:
+                    self._stats["crawl_failures"] += 1
+                    self._last_failures[province] = datetime.now().isoformat()
+            if fresh_data:
+                fetched_at = datetime.now()
+                cache_entry = {'cache_time': fetched_at.isoformat(), 'fetched_at': fetched_at.timestamp(), 'data': fresh_data}
+                with self._cache_lock:
+                    self.weather_cache[province] = cache_entry
+                self._write_entry(province, cache_entry)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(province, None)
+            future.set_result(fresh_data)
+        return fresh_data
+
+    def needs_refresh(self, province: str, lead_hours: float = 0.0) -> bool:
+        """True nếu tỉnh chưa có cache hoặc cache sẽ hết hạn trong vòng `lead_hours` giờ tới."""
+        _, age_hours = self._get_cache_entry(province)
+        return age_hours is None or age_hours >= self.cache_duration_hours - lead_hours
+
+    def refresh(self, province: str, lead_hours: float = 0.0) -> bool:
+        """
+        Đưa tỉnh vào hàng đợi làm mới nền (bỏ qua nếu tỉnh đã có trong hàng đợi).
+        `lead_hours` > 0 cho phép làm mới trước khi cache hết hạn (dùng cho prefetch).
+        """
+        with self._inflight_lock:
+            if province in self._queued_provinces:
+                return False
+            self._queued_provinces.add(province)
+        self._refresh_queue.put((province, lead_hours))
+        return True
+
+    def _refresh_loop(self):
+        """Luồng nền làm mới cache lần lượt từng tỉnh, nghỉ một khoảng ngẫu nhiên giữa các lần crawl."""
+        while True:
+            province, lead_hours = self._refresh_queue.get()
+            with self._inflight_lock:
+                self._queued_provinces.discard(province)
+            if not self.needs_refresh(province, lead_hours):
+                continue
+            try:
+                self._record("refreshes")
+                self._fetch(province, wait=False)
+            except Exception as e:
+                logger.error(f"Lỗi khi làm mới nền dữ liệu thời tiết cho {province}: {e}")
+            delay = random.uniform(*self.politeness_delay_seconds)
+            logger.info(f"Đã làm mới thời tiết cho {province}, tạm dừng {delay:.2f} giây trước lần crawl kế tiếp...")
+            time.sleep(delay)
+
     def get_forecast(self, province: str):
-        """Lấy dữ liệu dự báo, ưu tiên từ cache."""
-        now = datetime.now()
-        
-        if province in self.weather_cache:
-            cache_entry = self.weather_cache.get(province, {})
-            cache_time_str = cache_entry.get('cache_time')
-            if cache_time_str:
-                cache_time = datetime.fromisoformat(cache_time_str)
-                if now - cache_time < timedelta(hours=self.cache_duration_hours):
-                    logger.info(f"CACHE HIT: Sử dụng dữ liệu thời tiết đã cache cho {province}.")
-                    return cache_entry.get('data')
-
-        fresh_data = self._crawl_weather_data(province)
-        
+        """Lấy dữ liệu dự báo, ưu tiên từ cache (kể cả cache hết hạn chưa lâu, khi đó làm mới ở nền)."""
+        looked_up_at = time.time()
+        cached_data, age_hours = self._get_cache_entry(province)
+
+        if cached_data is not None and age_hours < self.cache_duration_hours:
+            self._record("hits")
+            logger.info(f"CACHE HIT: Sử dụng dữ liệu thời tiết đã cache cho {province}.")
+            return cached_data
+
+        if cached_data is not None and age_hours < self.stale_max_hours:
+            self._record("stale_hits")
+            logger.info(f"CACHE STALE: Dùng tạm dữ liệu thời tiết cũ ({age_hours:.1f} giờ) cho {province}, làm mới ở nền.")
+            self.refresh(province)
+            return cached_data
+
+        self._record("misses")
+        fresh_data = self._fetch(province, newer_than=looked_up_at)
         if fresh_data:
-            self.weather_cache[province] = {'cache_time': now.isoformat(), 'data': fresh_data}
-            self._save_cache_to_disk()
-            
-            delay = random.uniform(2, 5)
-            logger.info(f"Đã crawl xong, tạm dừng {delay:.2f} giây...")
-            time.sleep(delay)
-            
             return fresh_data
-        
+
         logger.warning(f"Crawl dữ liệu mới cho {province} thất bại. Sử dụng dữ liệu cũ trong cache (nếu có).")
-        return self.weather_cache.get(province, {}).get('data')
+        return cached_data
+
+    def get_forecast_frame(self, province: str):
+        """
+        Dự báo của tỉnh dưới dạng ForecastFrame đã phân tích sẵn, dùng chung cho mọi lời gọi cùng (tỉnh, cache_time):
+        chỉ phân tích lại khi dữ liệu trong cache được làm mới. Trả về None nếu không có dữ liệu.
+        """
+        hourly_forecast = self.get_forecast(province)
+        if not hourly_forecast:
+            return None
+        cache_entry = self._lookup(province) or {}
+        # Dữ liệu vừa crawl nhưng không vào được cache (hoặc cache vừa bị thay) thì không có phiên bản để dùng chung.
+        cache_time = cache_entry.get('cache_time') if cache_entry.get('data') is hourly_forecast else None
+        if cache_time is None:
+            self._record("frame_builds")
+            return ForecastFrame(hourly_forecast, province=province)
+
+        with self._frames_lock:
+            frame = self._frames.get(province)
+        if frame is not None and frame.cache_time == cache_time:
+            self._record("frame_hits")
+            return frame
+        self._record("frame_builds")
+        frame = ForecastFrame(hourly_forecast, province=province, cache_time=cache_time)
+        with self._frames_lock:
+            current = self._frames.get(province)
+            if current is None or current.cache_time <= cache_time:
+                self._frames[province] = frame
+        return frame
+
+    def get_stats(self) -> dict:
+        with self._inflight_lock:
+            inflight = len(self._inflight)
+        with self._stats_lock:
+            stats = dict(self._stats)
+            latency = dict(self._crawl_latency)
+            last_failures = dict(self._last_failures)
+        stats["crawl_latency"] = {
+            "avg_seconds": round(latency["total_seconds"] / stats["crawls"], 3) if stats["crawls"] else 0.0,
+            "max_seconds": round(latency["max_seconds"], 3),
+            "last_seconds": round(latency["last_seconds"], 3),
+        }
+        return {**stats, "inflight": inflight, "refresh_queue_depth": self._refresh_queue.qsize(),
+                "cached_provinces": len(self.weather_cache), "failing_provinces": last_failures,
+                "evict_after_hours": self.evict_after_hours}
@@ -27,10 +27,33 @@ class AppConfig:
 
     STORAGE_FOLDER = os.path.join(BASE_DIR, "data", "storage")
     IOT_FOLDER = os.path.join(BASE_DIR, "data", "clean_data")
+    # Kho chuỗi thời gian cảm biến IoT (SQLite); bản đo cũ hơn retention_days bị xóa khi compact.
+    IOT_STORE = {
+        "path": os.path.join(BASE_DIR, "data", "clean_data", "iot_data", "iot_readings.sqlite3"),
+        "retention_days": 90,
+    }
+    # Thống kê trượt của cảm biến cho prompt: cửa sổ (giờ), ngưỡng độ ẩm (%) để đếm giờ độ ẩm cao,
+    # ngưỡng chênh lệch nhiệt độ - điểm sương (°C) coi là lá ướt, và thời lượng tối đa một bản đo đại diện.
+    IOT_AGGREGATES = {
+        "windows_hours": (1, 6, 24),
+        "fields": ("temperature", "humidity", "soil_moisture", "water_level"),
+        "humidity_thresholds": (85, 90),
+        "leaf_wetness_max_dew_point_depression": 2.0,
+        "max_gap_hours": 4,
+    }
+    # File cache thời tiết JSON cũ; được chuyển sang WEATHER_SERVICE["cache_path"] (SQLite) ở lần khởi động đầu tiên.
     WEATHER_CACHE_PATH = os.path.join(BASE_DIR, "data", "cache", "weather_cache.json")
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024 
 
     VECTOR_STORE_DIR = os.path.join(BASE_DIR, "data", "vector_store")
+    QUERY_EMBEDDING_CACHE_SIZE = 1024
+    VECTOR_STORE_USE_MMAP = True
+    # Loại index FAISS của lớp vector dùng chung: "flat" (chính xác tuyệt đối), "sq8" (lượng tử hóa 8-bit)
+    # hoặc "ivfpq" (IVF + Product Quantization). Các kho tri thức là view lọc theo ID trên index này.
+    VECTOR_STORE_INDEX = {"type": "sq8", "nlist": 32, "m": 16, "nbits": 8, "nprobe": 8}
+    # Truy vấn lai: trọng số Reciprocal Rank Fusion của điểm vector và BM25;
+    # mỗi nguồn lấy k * candidate_multiplier ứng viên trước khi hợp nhất.
+    HYBRID_RETRIEVAL = {"vector_weight": 1.0, "bm25_weight": 1.0, "rrf_k": 60, "candidate_multiplier": 4}
     
     KNOWLEDGE_SOURCES = {
         "bacterial_leaf_blight": [
@@ -166,20 +189,93 @@ class AppConfig:
     MODEL_VERSIONS_DIR = os.path.join(BASE_DIR, "src", "model", "versions")
     MODEL_PATH = get_latest_model_path(MODEL_VERSIONS_DIR)
     CLASS_NAMES = ["bacterial_leaf_blight", "blast", "brown_spot", "healthy"]
+    # Suy luận ảnh: backend "auto" ưu tiên bản export .tflite cạnh file .keras (xem model/retrain/export.py);
+    # micro-batch gom các yêu cầu đồng thời trong tối đa max_wait_ms.
+    IMAGE_INFERENCE = {
+        "backend": "auto", "num_threads": None,
+        "max_batch_size": 16, "max_wait_ms": 10, "timeout_seconds": 60,
+    }
+
+    # Lịch giám sát định kỳ: một job quét mỗi sweep_interval_seconds, chạy các nông hộ đến hạn trên
+    # thread pool max_workers; stage_limits giới hạn số tác vụ đồng thời cho từng giai đoạn của pipeline.
+    MONITORING_SCHEDULER = {
+        "sweep_interval_seconds": 60,
+        "max_workers": 8,
+        "stage_limits": {"inference": 4, "weather": 2, "llm": 4},
+    }
+    # Chỉ mục phash của ảnh giám sát: ảnh có khoảng cách Hamming <= max_distance với ảnh đã phân tích
+    # được coi là trùng lặp và dùng lại kết quả nhận diện cũ.
+    IMAGE_HASH_INDEX = {
+        "enabled": True,
+        "path": os.path.join(BASE_DIR, "data", "cache", "image_hash_index.sqlite3"),
+        "max_distance": 6,
+    }
 
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     if not OPENAI_API_KEY:
         raise ValueError("Lỗi: Biến môi trường OPENAI_API_KEY chưa được thiết lập.")
     
+    # Cho phép trỏ tới endpoint tương thích OpenAI khác (ví dụ server giả lập cục bộ khi kiểm thử).
+    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
     OPENAI_MODEL_NAME = "gpt-4o-mini"  
     OPENAI_GENERATION_CONFIG = {
         "temperature": 0.4,
         "top_p": 0.9,
         "max_tokens": 2048,  
-        "seed": 12345         
+        "seed": 12345
+    }
+    # Thư mục cache file BPE của tiktoken: bộ tách token được nạp một lần lúc khởi động app và chỉ tải về lần đầu;
+    # chép sẵn file vào đây để chạy không cần mạng.
+    TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR", os.path.join(BASE_DIR, "data", "cache", "tiktoken"))
+    # Ngân sách token cho từng phần của prompt, theo tên prompt. Phần không khai báo thì không giới hạn.
+    PROMPT_TOKEN_BUDGETS = {
+        "treatment": {"context": 1200, "farmer_info": 200, "daily_summary": 300, "hourly_detail": 800, "iot_data": 300,
+                      "iot_stats": 500},
+        "treatment_update": {"current_plan": 1500, "user_message": 300},
+        "fertilization": {"context": 1800, "farmer_info": 200},
+        "water": {"context": 900, "daily_summary": 300, "iot_data": 300, "iot_stats": 500},
+        "qa": {"context": 900, "farmer_info": 400, "history": 800, "question": 300},
+    }
+    # Định tuyến ý định cục bộ cho hỏi đáp: chỉ bỏ qua bước LLM chọn tool khi độ tương đồng cosine
+    # với câu mẫu đạt ngưỡng và cách biệt đủ xa tool thứ hai (hoặc luật từ khóa khớp duy nhất một tool
+    # và độ tương đồng với tool đó đạt keyword_min_similarity). Khi có lịch sử hội thoại chỉ dùng luật từ khóa.
+    INTENT_ROUTER = {"enabled": True, "similarity_threshold": 0.8, "margin": 0.08, "keyword_min_similarity": 0.6}
+    # Gateway LLM dùng chung: giới hạn connection pool, số lời gọi đồng thời, timeout và thử lại có backoff.
+    LLM_GATEWAY = {
+        "max_connections": 20,
+        "max_keepalive_connections": 10,
+        "max_concurrency": 8,
+        "timeout_seconds": 60.0,
+        "connect_timeout_seconds": 10.0,
+        "max_retries": 3,
+        "backoff_base_seconds": 0.5,
+        "backoff_max_seconds": 8.0,
+    }
+    # Cache phản hồi LLM theo nội dung prompt (SQLite). TTL tính theo giây cho từng loại kế hoạch.
+    LLM_RESPONSE_CACHE = {
+        "enabled": True,
+        "path": os.path.join(BASE_DIR, "data", "cache", "llm_response_cache.sqlite3"),
+        # treatment_image: ảnh giám sát -> phiên kế hoạch đã tạo; khóa đã gồm phiên bản dự báo nên TTL chỉ để dọn bản ghi cũ.
+        "ttl_seconds": {"fertilization": 24 * 3600, "water": 3 * 3600, "treatment_image": 24 * 3600},
+        "default_ttl_seconds": 3600,
     }
 
     WEATHER_CACHE_DURATION_HOURS = 6
+    # Crawler thời tiết: base_url đổi được qua biến môi trường (vd. trỏ tới server fixture cục bộ khi kiểm thử).
+    # Cache hết hạn nhưng chưa quá stale_max_hours vẫn được trả về ngay trong khi làm mới ở nền;
+    # cache của tỉnh không được làm mới quá evict_after_hours thì bị xóa khỏi SQLite.
+    WEATHER_SERVICE = {
+        "base_url": os.getenv("WEATHER_BASE_URL", "https://baomoi.com/tien-ich/thoi-tiet-"),
+        "cache_path": os.path.join(BASE_DIR, "data", "cache", "weather_cache.sqlite3"),
+        "stale_max_hours": 48,
+        "evict_after_hours": 168,
+        "politeness_delay_seconds": (2, 5),
+        "request_timeout_seconds": 15,
+        "fetch_wait_seconds": 30,
+    }
+    # Prefetch thời tiết: mỗi interval_seconds, làm mới ở nền các tỉnh đang được giám sát có cache
+    # sắp hết hạn trong lead_minutes (tốc độ crawl bị giới hạn bởi politeness_delay_seconds ở trên).
+    WEATHER_PREFETCH = {"enabled": True, "interval_seconds": 300, "lead_minutes": 30}
 
 CONFIG = AppConfig()
 
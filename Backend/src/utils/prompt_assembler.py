@@ -0,0 +1,246 @@
+import os
+import re
+import json
+from functools import lru_cache
+
+from src.utils.config import CONFIG
+from src.logging.logger import logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHUNK_SEPARATOR = "\n---\n"
+TRUNCATION_MARK = " …"
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]+")
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    """Nạp bộ tách token của model (tiktoken). Trả về None nếu không nạp được."""
+    if tiktoken is None:
+        logger.warning("Không có thư viện tiktoken, số token sẽ được ước lượng theo từ và dấu câu.")
+        return None
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", CONFIG.TIKTOKEN_CACHE_DIR)
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.warning(f"Không nạp được bộ tách token cho model '{model_name}': {e}. Dùng ước lượng thay thế.")
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"Không nạp được bộ tách token 'o200k_base': {e}. Dùng ước lượng thay thế.")
+        return None
+
+def load_tokenizer(model_name: str = None):
+    """
+    Nạp trước bộ tách token (gọi một lần lúc khởi động app), để lần tải file BPE đầu tiên không rơi vào
+    luồng xử lý request. Trả về encoding, hoặc None nếu dùng ước lượng.
+    """
+    encoding = _get_encoding(model_name or CONFIG.OPENAI_MODEL_NAME)
+    logger.info(f"Bộ đếm token cho prompt: {encoding.name if encoding is not None else 'ước lượng theo từ và dấu câu'}.")
+    return encoding
+
+def compact_json(data) -> str:
+    """Tuần tự hóa JSON dạng gọn (không thụt lề, không khoảng trắng thừa)."""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def dedupe_chunks(chunks: list, shingle_size: int = 8, min_run: int = 4) -> list:
+    """
+    Loại bỏ phần trùng lặp giữa các đoạn văn bản truy xuất được.
+    Các chunk liền kề trong kho tri thức chồng lấn nhau (overlap khi chia nhỏ), nên mỗi chunk
+    chỉ giữ lại những đoạn từ chưa xuất hiện trong các chunk trước đó (so khớp theo cụm `shingle_size` từ).
+    Chunk không còn nội dung mới sẽ bị bỏ.
+    """
+    seen_shingles = set()
+    seen_short = set()
+    result = []
+    for chunk in chunks:
+        words = chunk.split()
+        if not words:
+            continue
+        if len(words) < shingle_size:
+            key = tuple(words)
+            if key not in seen_short:
+                seen_short.add(key)
+                result.append(chunk.strip())
+            continue
+
+        shingles = [tuple(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)]
+        covered = [False] * len(words)
+        for i, shingle in enumerate(shingles):
+            if shingle in seen_shingles:
+                covered[i:i + shingle_size] = [True] * shingle_size
+        seen_shingles.update(shingles)
+
+        if not any(covered):
+            result.append(chunk.strip())
+            continue
+
+        runs, start = [], None
+        for i, is_covered in enumerate(covered + [True]):
+            if not is_covered and start is None:
+                start = i
+            elif is_covered and start is not None:
+                if i - start >= min_run:
+                    runs.append(" ".join(words[start:i]))
+                start = None
+        if runs:
+            result.append(" … ".join(runs))
+    return result
+
+class PromptAssembler:
+    """
+    Lắp ráp prompt theo ngân sách token.
+    Mỗi phần (ngữ cảnh truy xuất, thông tin nông hộ, dự báo...) được đếm token bằng bộ tách token
+    của model và cắt gọn theo ngân sách cấu hình trong `PROMPT_TOKEN_BUDGETS[name]`.
+    Sau khi gọi `finalize`, `report` chứa số token của từng phần và của toàn bộ prompt.
+    """
+    def __init__(self, name: str, budgets: dict = None, model_name: str = None):
+        self.name = name
+        self.budgets = budgets if budgets is not None else CONFIG.PROMPT_TOKEN_BUDGETS.get(name, {})
+        self.encoding = _get_encoding(model_name or CONFIG.OPENAI_MODEL_NAME)
+        self.sections = {}
+        self.report = {}
+
+    def count_tokens(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return len(_TOKEN_PATTERN.findall(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cắt văn bản về tối đa `max_tokens` token (tính cả dấu cắt)."""
+        if max_tokens is None or self.count_tokens(text) <= max_tokens:
+            return text
+        keep = max(max_tokens - self.count_tokens(TRUNCATION_MARK), 0)
+        if self.encoding is not None:
+            head = self.encoding.decode(self.encoding.encode(text)[:keep])
+        else:
+            matches = list(_TOKEN_PATTERN.finditer(text))
+            head = text[:matches[keep - 1].end()] if keep else ""
+        return head.rstrip() + TRUNCATION_MARK
+
+    def _record(self, name: str, text: str, original_tokens: int) -> str:
+        self.sections[name] = {
+            "tokens": self.count_tokens(text),
+            "original_tokens": original_tokens,
+            "budget": self.budgets.get(name),
+        }
+        return text
+
+    def add_text(self, name: str, text: str) -> str:
+        """Thêm một phần văn bản tự do, cắt theo ngân sách của phần đó."""
+        text = text or ""
+        original_tokens = self.count_tokens(text)
+        return self._record(name, self.truncate(text, self.budgets.get(name)), original_tokens)
+
+    def add_json(self, name: str, data, required: bool = False) -> str:
+        """
+        Thêm dữ liệu JSON dạng gọn. Nếu vượt ngân sách: danh sách bị lược bớt các phần tử cuối, dict bị bỏ
+        nguyên các khóa cuối; JSON đưa vào prompt luôn hợp lệ, không bao giờ bị cắt giữa chừng.
+        `required=True` dành cho dữ liệu mà model phải trả lại đầy đủ (vd. kế hoạch đang cập nhật):
+        không lược gì, chỉ ghi cảnh báo khi vượt ngân sách.
+
+        Raises:
+            ValueError: dữ liệu không phải list/dict vượt ngân sách (không thể lược mà vẫn giữ JSON hợp lệ).
+        """
+        text = compact_json(data)
+        original_tokens = self.count_tokens(text)
+        budget = self.budgets.get(name)
+        if budget is None or original_tokens <= budget:
+            return self._record(name, text, original_tokens)
+        if required:
+            logger.warning(f"[Prompt '{self.name}'] Phần bắt buộc '{name}' vượt ngân sách ({original_tokens}/{budget} token), vẫn giữ nguyên.")
+            return self._record(name, text, original_tokens)
+
+        if isinstance(data, list):
+            items = list(data)
+            while items and self.count_tokens(compact_json(items)) > budget:
+                items.pop()
+            logger.info(f"[Prompt '{self.name}'] Phần '{name}' vượt ngân sách, giữ {len(items)}/{len(data)} mục.")
+            return self._record(name, compact_json(items), original_tokens)
+        if isinstance(data, dict):
+            items = dict(data)
+            while items and self.count_tokens(compact_json(items)) > budget:
+                items.popitem()
+            logger.info(f"[Prompt '{self.name}'] Phần '{name}' vượt ngân sách, giữ {len(items)}/{len(data)} khóa "
+                        f"({', '.join(map(str, items)) or 'không khóa nào'}).")
+            return self._record(name, compact_json(items), original_tokens)
+        raise ValueError(f"Phần '{name}' của prompt '{self.name}' vượt ngân sách {budget} token và không thể lược bớt.")
+
+    def add_context(self, name: str, context) -> str:
+        """
+        Thêm ngữ cảnh truy xuất (chuỗi nối bằng '---' hoặc danh sách chunk).
+        Các chunk được khử trùng lặp rồi đưa vào theo thứ tự xếp hạng cho đến khi hết ngân sách.
+        """
+        chunks = context.split(CHUNK_SEPARATOR) if isinstance(context, str) else list(context or [])
+        original_tokens = self.count_tokens(CHUNK_SEPARATOR.join(chunks))
+        chunks = dedupe_chunks(chunks)
+        budget = self.budgets.get(name)
+
+        selected, used = [], 0
+        separator_tokens = self.count_tokens(CHUNK_SEPARATOR)
+        for chunk in chunks:
+            cost = self.count_tokens(chunk) + (separator_tokens if selected else 0)
+            if budget is None or used + cost <= budget:
+                selected.append(chunk)
+                used += cost
+                continue
+            remaining = budget - used - (separator_tokens if selected else 0)
+            if remaining >= 50 or not selected:
+                selected.append(self.truncate(chunk, max(remaining, 1)))
+            break
+        return self._record(name, CHUNK_SEPARATOR.join(selected), original_tokens)
+
+    def add_lines(self, name: str, lines: list, keep_last: bool = True) -> str:
+        """Thêm danh sách dòng (ví dụ lịch sử hội thoại); khi vượt ngân sách ưu tiên giữ các dòng mới nhất."""
+        lines = [line for line in lines if line]
+        original_tokens = self.count_tokens("\n".join(lines))
+        budget = self.budgets.get(name)
+        if budget is None or original_tokens <= budget:
+            return self._record(name, "\n".join(lines), original_tokens)
+
+        ordered = list(reversed(lines)) if keep_last else list(lines)
+        selected, used = [], 0
+        for line in ordered:
+            cost = self.count_tokens(line) + 1
+            if used + cost > budget:
+                if not selected:
+                    selected.append(self.truncate(line, budget))
+                break
+            selected.append(line)
+            used += cost
+        if keep_last:
+            selected.reverse()
+        return self._record(name, "\n".join(selected), original_tokens)
+
+    @staticmethod
+    def _strip_template_indent(prompt: str) -> str:
+        """Bỏ phần thụt lề chung của template f-string (các khoảng trắng đầu dòng chỉ tốn token)."""
+        indents = [len(line) - len(line.lstrip(" ")) for line in prompt.splitlines() if line.strip() and line.startswith(" ")]
+        if not indents:
+            return prompt.strip()
+        common = min(indents)
+        lines = [line[common:] if line[:common].isspace() else line.lstrip(" ") for line in prompt.splitlines()]
+        return "\n".join(lines).strip()
+
+    def finalize(self, prompt: str) -> str:
+        """Chuẩn hóa prompt hoàn chỉnh, ghi nhận và log số token của từng phần."""
+        prompt = self._strip_template_indent(prompt)
+        total_tokens = self.count_tokens(prompt)
+        self.report = {
+            "prompt": self.name,
+            "total_tokens": total_tokens,
+            "sections": dict(self.sections),
+            "tokenizer": self.encoding.name if self.encoding is not None else "estimate",
+        }
+        details = ", ".join(
+            f"{name}={info['tokens']}/{info['original_tokens']}" for name, info in self.sections.items()
+        )
+        logger.info(f"[Prompt '{self.name}'] Tổng {total_tokens} token, bộ đếm {self.report['tokenizer']} ({details}).")
+        return prompt
@@ -0,0 +1,16 @@
+import os
+import sqlite3
+
+def connect_sqlite(path: str, timeout: float = 30.0) -> sqlite3.Connection:
+    """
+    Mở kết nối SQLite cho các kho lưu trữ cục bộ (cache, chuỗi thời gian...).
+    Bật WAL để đọc không chặn ghi và đặt busy_timeout để nhiều tiến trình (worker Flask,
+    scheduler) có thể dùng chung một file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+    return connection
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# CONFIG đọc DATABASE_URL ngay khi import; các test chỉ dùng kho SQLite/FAISS cục bộ, không cần CSDL thật.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,67 @@
+import random
+
+import pandas as pd
+import pytest
+
+from src.services.forecast_frame import ForecastFrame
+
+def hourly_forecast(days=4, seed=11, drop_rate=0.0):
+    rng = random.Random(seed)
+    records = []
+    for day in range(days):
+        for hour in range(0, 24, 3):
+            record = {"date": f"2026-10-{18 + day:02d}", "hour": f"{hour:02d}:00", "temperature": rng.randint(23, 35),
+                      "humidity": rng.randint(60, 99), "rain_chance": rng.choice([0, 10, 20, 30, 40, 70, 90]),
+                      "wind_kmh": rng.randint(2, 25)}
+            for field in ("rain_chance", "wind_kmh"):
+                if rng.random() < drop_rate:
+                    del record[field]
+            records.append(record)
+    rng.shuffle(records)
+    return records
+
+def pandas_daily_summary(records):
+    """Cách tóm tắt theo ngày bằng pandas trước khi có ForecastFrame."""
+    df = pd.DataFrame(records)
+    df["date"] = pd.to_datetime(df["date"])
+    summary = df.groupby(df["date"].dt.date).agg(
+        min_temp=("temperature", "min"), max_temp=("temperature", "max"),
+        avg_humidity=("humidity", lambda h: round(h.mean())),
+        max_rain_chance=("rain_chance", "max"), max_wind_kmh=("wind_kmh", "max"),
+    ).reset_index()
+    summary["date"] = summary["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
+    return summary.to_dict("records")
+
+def loop_spray_score(hours):
+    """Cách chấm điểm ngày phun thuốc bằng vòng lặp theo giờ trước khi có ForecastFrame."""
+    score, streak, longest = 100.0, 0, 0
+    for hour in hours:
+        if hour.get("rain_chance", 100) > 30:
+            score -= 10
+            streak = 0
+        else:
+            streak += 1
+        if hour.get("wind_kmh", 99) > 15:
+            score -= 2
+        longest = max(longest, streak)
+    return score + longest * 5
+
+def test_daily_summary_matches_pandas():
+    records = hourly_forecast()
+    assert ForecastFrame(records).daily_summary() == pandas_daily_summary(records)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_spray_scores_match_hourly_loop(seed):
+    records = hourly_forecast(seed=seed, drop_rate=0.1)
+    frame = ForecastFrame(records)
+    expected = [{"date": str(day), "score": loop_spray_score([record for record in frame.records if record["date"] == day])}
+                for day in sorted({record["date"] for record in records})]
+    assert frame.spray_scores() == expected
+    assert frame.best_spray_day()["score"] == max(day["score"] for day in expected)
+
+def test_best_spray_window_is_longest_dry_calm_run_of_the_day():
+    hours = [(6, 0, 5), (9, 10, 8), (12, 60, 5), (15, 0, 5), (18, 20, 10), (21, 0, 12)]
+    frame = ForecastFrame([{"date": "2026-10-18", "hour": f"{hour:02d}:00", "rain_chance": rain, "wind_kmh": wind}
+                           for hour, rain, wind in hours])
+    assert frame.best_spray_window("2026-10-18") == {"date": "2026-10-18", "start_hour": "15:00", "end_hour": "21:00", "hours": 3}
+    assert frame.best_spray_window("2026-10-19") is None
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+from src.services.image_hash_index import ImageHashIndex
+
+BASE = 0x0F0F_0F0F_0F0F_0F0F
+
+def flip(hash_value: int, bits: int) -> str:
+    """Hash cách `hash_value` đúng `bits` bit (đổi các bit thấp nhất)."""
+    return f"{hash_value ^ ((1 << bits) - 1):016x}"
+
+def make_index(tmp_path, max_distance=6):
+    config = SimpleNamespace(IMAGE_HASH_INDEX={"path": str(tmp_path / "hashes.sqlite3"), "max_distance": max_distance})
+    return ImageHashIndex(config)
+
+def add_image(index, tmp_path, image_hash, label="blast"):
+    path = tmp_path / f"{image_hash}.jpg"
+    path.write_bytes(b"jpg")
+    index.add(image_hash, label, str(path))
+    return path
+
+def test_lookup_respects_hamming_radius(tmp_path):
+    index = make_index(tmp_path)
+    add_image(index, tmp_path, f"{BASE:016x}")
+    add_image(index, tmp_path, flip(BASE, 20), label="brown_spot")
+
+    assert index.find(f"{BASE:016x}")["distance"] == 0
+    assert index.find(flip(BASE, 6))["distance"] == 6
+    assert index.find(flip(BASE, 7)) is None
+    assert index.find(flip(BASE, 7), max_distance=7)["label"] == "blast"
+    assert index.find(flip(BASE, 18))["label"] == "brown_spot"
+    assert index.get_stats()["misses"] == 1
+
+def test_hashes_survive_restart_and_storage_folder_is_imported(tmp_path):
+    add_image(make_index(tmp_path), tmp_path, f"{BASE:016x}")
+    storage = tmp_path / "storage" / "brown_spot"
+    storage.mkdir(parents=True)
+    (storage / f"{flip(BASE, 30)}.jpg").write_bytes(b"jpg")
+    (storage / "anh_khong_phai_hash.jpg").write_bytes(b"jpg")
+
+    config = SimpleNamespace(IMAGE_HASH_INDEX={"path": str(tmp_path / "hashes.sqlite3"), "max_distance": 6})
+    index = ImageHashIndex(config, storage_folder=str(tmp_path / "storage"))
+    assert index.get_stats()["size"] == 2
+    assert index.find(flip(BASE, 2))["label"] == "blast"
+    assert index.find(flip(BASE, 31))["label"] == "brown_spot"
+
+def test_lookup_prunes_entries_whose_image_was_moved(tmp_path):
+    index = make_index(tmp_path)
+    add_image(index, tmp_path, f"{BASE:016x}")
+    near = add_image(index, tmp_path, flip(BASE, 3), label="brown_spot")
+    (tmp_path / f"{BASE:016x}.jpg").unlink()
+
+    found = index.find(f"{BASE:016x}")
+    assert found["path"] == str(near) and found["distance"] == 3
+    assert index.get_stats()["size"] == 1
+    assert make_index(tmp_path).get_stats()["size"] == 1
+
+    near.unlink()
+    assert index.find(f"{BASE:016x}") is None
+    assert index.add(f"{BASE:016x}", "blast", str(near)) is True
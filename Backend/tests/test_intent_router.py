@@ -0,0 +1,66 @@
+import numpy as np
+
+from src.agents.intent_router import IntentRouter, TOOL_EXAMPLES
+
+TREATMENT_EXAMPLES = set(TOOL_EXAMPLES["get_treatment_plan"])
+
+class StubVectorStore:
+    """
+    Embedding giả: câu mẫu của get_treatment_plan nằm trên trục 1, các câu mẫu khác trên trục 0;
+    câu hỏi dùng vector trong `questions` (mặc định trùng trục 0).
+    """
+    def __init__(self, questions: dict = None):
+        self.questions = questions or {}
+
+    def embed_texts(self, texts: list):
+        return [self.questions.get(text, [0.0, 1.0, 0.0] if text in TREATMENT_EXAMPLES else [1.0, 0.0, 0.0])
+                for text in texts]
+
+def route(question: str, history: list = None, questions: dict = None):
+    return IntentRouter(StubVectorStore(questions)).route(question, history)
+
+def test_treatment_keyword_does_not_match_inside_compound_words():
+    assert route("Bệnh đạo ôn là gì, có giá trị kinh tế ra sao?")[0] == "answer_general_question"
+    assert route("Triệu chứng bệnh đốm nâu, trị số pH đất có liên quan không?")[0] == "answer_general_question"
+
+def test_keywords_match_whole_words():
+    assert route("Bệnh cháy bìa lá là gì, phun thuốc gì?", questions={
+        "Bệnh cháy bìa lá là gì, phun thuốc gì?": [0.0, 1.0, 0.0]})[0] == "get_treatment_plan"
+    assert route("Giống npkx là gì?") is None
+
+def test_keyword_match_routes_without_llm():
+    treatment = {"Lúa bị đạo ôn, trị thế nào?": [0.0, 1.0, 0.0]}
+    assert route("Lúa bị đạo ôn, trị thế nào?", questions=treatment) == (
+        "get_treatment_plan", {"symptom_description": "Lúa bị đạo ôn, trị thế nào?"})
+    assert route("Có nên tưới thêm không?")[0] == "get_watering_advice"
+    assert route("Bón NPK bao nhiêu?")[0] == "get_nutrient_recommendation"
+
+def test_confident_embedding_match_routes_without_keyword():
+    question = "Lá lúa vàng úa từng đám, làm sao bây giờ?"
+    router = IntentRouter(StubVectorStore({question: [0.0, 1.0, 0.0]}))
+    assert router.route(question) == ("get_treatment_plan", {"symptom_description": question})
+    assert router.get_stats()["embedding"] == 1
+
+def test_ambiguous_question_is_left_to_the_llm():
+    # Không khớp từ khóa nào, các tool có cùng độ tương đồng: để LLM chọn.
+    router = IntentRouter(StubVectorStore())
+    assert router.route("Giống lúa nào hợp đất phèn?") is None
+    stats = router.get_stats()
+    assert stats["fallback"] == 1 and stats["local_rate"] == 0.0
+
+def test_follow_up_without_keyword_goes_to_llm_when_there_is_history():
+    question = "Còn liều lượng thì sao?"
+    questions = {question: [0.0, 1.0, 0.0]}
+    history = [{"role": "user", "content": "Lúa bị đạo ôn phải xử lý thế nào?"},
+               {"role": "assistant", "content": "Nên phun Beam 75WP..."}]
+
+    assert route(question, questions=questions)[0] == "get_treatment_plan"
+    router = IntentRouter(StubVectorStore(questions))
+    assert router.route(question, history) is None
+    assert router.get_stats()["fallback"] == 1
+    assert router.route("Có nên tưới thêm không?", history)[0] == "get_watering_advice"
+
+def test_keyword_route_needs_minimum_similarity():
+    question = "Bón NPK bao nhiêu?"
+    weak = {question: list(np.array([0.5, 0.0, np.sqrt(0.75)]))}
+    assert route(question, questions=weak) is None
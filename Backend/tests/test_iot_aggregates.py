@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from src.services.iot_aggregates import IoTAggregator
+
+HOUR = 3600.0
+
+def test_mean_min_max_match_brute_force():
+    aggregator = IoTAggregator()
+    rng = random.Random(7)
+    start, readings = 1_700_000_000.0, []
+    for i in range(500):
+        ts = start + i * 600
+        reading = {"temperature": rng.uniform(24, 34), "humidity": rng.uniform(60, 99)}
+        readings.append((ts, reading))
+        aggregator.add_reading(1, ts, reading)
+
+    windows = aggregator.get_summary(1)["windows"]
+    last_ts = readings[-1][0]
+    for hours in (1, 6, 24):
+        inside = [reading["humidity"] for ts, reading in readings if ts >= last_ts - hours * HOUR]
+        stats = windows[f"{hours}h"]
+        assert stats["readings"] == len(inside)
+        assert stats["humidity"]["mean"] == pytest.approx(sum(inside) / len(inside), abs=0.051)
+        assert stats["humidity"]["min"] == round(min(inside), 1)
+        assert stats["humidity"]["max"] == round(max(inside), 1)
+
+def test_late_readings_are_ignored_and_unknown_farm_has_no_summary():
+    aggregator = IoTAggregator()
+    aggregator.add_reading(1, 1_700_000_000.0, {"humidity": 80.0})
+    aggregator.add_reading(1, 1_699_990_000.0, {"humidity": 99.0})
+    assert aggregator.get_summary(1)["windows"]["24h"]["humidity"]["max"] == 80.0
+    assert aggregator.get_summary(2) is None
+
+def test_sparse_readings_never_exceed_window_length():
+    aggregator = IoTAggregator({"max_gap_hours": 4})
+    start = 1_700_000_000.0
+    for i in range(10):
+        aggregator.add_reading(1, start + i * 4 * HOUR, {"temperature": 26.0, "humidity": 95.0})
+
+    windows = aggregator.get_summary(1)["windows"]
+    assert windows["1h"]["hours_humidity_above"] == {"85": 1.0, "90": 1.0}
+    assert windows["1h"]["leaf_wetness_hours"] == 1.0
+    assert windows["6h"]["hours_humidity_above"] == {"85": 6.0, "90": 6.0}
+    assert windows["24h"]["hours_humidity_above"] == {"85": 24.0, "90": 24.0}
+
+def test_hours_only_count_the_part_of_the_interval_inside_the_window():
+    aggregator = IoTAggregator({"max_gap_hours": 4})
+    start = 1_700_000_000.0
+    aggregator.add_reading(1, start, {"humidity": 70.0})
+    aggregator.add_reading(1, start + 3 * HOUR, {"humidity": 92.0})
+    aggregator.add_reading(1, start + 4 * HOUR, {"humidity": 80.0})
+
+    windows = aggregator.get_summary(1)["windows"]
+    # Khoảng [1h, 3h] ẩm >= 90% nằm trọn trong cửa sổ 6h, nằm ngoài cửa sổ 1h.
+    assert windows["6h"]["hours_humidity_above"]["90"] == 3.0
+    assert windows["1h"]["hours_humidity_above"]["90"] == 0.0
+
+    # Bốn giờ sau bản đo cuối, mốc cắt của cửa sổ 6h là 2h: chỉ còn 1h của khoảng ẩm [0h, 3h].
+    windows = aggregator.get_summary(1, now=start + 8 * HOUR)["windows"]
+    assert windows["6h"]["hours_humidity_above"]["90"] == 1.0
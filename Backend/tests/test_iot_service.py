@@ -0,0 +1,124 @@
+import json
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from src.services import iot_service
+from src.services.iot_service import IoTService, TIMESTAMP_FORMAT
+
+@pytest.fixture
+def make_service(tmp_path, monkeypatch):
+    monkeypatch.setattr(iot_service.CONFIG, "IOT_FOLDER", str(tmp_path))
+    monkeypatch.setattr(iot_service.CONFIG, "IOT_STORE", {"path": str(tmp_path / "iot.sqlite3"), "retention_days": 90})
+    return IoTService
+
+def reading(farm_id, ts, humidity):
+    timestamp = datetime.fromtimestamp(ts, tz=timezone.utc).strftime(TIMESTAMP_FORMAT)
+    return {"farm_id": farm_id, "timestamp": timestamp, "temperature": 27.0, "humidity": humidity}
+
+def test_history_is_ordered_by_reading_time_and_survives_restart(make_service):
+    service = make_service()
+    now = time.time()
+    for ts, humidity in ((now - 60, 92.0), (now - 600, 80.0), (now - 300, 85.0)):
+        service.save_data(4, reading(4, ts, humidity))
+
+    assert [row["humidity"] for row in service.get_history(4)] == [80.0, 85.0, 92.0]
+    assert [row["humidity"] for row in service.get_history(4, since_ts=now - 400)] == [85.0, 92.0]
+    assert [row["humidity"] for row in service.get_history(4, limit=2)] == [85.0, 92.0]
+    assert service.get_latest_data(4)["humidity"] == 92.0
+    assert make_service().get_latest_data(4)["humidity"] == 92.0
+
+def test_compact_drops_expired_readings_but_keeps_latest_per_farm(make_service):
+    service = make_service()
+    now = time.time()
+    for ts, humidity in ((now - 200 * 86400, 60.0), (now - 120 * 86400, 65.0), (now - 60, 90.0)):
+        service.save_data(1, reading(1, ts, humidity))
+    service.save_data(2, reading(2, now - 100 * 86400, 70.0))
+
+    assert service.compact() == 2
+    assert [row["humidity"] for row in service.get_history(1)] == [90.0]
+    assert service.get_latest_data(2)["humidity"] == 70.0
+    assert service.get_stats()["readings"] == 2
+
+def test_legacy_json_file_is_migrated(tmp_path, make_service):
+    legacy_file = tmp_path / "iot_data" / "all_iot_data.json"
+    legacy_file.parent.mkdir()
+    legacy_file.write_text(json.dumps({"3": reading(3, time.time() - 60, 88.0)}), encoding="utf-8")
+
+    assert make_service().get_latest_data(3)["humidity"] == 88.0
+    assert not legacy_file.exists() and (tmp_path / "iot_data" / "all_iot_data.json.migrated").exists()
+
+def test_save_many_reports_invalid_records_by_position(make_service):
+    service = make_service()
+    now = time.time()
+    result = service.save_many([
+        reading(1, now - 60, 80.0),
+        {"farm_id": "ruộng 1", "humidity": 80.0},
+        {"farm_id": 1, "humidity": 180.0},
+        {"farm_id": 1, "timestamp": reading(1, now, 0)["timestamp"]},
+        {"farm_id": 2, "water_level": "cao"},
+        reading(9, now - 60, 80.0),
+        reading(2, now - 30, 85.0),
+    ], allowed_farm_ids={1, 2})
+
+    assert (result["received"], result["saved"]) == (7, 2)
+    assert [error["index"] for error in result["errors"]] == [1, 2, 3, 4, 5]
+    assert service.get_latest_data(2)["humidity"] == 85.0
+
+def test_reading_written_by_another_worker_is_visible(make_service):
+    reader, writer = make_service(), make_service()
+    now = time.time()
+    assert writer.save_many([reading(7, now - 600, 80.0), reading(7, now - 60, 92.0)])["saved"] == 2
+
+    latest = reader.get_latest_data(7)
+    assert latest["humidity"] == 92.0
+    assert reader.get_history(7)[-1]["humidity"] == 92.0
+    assert reader.get_aggregates(7)["windows"]["1h"]["readings"] == 2
+    assert reader.get_stats()["farms"] == 1
+
+def test_late_reading_from_another_worker_rebuilds_aggregates(make_service):
+    reader, writer = make_service(), make_service()
+    now = time.time()
+    writer.save_many([reading(3, now - 1800, 70.0), reading(3, now - 60, 90.0)])
+    assert reader.get_aggregates(3)["windows"]["1h"]["readings"] == 2
+
+    writer.save_many([reading(3, now - 900, 50.0)])
+    windows = reader.get_aggregates(3)["windows"]
+    assert windows["1h"]["readings"] == 3
+    assert windows["1h"]["humidity"]["min"] == 50.0
+    assert reader.get_latest_data(3)["humidity"] == 90.0
+    assert windows == writer.get_aggregates(3)["windows"]
+
+def test_reading_after_compaction_of_newest_row_is_visible(make_service):
+    reader, writer = make_service(), make_service()
+    now = time.time()
+    writer.save_many([reading(5, now - 120, 80.0)])
+    # Bản đo bổ sung cũ hơn thời hạn lưu trữ là dòng được ghi cuối cùng, rồi bị compact xóa.
+    writer.save_many([reading(5, now - 100 * 86400, 60.0)])
+    assert writer.compact() == 1
+
+    writer.save_many([reading(5, now - 60, 93.0)])
+    assert writer.get_latest_data(5)["humidity"] == 93.0
+    assert reader.get_latest_data(5)["humidity"] == 93.0
+    assert reader.get_aggregates(5)["windows"]["1h"]["readings"] == 2
+
+def test_legacy_table_without_id_column_is_migrated(tmp_path, make_service):
+    connection = sqlite3.connect(tmp_path / "iot.sqlite3")
+    connection.execute(
+        "CREATE TABLE iot_readings (farm_id INTEGER NOT NULL, ts REAL NOT NULL, temperature REAL, humidity REAL, "
+        "soil_moisture REAL, soil_ph REAL, water_level REAL, payload TEXT NOT NULL)"
+    )
+    now = time.time()
+    for ts, humidity in ((now - 300, 70.0), (now - 60, 88.0)):
+        payload = json.dumps(reading(2, ts, humidity))
+        connection.execute("INSERT INTO iot_readings VALUES (2, ?, 27.0, ?, NULL, NULL, NULL, ?)", (ts, humidity, payload))
+    connection.commit()
+    connection.close()
+
+    service = make_service()
+    assert service.get_latest_data(2)["humidity"] == 88.0
+    assert [row["id"] for row in service._connection.execute("SELECT id FROM iot_readings ORDER BY id")] == [1, 2]
+    service.save_many([reading(2, now, 90.0)])
+    assert make_service().get_latest_data(2)["humidity"] == 90.0
@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from src.services.llm_gateway import LLMGateway
+
+def completion(content: str) -> dict:
+    return {
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+def stream_chunk(content: str) -> str:
+    chunk = {"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o-mini",
+             "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+    return f"data: {json.dumps(chunk)}\n\n"
+
+class StubServer:
+    """Server giả lập endpoint /v1/chat/completions, trả lần lượt các phản hồi đã định (status, headers, body, delay)."""
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests.append(body)
+                status, headers, payload, delay = stub.responses.pop(0) if len(stub.responses) > 1 else stub.responses[0]
+                time.sleep(delay)
+                data = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/event-stream" if isinstance(payload, str) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except BrokenPipeError:
+                    pass  # client đã bỏ cuộc (test timeout)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def make_gateway():
+    servers = []
+
+    def factory(responses, **gateway_config):
+        server = StubServer(responses)
+        servers.append(server)
+        config = SimpleNamespace(
+            OPENAI_API_KEY="test-key", OPENAI_BASE_URL=server.base_url, OPENAI_MODEL_NAME="gpt-4o-mini",
+            LLM_GATEWAY={"max_concurrency": 1, "max_retries": 3, "backoff_base_seconds": 0.01,
+                         "backoff_max_seconds": 1.0, **gateway_config},
+        )
+        return LLMGateway(config), server
+
+    yield factory
+    for server in servers:
+        server.close()
+
+ERROR_BODY = {"error": {"message": "tạm thời lỗi", "type": "server_error"}}
+
+def test_retries_rate_limit_and_server_error_then_succeeds(make_gateway):
+    gateway, server = make_gateway([
+        (429, {"Retry-After": "0.3"}, ERROR_BODY, 0),
+        (500, {}, ERROR_BODY, 0),
+        (200, {}, completion("xin chào"), 0),
+    ])
+
+    started = time.monotonic()
+    response = gateway.chat_completion([{"role": "user", "content": "chào"}], temperature=0.2)
+
+    assert response.choices[0].message.content == "xin chào"
+    assert time.monotonic() - started >= 0.3
+    assert len(server.requests) == 3
+    assert server.requests[0]["model"] == "gpt-4o-mini" and server.requests[0]["temperature"] == 0.2
+    stats = gateway.get_stats()
+    assert (stats["calls"], stats["retries"], stats["failures"], stats["in_flight"]) == (1, 2, 0, 0)
+
+def test_gives_up_after_max_retries(make_gateway):
+    gateway, server = make_gateway([(500, {}, ERROR_BODY, 0)], max_retries=2)
+
+    with pytest.raises(openai.InternalServerError):
+        gateway.chat_completion([{"role": "user", "content": "chào"}])
+
+    assert len(server.requests) == 3
+    stats = gateway.get_stats()
+    assert (stats["calls"], stats["retries"], stats["failures"], stats["in_flight"]) == (0, 2, 1, 0)
+
+def test_per_call_timeout(make_gateway):
+    gateway, _ = make_gateway([(200, {}, completion("muộn"), 1.0)], max_retries=0)
+
+    with pytest.raises(openai.APITimeoutError):
+        gateway.chat_completion([{"role": "user", "content": "chào"}], timeout=0.2)
+    assert gateway.get_stats()["failures"] == 1
+
+def test_stream_releases_slot_when_consumer_stops_early(make_gateway):
+    gateway, server = make_gateway([
+        (503, {}, ERROR_BODY, 0),
+        (200, {}, stream_chunk("Phun ") + stream_chunk("sáng sớm.") + "data: [DONE]\n\n", 0),
+    ])
+
+    stream = gateway.stream_chat_completion([{"role": "user", "content": "chào"}])
+    assert next(stream) == "Phun "
+    stream.close()
+    assert gateway.get_stats()["in_flight"] == 0
+
+    # max_concurrency=1: lời gọi kế tiếp chỉ chạy được nếu slot của stream trước đã được trả lại.
+    assert "".join(gateway.stream_chat_completion([{"role": "user", "content": "chào"}])) == "Phun sáng sớm."
+    assert server.requests[-1]["stream"] is True
+    assert gateway.get_stats()["retries"] == 1
@@ -0,0 +1,51 @@
+import io
+from types import SimpleNamespace
+
+import imagehash
+import numpy as np
+from PIL import Image
+
+from src.agents.monitoring_agent import EnvironmentalMonitoringAgent, original_image_hash
+from src.services.image_hash_index import ImageHashIndex
+
+def encode(image_format: str, size=(3200, 2400)) -> bytes:
+    # Ảnh nhiều chi tiết cạnh sắc: phash trên ảnh draft mode (1/8) lệch vài bit so với ảnh đủ độ phân giải.
+    rng = np.random.default_rng(3)
+    pixels = rng.integers(0, 255, (size[1] // 20, size[0] // 20, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize(size, Image.NEAREST)
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+def make_agent(tmp_path, hash_index=None):
+    return EnvironmentalMonitoringAgent(treatment_agent=None, image_agent=None, user_repo=None,
+                                        storage_folder=str(tmp_path / "storage"), hash_index=hash_index)
+
+def test_hash_matches_legacy_files_named_by_full_resolution_phash(tmp_path):
+    image_bytes = encode("JPEG")
+    legacy_hash = imagehash.phash(Image.open(io.BytesIO(image_bytes)))
+    legacy_folder = tmp_path / "storage" / "blast"
+    legacy_folder.mkdir(parents=True)
+    (legacy_folder / f"{legacy_hash}.jpg").write_bytes(image_bytes)
+
+    config = SimpleNamespace(IMAGE_HASH_INDEX={"max_distance": 0})
+    index = ImageHashIndex(config, storage_folder=str(tmp_path / "storage"))
+    img_hash, image_format = original_image_hash(image_bytes)
+
+    assert image_format == "JPEG"
+    assert index.find(img_hash)["label"] == "blast"
+
+def test_store_image_keeps_the_real_format(tmp_path):
+    agent = make_agent(tmp_path)
+    png_bytes = encode("PNG", size=(64, 48))
+    img_hash, image_format = original_image_hash(png_bytes)
+
+    path, is_duplicate = agent._store_image(png_bytes, img_hash, "blast", "[TEST]", image_format)
+    assert path.endswith(".png") and not is_duplicate
+    assert open(path, "rb").read() == png_bytes
+
+    tiff_bytes = encode("TIFF", size=(64, 48))
+    img_hash, image_format = original_image_hash(tiff_bytes)
+    path, _ = agent._store_image(tiff_bytes, img_hash, "blast", "[TEST]", image_format)
+    assert path.endswith(".jpg")
+    assert Image.open(path).format == "JPEG"
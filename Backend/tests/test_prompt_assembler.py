@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from src.utils.prompt_assembler import CHUNK_SEPARATOR, PromptAssembler
+
+PLAN = {
+    "main_message": "Phun thuốc trừ bệnh đạo ôn vào sáng sớm, tránh ngày có mưa. " * 10,
+    "drug_info": [{"name": "Beam 75WP", "dosage": "20 g/bình 16 lít"}] * 5,
+    "notes": "Theo dõi lại sau 7 ngày.",
+}
+
+def assembler_tokens(*texts) -> int:
+    assembler = PromptAssembler("test", budgets={})
+    return sum(assembler.count_tokens(text) for text in texts)
+
+def test_over_budget_dict_drops_whole_keys_and_stays_valid_json():
+    assembler = PromptAssembler("test", budgets={"farmer_info": 40})
+    text = assembler.add_json("farmer_info", PLAN)
+    trimmed = json.loads(text)
+    assert list(trimmed) == list(PLAN)[:len(trimmed)]
+    assert all(trimmed[key] == PLAN[key] for key in trimmed)
+    assert assembler.sections["farmer_info"]["tokens"] <= 40
+
+def test_over_budget_list_drops_trailing_items():
+    assembler = PromptAssembler("test", budgets={"daily_summary": 30})
+    days = [{"date": f"2026-10-{day:02d}", "max_rain_chance": 40} for day in range(1, 11)]
+    kept = json.loads(assembler.add_json("daily_summary", days))
+    assert kept and kept == days[:len(kept)]
+
+def test_context_drops_overlap_and_keeps_chunks_in_rank_order_within_budget():
+    first = "Bệnh đạo ôn phát triển mạnh khi trời âm u, sương mù nhiều và độ ẩm không khí trên 90 phần trăm."
+    # Chunk thứ hai chồng lấn phần cuối của chunk đầu (overlap khi chia nhỏ tài liệu).
+    second = "sương mù nhiều và độ ẩm không khí trên 90 phần trăm. Khi thấy vết bệnh hình thoi cần phun thuốc ngay."
+    third = "Bón thừa đạm làm lá lúa mềm, dễ nhiễm bệnh. " * 20
+
+    assembler = PromptAssembler("test", budgets={"context": assembler_tokens(first, second) + 20})
+    chunks = assembler.add_context("context", CHUNK_SEPARATOR.join([first, second, third])).split(CHUNK_SEPARATOR)
+
+    assert chunks[0] == first
+    assert chunks[1] == "Khi thấy vết bệnh hình thoi cần phun thuốc ngay."
+    assert len(chunks) == 2
+    assert assembler.sections["context"]["tokens"] <= assembler.budgets["context"]
+
+def test_history_keeps_newest_lines():
+    lines = [f"Nông dân: câu hỏi số {i} về lịch bón phân cho ruộng lúa" for i in range(10)]
+    assembler = PromptAssembler("test", budgets={"history": 40})
+    kept = assembler.add_lines("history", lines).split("\n")
+    assert kept and kept == lines[-len(kept):]
+
+def test_required_json_is_never_trimmed():
+    assembler = PromptAssembler("test", budgets={"current_plan": 20})
+    assert json.loads(assembler.add_json("current_plan", PLAN, required=True)) == PLAN
+
+def test_over_budget_scalar_fails_loudly():
+    assembler = PromptAssembler("test", budgets={"note": 3})
+    with pytest.raises(ValueError):
+        assembler.add_json("note", "một chuỗi rất dài không thể lược bớt mà vẫn giữ JSON hợp lệ")
@@ -0,0 +1,139 @@
+import hashlib
+import multiprocessing
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")
+from src.services import vector_store_service
+from src.services.vector_store_service import VectorStoreService
+
+DIMENSION = 32
+
+class FakeEncoder:
+    """Embedding tất định theo hash nội dung, thay cho model SentenceTransformer thật trong test."""
+    encoded = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def encode(self, texts, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        FakeEncoder.encoded.extend(texts)
+        vectors = np.stack([
+            np.frombuffer(hashlib.sha256(text.encode("utf-8")).digest(), dtype=np.uint8)[:DIMENSION].astype(np.float32) / 255
+            for text in texts
+        ])
+        return vectors[0] if single else vectors
+
+@pytest.fixture(autouse=True)
+def fake_encoder(monkeypatch):
+    monkeypatch.setattr(vector_store_service, "SentenceTransformer", FakeEncoder)
+    FakeEncoder.encoded = []
+
+def write_source(path, paragraphs: int, tag: str):
+    sentences = (f"Đoạn {i} về bệnh đạo ôn phiên bản {tag}, cách phòng trừ và liều lượng thuốc số {i}." for i in range(paragraphs * 10))
+    path.write_text(" ".join(sentences), encoding="utf-8")
+
+def make_config(tmp_path, source_path):
+    return SimpleNamespace(
+        VECTOR_STORE_DIR=str(tmp_path / "vector_store"),
+        VECTOR_STORE_INDEX={"type": "sq8"},
+        VECTOR_STORE_USE_MMAP=True,
+        KNOWLEDGE_SOURCES={"blast": [{"id": "blast_control", "type": "txt", "path": str(source_path)}]},
+    )
+
+def search_after_reindex(config, ready, done):
+    service = VectorStoreService(config)
+    service.get_store("blast")
+    ready.set()
+    done.wait(30)
+    for _ in range(20):
+        service.search("blast", "bệnh đạo ôn", k=3)
+
+def test_fresh_deploy_creates_directory_and_persists_views(tmp_path):
+    source = tmp_path / "blast.txt"
+    write_source(source, 20, "v1")
+    config = make_config(tmp_path, source)
+
+    VectorStoreService(config).get_store("blast")
+    assert (tmp_path / "vector_store" / "documents_blast.json").exists()
+
+    # Lần khởi động sau dùng lại view và index trên đĩa, không đồng bộ (ghi) lại.
+    assert VectorStoreService(config).refresh_stale_stores() == []
+
+def test_changed_source_only_embeds_new_chunks(tmp_path):
+    source = tmp_path / "blast.txt"
+    write_source(source, 20, "v1")
+    service = VectorStoreService(make_config(tmp_path, source))
+    service.get_store("blast")
+    built = len(FakeEncoder.encoded)
+    assert service.refresh_stale_stores() == []
+
+    # Thêm một đoạn vào cuối nguồn: các chunk phía trước giữ nguyên nội dung nên không encode lại.
+    with open(source, "a", encoding="utf-8") as f:
+        f.write(" Phun Tricyclazole khi lúa trổ lác đác để phòng đạo ôn cổ bông.")
+    FakeEncoder.encoded = []
+    assert service.refresh_stale_stores() == ["blast"]
+    assert 0 < len(FakeEncoder.encoded) < built
+    assert "Tricyclazole" in "".join(FakeEncoder.encoded)
+
+    # Worker khởi động sau đọc manifest và index đã vá, không cần encode chunk nào.
+    FakeEncoder.encoded = []
+    restarted = VectorStoreService(make_config(tmp_path, source))
+    restarted.get_store("blast")
+    assert FakeEncoder.encoded == []
+    assert "Tricyclazole" in restarted.retrieve("blast", "đạo ôn cổ bông", k=50)
+
+def test_stores_sharing_a_source_embed_each_chunk_once(tmp_path):
+    blast, brown_spot = tmp_path / "blast.txt", tmp_path / "brown_spot.txt"
+    write_source(blast, 10, "đạo ôn")
+    brown_spot.write_text("Bệnh đốm nâu gây hại trên lá lúa thiếu kali. " * 20, encoding="utf-8")
+    config = make_config(tmp_path, blast)
+    config.KNOWLEDGE_SOURCES = {
+        "blast": [{"id": "blast_control", "type": "txt", "path": str(blast)}],
+        "general_qa": [{"id": "blast_control", "type": "txt", "path": str(blast)},
+                       {"id": "brown_spot", "type": "txt", "path": str(brown_spot)}],
+    }
+    service = VectorStoreService(config)
+    service.load_stores(["blast", "general_qa"])
+    assert len(FakeEncoder.encoded) == len(set(FakeEncoder.encoded))
+
+    # Kho 'blast' chỉ là view trên index chung: không bao giờ trả về chunk của nguồn mà nó không khai báo.
+    assert "đốm nâu" not in service.retrieve("blast", "bệnh đốm nâu", k=50)
+    assert "đốm nâu" in service.retrieve("general_qa", "bệnh đốm nâu", k=50)
+
+def test_reindex_while_another_worker_searches_mmapped_index(tmp_path):
+    source = tmp_path / "blast.txt"
+    write_source(source, 40, "v1")
+    config = make_config(tmp_path, source)
+    VectorStoreService(config).get_store("blast")
+
+    context = multiprocessing.get_context("fork")
+    ready, done = context.Event(), context.Event()
+    reader = context.Process(target=search_after_reindex, args=(config, ready, done))
+    reader.start()
+    assert ready.wait(30)
+
+    # Nguồn bị rút ngắn: index dùng chung được ghi lại nhỏ hơn trong khi worker kia vẫn đang map bản cũ.
+    write_source(source, 5, "v2")
+    writer = VectorStoreService(config)
+    writer.get_store("blast")
+    assert writer.refresh_stale_stores() == []
+    done.set()
+    reader.join(60)
+    assert reader.exitcode == 0
+
+def test_resync_in_same_process_replaces_its_own_mapped_index(tmp_path):
+    source = tmp_path / "blast.txt"
+    write_source(source, 40, "v1")
+    service = VectorStoreService(make_config(tmp_path, source))
+    service.get_store("blast")
+    service.search("blast", "bệnh đạo ôn", k=3)
+
+    write_source(source, 5, "v2")
+    assert service.refresh_stale_stores() == ["blast"]
+    hits = service.search("blast", "bệnh đạo ôn", k=3)
+    assert hits and all("v1" not in hit["content"] for hit in hits)
@@ -0,0 +1,89 @@
+import json
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from src.agents.water_agent import WaterAgent
+from src.services.forecast_frame import ForecastFrame
+from src.services.llm_response_cache import LLMResponseCache
+
+FARM = SimpleNamespace(id=1, province="An Giang", planting_date=date.today() - timedelta(days=30))
+PLAN = {"main_recommendation": "GIỮ NGUYÊN MỰC NƯỚC", "reason": "Mực nước 5 cm phù hợp giai đoạn đẻ nhánh."}
+HOURLY_FORECAST = [
+    {"date": f"2026-10-{day:02d} {hour:02d}:00", "temperature": 30, "humidity": 80, "rain_chance": 20, "wind_kmh": 8}
+    for day in (18, 19, 20) for hour in (6, 12, 18)
+]
+
+class StubLLMGateway:
+    """Thay cho LLMGateway: ghi lại các lời gọi chat và trả về kế hoạch JSON cố định."""
+    available = True
+
+    def __init__(self):
+        self.calls = []
+
+    def chat_completion(self, messages, timeout=None, **kwargs):
+        self.calls.append(messages)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(PLAN)))])
+
+class StubWeatherService:
+    cache_time = "2026-10-18T06:00:00"
+
+    def get_forecast_frame(self, province):
+        return ForecastFrame(HOURLY_FORECAST, province=province, cache_time=self.cache_time)
+
+class StubUserRepo:
+    def get_user_with_farm(self, farmer_id):
+        return SimpleNamespace(farms=SimpleNamespace(first=lambda: FARM))
+
+class StubVectorStore:
+    def retrieve(self, store_name, query, k=5):
+        return "Giai đoạn đẻ nhánh giữ mực nước 3-5 cm, tháo cạn khi dự báo mưa lớn."
+
+def stats(water_level_mean, humid_hours):
+    return {"as_of": "2026-10-18 06:00:00 UTC", "windows": {"6h": {
+        "readings": 12,
+        "water_level": {"mean": water_level_mean, "min": 4.0, "max": 6.0},
+        "hours_humidity_above": {"85": humid_hours, "90": 0.0},
+        "leaf_wetness_hours": 0.0,
+    }}}
+
+@pytest.fixture
+def agent(tmp_path):
+    cache = LLMResponseCache(SimpleNamespace(LLM_RESPONSE_CACHE={
+        "path": str(tmp_path / "llm_response_cache.sqlite3"), "ttl_seconds": {"water": 3600},
+    }))
+    return WaterAgent(StubWeatherService(), StubUserRepo(), SimpleNamespace(), StubVectorStore(),
+                      response_cache=cache, llm_gateway=StubLLMGateway())
+
+def test_same_inputs_reuse_the_cached_plan(agent):
+    reading = {"timestamp": "2026-10-18 06:00:00 UTC", "water_level": 5.0, "humidity": 81.0}
+    assert agent.create_water_management_plan("7", reading) == {"plan": PLAN}
+    assert agent.create_water_management_plan("7", dict(reading)) == {"plan": PLAN}
+    assert len(agent.llm.calls) == 1
+    assert agent.response_cache.get_stats()["hits"] == 1
+
+def test_new_reading_or_farm_change_asks_the_llm_again(agent):
+    agent.create_water_management_plan("7", {"water_level": 5.0})
+    agent.create_water_management_plan("7", {"water_level": 9.0})
+    assert len(agent.llm.calls) == 2
+
+    agent.response_cache.invalidate_farm(FARM.id)
+    agent.create_water_management_plan("7", {"water_level": 9.0})
+    assert len(agent.llm.calls) == 3
+
+def test_timestamps_and_small_sensor_changes_hit_the_cache(agent):
+    agent.create_water_management_plan(
+        "7", {"timestamp": "2026-10-18 06:00:00 UTC", "water_level": 5.2, "humidity": 81.0}, stats(5.1, 2.2))
+    agent.create_water_management_plan(
+        "7", {"timestamp": "2026-10-18 06:05:00 UTC", "water_level": 4.9, "humidity": 82.4}, stats(4.8, 1.8))
+    assert len(agent.llm.calls) == 1
+
+def test_water_level_and_forecast_version_change_the_cache_key(agent):
+    agent.create_water_management_plan("7", {"water_level": 5.0}, stats(5.0, 2.0))
+    agent.create_water_management_plan("7", {"water_level": 8.0}, stats(5.0, 2.0))
+    assert len(agent.llm.calls) == 2
+
+    agent.weather_service.cache_time = "2026-10-18T12:00:00"
+    agent.create_water_management_plan("7", {"water_level": 8.0}, stats(5.0, 2.0))
+    assert len(agent.llm.calls) == 3
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+from src.services import weather_service
+from src.services.weather_service import WeatherService
+
+FORECAST = [{"province": "An Giang", "date": "2026-10-18", "hour": "06:00", "temperature": 27, "humidity": 88,
+             "wind_kmh": 8, "rain_chance": 20, "description": "Nhiều mây"}]
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setattr(weather_service.CONFIG, "WEATHER_CACHE_PATH", str(tmp_path / "weather_cache.json"))
+    return WeatherService(service_config={"cache_path": str(tmp_path / "weather_cache.sqlite3")})
+
+def test_concurrent_misses_trigger_exactly_one_crawl(service, monkeypatch):
+    crawls = []
+
+    def slow_crawl(province):
+        crawls.append(province)
+        time.sleep(0.3)
+        return FORECAST
+
+    monkeypatch.setattr(service, "_crawl_weather_data", slow_crawl)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def request_forecast(delay):
+        barrier.wait()
+        time.sleep(delay)
+        results.append(service.get_forecast("An Giang"))
+
+    threads = [threading.Thread(target=request_forecast, args=(0.05 * i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert crawls == ["An Giang"]
+    assert results == [FORECAST] * 8
+    assert service.get_forecast("An Giang") == FORECAST
+    assert len(crawls) == 1
+
+def test_miss_observed_before_another_crawl_finished_reuses_its_result(service, monkeypatch):
+    crawls = []
+    monkeypatch.setattr(service, "_crawl_weather_data", lambda province: crawls.append(province) or FORECAST)
+
+    looked_up_at = time.time()
+    service._fetch("An Giang")
+    assert service._fetch("An Giang", newer_than=looked_up_at) == FORECAST
+    assert crawls == ["An Giang"]